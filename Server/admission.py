@@ -0,0 +1,287 @@
+"""
+Admission control for the inference endpoints.
+
+Every guarded request passes three checks before it runs, cheapest first:
+
+1. Queue time: nginx stamps ``X-Request-Start: t=<seconds>`` when it
+   accepts the request. If the request already waited longer than
+   MAX_QUEUE_MS for a worker thread, answering it would only add to a
+   backlog whose clients have given up, so it is shed with 503.
+2. Concurrency: at most MAX_CONCURRENT inference requests run at once
+   across all workers; beyond that we shed with 503 instead of letting
+   every request slow down. Under gunicorn it defaults to CAPACITY_SHARE
+   of its workers x threads (read from the command line and
+   ``GUNICORN_CMD_ARGS``), so requests are shed while threads are still
+   free for health checks and other endpoints.
+3. Per-client token bucket (RATE_PER_SECOND, BURST), keyed by the client
+   address; forwarding headers count only from TRUSTED_PROXIES. An empty
+   bucket gets 429.
+
+State is shared by all gunicorn workers through a small memory-mapped file
+guarded by ``flock``: counters, one in-flight slot per worker (slots of dead
+workers are reclaimed, so a crash cannot leak capacity) and a fixed-size,
+direct-mapped table of buckets. Two clients that hash to the same bucket
+slot evict each other, which at worst gives a client a fresh bucket. The
+file records the server that created it (the gunicorn master), so a
+restarted server starts from empty counters and buckets while a worker
+that gunicorn replaces keeps them.
+"""
+import os
+import sys
+import math
+import shlex
+import time
+import fcntl
+import hashlib
+import tempfile
+import ipaddress
+import threading
+from functools import wraps
+
+import numpy as np
+from flask import request, jsonify
+
+STATE_PATH = os.environ.get("ADMISSION_STATE_PATH",
+                            os.path.join(tempfile.gettempdir(), "bitbyte_admission.bin"))
+MAX_QUEUE_MS = float(os.environ.get("ADMISSION_MAX_QUEUE_MS", 500))
+RATE_PER_SECOND = float(os.environ.get("ADMISSION_RATE", 10))
+BURST = float(os.environ.get("ADMISSION_BURST", 20))
+SHED_RETRY_AFTER = 1         # seconds suggested to shed clients
+CAPACITY_SHARE = 0.75        # of gunicorn's threads that may run inference at once
+# Addresses (or networks) whose X-Real-IP / X-Forwarded-For are believed, i.e. nginx
+TRUSTED_PROXIES = [ipaddress.ip_network(p.strip(), strict=False) for p in
+                   os.environ.get("ADMISSION_TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if p.strip()]
+
+MAX_WORKERS = 64
+BUCKET_SLOTS = 4096          # power of two
+
+def _gunicorn_capacity():
+    """Workers x threads of the gunicorn server running this process, or None"""
+    if "gunicorn.arbiter" not in sys.modules:
+        return None
+    try:
+        from gunicorn.config import Config
+        config = Config()
+        # Same sources gunicorn reads; the command line wins over the environment
+        argv = shlex.split(os.environ.get("GUNICORN_CMD_ARGS", "")) + sys.argv[1:]
+        args = config.parser().parse_known_args(argv)[0]
+        for name, value in vars(args).items():
+            if value is not None and name in config.settings:
+                config.set(name.lower(), value)
+        return config.workers * config.threads
+    except Exception as e:
+        print(f"Admission control: could not read the gunicorn settings: {str(e)}")
+        return None
+
+def _default_concurrency():
+    capacity = _gunicorn_capacity()
+    if capacity is None:
+        return 16
+    return max(1, int(capacity * CAPACITY_SHARE))
+
+MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT") or _default_concurrency())
+
+COUNTERS = ["admitted", "rate_limited", "concurrency_shed", "queue_shed"]
+HEADER_DTYPE = np.dtype([('server', '<i8')])
+COUNTER_DTYPE = np.dtype([(name, '<i8') for name in COUNTERS])
+WORKER_DTYPE = np.dtype([('pid', '<i8'), ('in_flight', '<i8')])
+BUCKET_DTYPE = np.dtype([('key', '<u8'), ('tokens', '<f8'), ('updated', '<f8')])
+STATE_SIZE = HEADER_DTYPE.itemsize + COUNTER_DTYPE.itemsize + MAX_WORKERS * WORKER_DTYPE.itemsize + \
+    BUCKET_SLOTS * BUCKET_DTYPE.itemsize
+
+_state = {"pid": None, "fd": None, "counters": None, "workers": None, "buckets": None, "slot": None}
+_thread_lock = threading.Lock()
+
+class _Locked:
+    """Exclusive access to the shared state from this thread and process"""
+    def __enter__(self):
+        _thread_lock.acquire()
+        try:
+            _open_state()
+            fcntl.flock(_state["fd"], fcntl.LOCK_EX)
+        except Exception:
+            _thread_lock.release()
+            raise
+        return _state
+
+    def __exit__(self, *exc):
+        fcntl.flock(_state["fd"], fcntl.LOCK_UN)
+        _thread_lock.release()
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _server_pid():
+    """The gunicorn master for its workers, otherwise this process"""
+    return os.getppid() if "gunicorn.arbiter" in sys.modules else os.getpid()
+
+def _open_state():
+    """Map the state file once per process (again after a fork) and claim a worker slot"""
+    pid = os.getpid()
+    if _state["pid"] == pid:
+        return
+    fd = os.open(STATE_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        if os.fstat(fd).st_size != STATE_SIZE:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, STATE_SIZE)
+        header = np.memmap(STATE_PATH, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+        server = _server_pid()
+        if int(header['server'][0]) != server:
+            # Left over from a previous server: start from empty state
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, STATE_SIZE)
+            header['server'][0] = server
+        offset = HEADER_DTYPE.itemsize
+        counters = np.memmap(STATE_PATH, dtype=COUNTER_DTYPE, mode='r+', offset=offset, shape=(1,))
+        offset += COUNTER_DTYPE.itemsize
+        workers = np.memmap(STATE_PATH, dtype=WORKER_DTYPE, mode='r+', offset=offset,
+                            shape=(MAX_WORKERS,))
+        offset += MAX_WORKERS * WORKER_DTYPE.itemsize
+        buckets = np.memmap(STATE_PATH, dtype=BUCKET_DTYPE, mode='r+', offset=offset,
+                            shape=(BUCKET_SLOTS,))
+
+        # Requests in flight in a worker that died will never be released
+        for i in range(MAX_WORKERS):
+            owner = int(workers['pid'][i])
+            if owner == pid or (owner != 0 and not _pid_alive(owner)):
+                workers[i] = (0, 0)
+        free = np.flatnonzero(workers['pid'] == 0)
+        slot = int(free[0]) if len(free) else None
+        if slot is not None:
+            workers[slot] = (pid, 0)
+        if slot is None:
+            print("Admission control: no free worker slot, concurrency limit is not enforced here")
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+    if _state["fd"] is not None:
+        os.close(_state["fd"])
+    _state.update(pid=pid, fd=fd, counters=counters, workers=workers, buckets=buckets, slot=slot)
+
+def _trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def client_key():
+    """
+    Address of the client, as nginx saw it.
+
+    Forwarding headers are only believed from TRUSTED_PROXIES; anyone who
+    reaches the app directly is keyed by their own address. Clients can
+    put anything in X-Forwarded-For, so only the hop nginx appended (the
+    last one) is used, and X-Real-IP is preferred.
+    """
+    remote = request.remote_addr or "unknown"
+    if not _trusted_proxy(remote):
+        return remote
+    real_ip = request.headers.get('X-Real-IP')
+    if real_ip:
+        return real_ip.strip()
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    return remote
+
+def queue_ms():
+    """How long the request waited since nginx accepted it, or None if not stamped"""
+    header = request.headers.get('X-Request-Start')
+    if not header:
+        return None
+    try:
+        started = float(header.strip().lstrip('t='))
+    except ValueError:
+        return None
+    # nginx ${msec} is seconds; some proxies send milliseconds or microseconds
+    while started > 1e11:
+        started /= 1000.0
+    return max((time.time() - started) * 1000.0, 0.0)
+
+def admit(client, waited_ms=None):
+    """
+    Decide whether a request may run.
+
+    Returns ``(None, None)`` when admitted (call ``release()`` when done), or
+    ``(status, retry_after_seconds)`` when it must be turned away.
+    """
+    if waited_ms is not None and waited_ms > MAX_QUEUE_MS:
+        with _Locked() as state:
+            state["counters"]["queue_shed"][0] += 1
+        return 503, SHED_RETRY_AFTER
+
+    key = int.from_bytes(hashlib.blake2b(client.encode('utf-8'), digest_size=8).digest(), 'little')
+    now = time.time()
+    with _Locked() as state:
+        counters, workers = state["counters"], state["workers"]
+        slot = state["slot"]
+        if slot is not None and int(workers['in_flight'].sum()) >= MAX_CONCURRENT:
+            counters["concurrency_shed"][0] += 1
+            return 503, SHED_RETRY_AFTER
+
+        bucket = state["buckets"][key & (BUCKET_SLOTS - 1)]
+        if bucket['key'] != key:
+            tokens = BURST
+        else:
+            tokens = min(BURST, float(bucket['tokens']) + (now - float(bucket['updated'])) * RATE_PER_SECOND)
+        if tokens < 1.0:
+            state["buckets"][key & (BUCKET_SLOTS - 1)] = (key, tokens, now)
+            counters["rate_limited"][0] += 1
+            return 429, max(1, math.ceil((1.0 - tokens) / RATE_PER_SECOND))
+        state["buckets"][key & (BUCKET_SLOTS - 1)] = (key, tokens - 1.0, now)
+
+        if slot is not None:
+            workers['in_flight'][slot] += 1
+        counters["admitted"][0] += 1
+    return None, None
+
+def release():
+    """Give back the concurrency slot taken by ``admit``"""
+    with _Locked() as state:
+        if state["slot"] is not None:
+            state["workers"]['in_flight'][state["slot"]] -= 1
+
+def guarded(view):
+    """Route decorator that runs ``view`` only if the request is admitted"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            status, retry_after = admit(client_key(), queue_ms())
+        except OSError as e:
+            # Never take the API down because the shared state is unavailable
+            print(f"Admission control unavailable: {str(e)}")
+            return view(*args, **kwargs)
+        if status is not None:
+            message = "Rate limit exceeded" if status == 429 else "Server is overloaded, try again shortly"
+            return jsonify({"error": message}), status, {'Retry-After': str(retry_after)}
+        try:
+            return view(*args, **kwargs)
+        finally:
+            release()
+    return wrapper
+
+def stats():
+    """Admission decisions and current load, summed over all workers"""
+    with _Locked() as state:
+        counters = {name: int(state["counters"][name][0]) for name in COUNTERS}
+        live = state["workers"][state["workers"]['pid'] != 0]
+        in_flight = int(live['in_flight'].sum())
+        workers = len(live)
+    return {
+        **counters,
+        "in_flight": in_flight,
+        "workers": workers,
+        "max_concurrent": MAX_CONCURRENT,
+        "max_queue_ms": MAX_QUEUE_MS,
+        "rate_per_second": RATE_PER_SECOND,
+        "burst": BURST,
+    }
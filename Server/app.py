@@ -1,9 +1,14 @@
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, request, jsonify, render_template
 import os
 import json
 from datetime import datetime
 import pandas as pd
-import glob
+import submission_archive
+import dedup
+import partitions
+import model_distribution
+import model_registry
+import ingest_schema
 
 app = Flask(__name__)
 
@@ -25,128 +30,105 @@ def submit_study_data():
         if not data or 'deviceContext' not in data or 'sessions' not in data:
             return jsonify({"error": "Invalid data format"}), 400
         
-        # Create unique ID for this submission
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        device_id = data.get('deviceContext', {}).get('deviceType', 'unknown')
-        filename = f"{timestamp}_{device_id}.json"
+        # Coerce and range-check every session before anything is stored
+        try:
+            rows, report = ingest_schema.normalize_submission(data)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid data format: {str(e)}"}), 400
         
-        # Save raw data
-        with open(os.path.join(DATA_DIR, filename), 'w') as f:
-            json.dump(data, f)
+        # Retries of an earlier submission are acknowledged without storing anything
+        device_id = data.get('deviceContext', {}).get('deviceType', 'unknown')
+        key = dedup.submission_key(data, device_id, request.headers.get('Idempotency-Key'))
+        if dedup.check_and_remember(key):
+            return jsonify({"success": True, "duplicate": True,
+                            "message": "Duplicate submission ignored"}), 200
         
-        # Process data for ML training (in production, you'd queue this for async processing)
-        process_data_for_ml(data)
+        try:
+            # Archive raw data (batched into compressed segments)
+            submission_archive.append_submission(data, device_id, key=key.hex())
+            
+            # Process data for ML training (in production, you'd queue this for async processing)
+            process_data_for_ml(rows)
+        except Exception:
+            dedup.forget(key)
+            raise
         
-        return jsonify({"success": True, "message": "Data received successfully"}), 200
+        return jsonify({"success": True, "message": "Data received successfully",
+                        "accepted": report["accepted"], "rejected": report["rejected"],
+                        "reasons": report["reasons"]}), 200
     
     except Exception as e:
         print(f"Error processing submission: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-def process_data_for_ml(data):
-    """Convert JSON data to DataFrame format suitable for ML training"""
-    try:
-        sessions = data['sessions']
-        if not sessions:
-            return
-            
-        # Convert to DataFrame for easier processing
-        df = pd.DataFrame(sessions)
+def process_data_for_ml(rows):
+    """
+    Store normalized session rows (ingest_schema.COLUMNS) for ML training.
+
+    Errors propagate, so the submission is answered with a 500 and its
+    duplicate-detection key is forgotten; the client's retry is stored.
+    """
+    if rows.empty:
+        return
         
-        # Add any device context as columns
-        for key, value in data['deviceContext'].items():
-            df[f"device_{key}"] = value
-            
-        # Save as CSV for ML processing
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        df.to_csv(os.path.join(DATA_DIR, f"processed_{timestamp}.csv"), index=False)
-    except Exception as e:
-        print(f"Error processing data for ML: {str(e)}")
+    # Save as CSV for ML processing, in the partitions of the sessions' days
+    partitions.write_rows(rows)
 
 @app.route('/api/models/latest', methods=['GET'])
 def get_latest_model():
     """Return the latest ML model"""
-    model_path = os.path.join(OUTPUT_DIR, "NotificationTimePredictor.mlmodel")
-    
-    if not os.path.exists(model_path):
+    # Size, hash and mtime come from the publish manifest, not from the file
+    entry = model_distribution.published_entry('coreml')
+    if entry is None:
         return jsonify({"error": "No model available"}), 404
         
     # Get model creation time
-    model_time = os.path.getmtime(model_path)
-    model_time_str = datetime.fromtimestamp(model_time).strftime("%Y-%m-%d %H:%M:%S")
+    model_time_str = datetime.fromtimestamp(entry["mtime"]).strftime("%Y-%m-%d %H:%M:%S")
     
-    # Return model file
-    return send_file(
-        model_path,
-        mimetype='application/octet-stream',
-        as_attachment=True,
+    # Return model file (ETag/304, precompressed variants, sendfile or nginx offload)
+    return model_distribution.send_published(
+        'coreml',
         download_name=f"NotificationTimePredictor_{model_time_str}.mlmodel"
     )
 
 @app.route('/dashboard')
 def dashboard():
     """Render the data collection dashboard"""
-    # Count total sessions collected
-    total_sessions = 0
-    submissions = []
-    
-    # Get list of all data files
-    data_files = glob.glob(os.path.join(DATA_DIR, "*.json"))
-    data_files.sort(key=os.path.getmtime, reverse=True)
+    # Totals come straight from the archive index
+    stats = submission_archive.archive_stats()
+    total_sessions = stats["sessions"]
+    unique_devices = stats["devices"]
     
-    # Calculate stats and prepare submission list
-    unique_devices = set()
-    for file_path in data_files:
-        try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                
-            # Count sessions
-            session_count = len(data.get('sessions', []))
-            total_sessions += session_count
-            
-            # Track unique devices
-            device_id = data.get('deviceContext', {}).get('deviceType', 'unknown')
-            unique_devices.add(device_id)
-            
-            # Add to submissions list (limit to 10 most recent)
-            if len(submissions) < 10:
-                timestamp = datetime.fromtimestamp(os.path.getmtime(file_path)).strftime("%Y-%m-%d %H:%M:%S")
-                submissions.append({
-                    'timestamp': timestamp,
-                    'device_type': device_id,
-                    'session_count': session_count
-                })
-        except:
-            continue
+    # Add to submissions list (limit to 10 most recent)
+    submissions = []
+    for record in submission_archive.recent_submissions(limit=10):
+        submissions.append({
+            'timestamp': datetime.fromtimestamp(record['received_at']).strftime("%Y-%m-%d %H:%M:%S"),
+            'device_type': record['device_id'],
+            'session_count': record['sessions']
+        })
     
     # Get model performance info
     model_path = os.path.join(OUTPUT_DIR, "NotificationTimePredictor.mlmodel")
     if os.path.exists(model_path):
         model_version = datetime.fromtimestamp(os.path.getmtime(model_path)).strftime("%Y-%m-%S %H:%M:%S")
-        
-        # In a real app, you'd store and retrieve the actual accuracy
-        model_accuracy = "85%" 
     else:
         model_version = "None"
-        model_accuracy = "N/A"
+    current = model_registry.current_version()
+    model_accuracy = describe_accuracy(model_registry.get_metadata(current) if current else None)
     
     # Prepare chart data - submissions per day for the last 30 days
     today = datetime.now().date()
     chart_labels = [(today - pd.Timedelta(days=i)).strftime("%Y-%m-%d") for i in range(30)]
     chart_labels.reverse()
     
-    # Count submissions per day
-    submissions_by_day = {}
-    for file_path in data_files:
-        file_date = datetime.fromtimestamp(os.path.getmtime(file_path)).date().strftime("%Y-%m-%d")
-        if file_date in chart_labels:
-            submissions_by_day[file_date] = submissions_by_day.get(file_date, 0) + 1
-    
-    chart_data = [submissions_by_day.get(day, 0) for day in chart_labels]
+    # Sessions per day straight from the partition metadata
+    sessions_by_day = partitions.rows_per_day(start=chart_labels[0])
+    chart_data = [sessions_by_day.get(day, 0) for day in chart_labels]
     
     return render_template('dashboard.html',
                           total_sessions=total_sessions,
+                          duplicates=dedup.stats()["duplicates"],
                           total_users=len(unique_devices),
                           last_update=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                           model_version=model_version,
@@ -155,6 +137,21 @@ def dashboard():
                           chart_labels=json.dumps(chart_labels),
                           chart_data=json.dumps(chart_data))
 
+def describe_accuracy(metadata):
+    """Accuracy of a registry version for the dashboard, from its backtest if it has one"""
+    summary = ((metadata or {}).get("backtest") or {}).get("summary")
+    if summary:
+        return (f"{summary['accuracy']:.0%} within {summary['tolerance_seconds']}s "
+                f"(MAE {summary['mae']:.1f}s, {summary['folds']}-fold backtest)")
+    if metadata and metadata.get("mae") is not None:
+        return f"MAE {metadata['mae']:.1f}s (random split)"
+    return "N/A"
+
+@app.route('/api/submission-stats', methods=['GET'])
+def submission_stats():
+    """Duplicate detection counters since the server started"""
+    return jsonify(dedup.stats())
+
 @app.route('/api/train-model', methods=['POST'])
 def api_train_model():
     """API endpoint to trigger model training"""
@@ -163,9 +160,13 @@ def api_train_model():
         # For demo purposes, we'll just import and call the training script
         from train_model import load_and_prepare_data, train_notification_time_model
         
-        data = load_and_prepare_data()
+        # Optional {"days": 30, "since": "YYYY-MM-DD", "until": ..., "half_life_days": 7,
+        #           "backtest_folds": 5}
+        params = request.get_json(silent=True) or {}
+        data = load_and_prepare_data(params.get('days'), params.get('since'),
+                                     params.get('until'), params.get('half_life_days'))
         if data is not None:
-            model_path = train_notification_time_model(data)
+            model_path = train_notification_time_model(data, backtest_folds=params.get('backtest_folds'))
             return jsonify({"success": True, "model_path": model_path})
         else:
             return jsonify({"success": False, "error": "No data available for training"})
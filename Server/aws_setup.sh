@@ -30,7 +30,7 @@ After=network.target
 [Service]
 User=ubuntu
 WorkingDirectory=/home/ubuntu/bit-ml-server
-ExecStart=/home/ubuntu/bit-ml-server/venv/bin/gunicorn --bind 0.0.0.0:5001 prediction_api:app
+ExecStart=/home/ubuntu/bit-ml-server/venv/bin/gunicorn --threads 8 --bind 0.0.0.0:5001 prediction_api:app
 Restart=always
 
 [Install]
@@ -0,0 +1,125 @@
+"""
+Rolling-origin backtest of the notification time model.
+
+Training rows arrive in collection order (partition day, then file, then
+row). Instead of one random split, the data is cut into ``folds + 1``
+consecutive blocks: fold k trains on blocks 0..k and is scored on block
+k+1, so every score comes from data collected after everything the model
+saw, as in production.
+
+Folds are fitted in parallel in spawned worker processes. The training
+matrix is written once to a temporary ``.npy`` file that every worker
+memory-maps read-only, so it is not pickled to each of them.
+
+    evaluation = backtest.start(X, y, weights, folds=5, params=MODEL_PARAMS)
+    ...  # fit the final model meanwhile
+    report = evaluation.result()    # {"folds": [...], "summary": {...}}
+
+``accuracy`` is the share of test predictions within
+ACCURACY_TOLERANCE_SECONDS of the observed response time. ``baseline_mae``
+is the error of always predicting the training median.
+"""
+import os
+import time
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+FOLDS = 5
+MIN_TEST_ROWS = 20               # fewer folds are used when a test block would be smaller
+ACCURACY_TOLERANCE_SECONDS = 60
+
+def fold_bounds(n_rows, folds=FOLDS, min_test_rows=MIN_TEST_ROWS):
+    """``[(train_end, test_end)]`` row bounds of each fold, oldest first"""
+    folds = min(int(folds), n_rows // min_test_rows - 1)
+    if folds < 1:
+        return []
+    edges = np.linspace(0, n_rows, folds + 2).astype(int)
+    return [(int(edges[k + 1]), int(edges[k + 2])) for k in range(folds)]
+
+def _score(path, fold, train_end, test_end, params):
+    """Fit and score one fold (runs in a worker process)"""
+    started = time.perf_counter()
+    data = np.load(path, mmap_mode='r')
+    X, y, w = data[:, :-2], data[:, -2], data[:, -1]
+    model = RandomForestRegressor(**params)
+    model.fit(X[:train_end], y[:train_end], sample_weight=w[:train_end])
+    actual = np.asarray(y[train_end:test_end], dtype=np.float64)
+    errors = model.predict(X[train_end:test_end]) - actual
+    baseline = np.median(y[:train_end]) - actual
+    return {
+        "fold": fold,
+        "train_rows": train_end,
+        "test_rows": test_end - train_end,
+        "mae": float(np.abs(errors).mean()),
+        "rmse": float(np.sqrt((errors ** 2).mean())),
+        "accuracy": float((np.abs(errors) <= ACCURACY_TOLERANCE_SECONDS).mean()),
+        "baseline_mae": float(np.abs(baseline).mean()),
+        "fit_seconds": round(time.perf_counter() - started, 3),
+    }
+
+def summarize(folds):
+    """Metrics over all folds, weighted by their test rows"""
+    rows = np.array([f["test_rows"] for f in folds], dtype=np.float64)
+    mean = lambda key: float(np.average([f[key] for f in folds], weights=rows))
+    return {
+        "folds": len(folds),
+        "test_rows": int(rows.sum()),
+        "mae": mean("mae"),
+        "rmse": float(np.sqrt(np.average([f["rmse"] ** 2 for f in folds], weights=rows))),
+        "accuracy": mean("accuracy"),
+        "baseline_mae": mean("baseline_mae"),
+        "tolerance_seconds": ACCURACY_TOLERANCE_SECONDS,
+    }
+
+class Backtest:
+    """Folds running in a process pool; ``result()`` waits for the report"""
+    def __init__(self, path, executor, futures, started):
+        self._path = path
+        self._executor = executor
+        self._futures = futures
+        self._started = started
+
+    def result(self):
+        try:
+            folds = [future.result() for future in self._futures]
+        finally:
+            self._executor.shutdown()
+            os.remove(self._path)
+        return {
+            "method": "rolling_origin",
+            "folds": folds,
+            "summary": summarize(folds),
+            "seconds": round(time.perf_counter() - self._started, 3),
+        }
+
+def start(X, y, weights=None, folds=FOLDS, params=None, workers=None):
+    """
+    Start a backtest of ``RandomForestRegressor(**params)`` over rows in time order.
+
+    Returns None when there are too few rows for a single fold.
+    """
+    bounds = fold_bounds(len(y), folds)
+    if not bounds:
+        return None
+    started = time.perf_counter()
+    fd, path = tempfile.mkstemp(prefix="backtest_", suffix=".npy")
+    os.close(fd)
+    # [features | target | weight], written once and memory-mapped by every worker
+    data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                     shape=(len(y), X.shape[1] + 2))
+    data[:, :-2] = X
+    data[:, -2] = y
+    data[:, -1] = 1.0 if weights is None else weights
+    data.flush()
+    del data
+
+    workers = workers or min(len(bounds), os.cpu_count() or 1)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    params = dict(params or {}, n_jobs=1)
+    futures = [executor.submit(_score, path, k, train_end, test_end, params)
+               for k, (train_end, test_end) in enumerate(bounds)]
+    return Backtest(path, executor, futures, started)
@@ -0,0 +1,99 @@
+"""
+Binary batch requests for /predict.
+
+Server-to-server callers can skip JSON entirely:
+
+* ``Content-Type: application/x-float32-matrix`` with an ``X-Features``
+  header naming the columns (comma-separated) and a body of little-endian
+  float32 values, row-major. The body is wrapped with ``np.frombuffer``,
+  so the model reads the request bytes directly when the columns are
+  already in the model's order.
+* ``Content-Type: application/msgpack`` (needs the ``msgpack`` package) with
+  ``{"features": [...], "data": <float32 LE bytes>}`` or
+  ``{"features": [...], "rows": [[...], ...]}``.
+
+The response is a raw little-endian float32 array with one prediction per
+row (``application/x-float32-array``), or ``{"predictions": <float32 LE
+bytes>, "version": ...}`` in msgpack for msgpack requests.
+"""
+import numpy as np
+from flask import Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FLOAT32_MATRIX = "application/x-float32-matrix"
+FLOAT32_ARRAY = "application/x-float32-array"
+MSGPACK = "application/msgpack"
+CONTENT_TYPES = (FLOAT32_MATRIX, MSGPACK)
+FEATURES_HEADER = "X-Features"
+MAX_ROWS = 100000
+LE_FLOAT32 = np.dtype('<f4')
+
+def decode(content_type, headers, body):
+    """Return (columns, matrix) for a binary request; raises ValueError if malformed"""
+    if content_type == FLOAT32_MATRIX:
+        columns = [c.strip() for c in headers.get(FEATURES_HEADER, '').split(',') if c.strip()]
+        data = body
+    else:
+        if msgpack is None:
+            raise ValueError("msgpack requests need the msgpack package on the server")
+        payload = msgpack.unpackb(body, raw=False)
+        if not isinstance(payload, dict):
+            raise ValueError("msgpack body must be a map with 'features' and 'data' or 'rows'")
+        columns = [str(c) for c in payload.get('features') or []]
+        if 'rows' in payload:
+            matrix = np.asarray(payload['rows'], dtype=np.float32).reshape(-1, len(columns) or 1)
+            return columns, _check(columns, matrix)
+        data = payload.get('data') or b''
+
+    if not columns:
+        raise ValueError(f"Feature order is required ({FEATURES_HEADER} header or 'features')")
+    if len(data) % (4 * len(columns)):
+        raise ValueError(f"Body is not a whole number of rows of {len(columns)} float32 values")
+    matrix = np.frombuffer(data, dtype=LE_FLOAT32).reshape(-1, len(columns))
+    return columns, _check(columns, matrix)
+
+def _check(columns, matrix):
+    if len(set(columns)) != len(columns):
+        raise ValueError("Feature names must be unique")
+    if matrix.shape[1] != len(columns):
+        raise ValueError(f"Rows must have {len(columns)} values")
+    if len(matrix) > MAX_ROWS:
+        raise ValueError(f"At most {MAX_ROWS} rows per request")
+    return matrix
+
+def model_matrix(columns, matrix, model_columns):
+    """
+    Lay ``matrix`` out in ``model_columns`` order.
+
+    No copy is made when the caller already sends the model's order.
+    Raises ValueError naming any feature the model needs but the request
+    lacks; extra request columns are ignored.
+    """
+    if list(columns) == list(model_columns):
+        return matrix
+    positions = {c: i for i, c in enumerate(columns)}
+    missing = [c for c in model_columns if c not in positions]
+    if missing:
+        raise ValueError(f"Missing features: {', '.join(missing)}")
+    return matrix[:, [positions[c] for c in model_columns]]
+
+def encode(content_type, predictions, version, columns=None):
+    """
+    Response carrying float32 predictions in the format matching the request.
+
+    ``predictions`` may be a matrix (row-major) whose ``columns`` are named
+    in the ``X-Columns`` header.
+    """
+    values = np.ascontiguousarray(predictions, dtype=LE_FLOAT32).tobytes()
+    headers = {"X-Rows": str(len(predictions)), "X-Model-Version": version or ""}
+    if columns:
+        headers["X-Columns"] = ",".join(columns)
+    if content_type == MSGPACK:
+        body = msgpack.packb({"predictions": values, "columns": columns, "version": version},
+                             use_bin_type=True)
+        return Response(body, mimetype=MSGPACK, headers=headers)
+    return Response(values, mimetype=FLOAT32_ARRAY, headers=headers)
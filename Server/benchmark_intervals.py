@@ -0,0 +1,69 @@
+"""
+Benchmark forest prediction intervals against plain ``predict``.
+
+Loads the current scikit-learn model (or fits a small forest if there is
+none), then times ``model.predict`` and ``forest_intervals.intervals`` on
+random batches of several sizes and checks that the interval mean matches
+the prediction.
+
+    python benchmark_intervals.py --sizes 1 100 5000 --repeat 20
+"""
+import time
+import pickle
+import argparse
+import warnings
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+import forest_intervals
+import slot_search
+
+SKLEARN_MODEL_PATH = "output_models/NotificationTimePredictor.pkl"
+FALLBACK_FEATURES = ['dayOfWeek', 'hourOfDay', 'minuteOfHour', 'device_activity', 'device_batteryLevel']
+
+def load_model():
+    try:
+        with open(SKLEARN_MODEL_PATH, 'rb') as f:
+            model = pickle.load(f)
+        if forest_intervals.supports(model):
+            print(f"Using {SKLEARN_MODEL_PATH}")
+            return model
+        print(f"{SKLEARN_MODEL_PATH} is not a random forest")
+    except OSError:
+        print(f"No model at {SKLEARN_MODEL_PATH}")
+    print("Fitting a 100-tree forest on random data instead")
+    rng = np.random.default_rng(0)
+    X = rng.random((5000, len(FALLBACK_FEATURES)))
+    y = X @ rng.random(len(FALLBACK_FEATURES)) + rng.normal(0, 0.1, len(X))
+    return RandomForestRegressor(n_estimators=100, random_state=0).fit(X, y)
+
+def best_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time prediction intervals against predict")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 5000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    # Plain arrays are fine here; skip sklearn's feature-name warning
+    warnings.simplefilter("ignore", UserWarning)
+
+    model = load_model()
+    columns = slot_search.model_columns(model, FALLBACK_FEATURES)
+    print(f"Trees: {len(model.estimators_)}, features: {len(columns)}")
+    forest_intervals.intervals(model, np.zeros((1, len(columns)), dtype=np.float32))  # flatten once
+
+    rng = np.random.default_rng(1)
+    print(f"{'rows':>6}  {'predict ms':>11}  {'intervals ms':>13}  {'ratio':>6}  {'max |diff|':>10}")
+    for size in args.sizes:
+        X = rng.random((size, len(columns))).astype(np.float32)
+        predict_ms = best_ms(lambda: model.predict(X), args.repeat)
+        interval_ms = best_ms(lambda: forest_intervals.intervals(model, X), args.repeat)
+        diff = np.abs(forest_intervals.intervals(model, X)["mean"] - model.predict(X)).max()
+        print(f"{size:>6}  {predict_ms:>11.2f}  {interval_ms:>13.2f}  {interval_ms / predict_ms:>6.2f}  {diff:>10.2e}")
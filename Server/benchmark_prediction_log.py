@@ -0,0 +1,93 @@
+"""
+Benchmark the per-request cost of ``prediction_log.record``.
+
+Logs into a temporary directory and reports the p50/p99 time of one
+``record`` call, measured as ``/metrics`` measures it (wall clock around
+the call), in two settings:
+
+* alone: one thread calling ``record`` back to back
+* loaded: the same calls while ``--threads`` other threads serve
+  ``/predict`` through the Flask test client (request parsing, a
+  single-row forest prediction, JSON encoding), as in a gunicorn worker
+  with ``--threads``. Wall-clock time then includes waiting for the GIL
+  while another thread holds it, so CPU time of the calling thread
+  (``time.thread_time``, ``cpu_us`` in ``/metrics``) is reported too.
+
+    python benchmark_prediction_log.py --calls 20000 --threads 7
+"""
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import warnings
+
+import numpy as np
+from flask import Flask, request, jsonify
+from sklearn.ensemble import RandomForestRegressor
+
+import prediction_log
+
+ROW = {'dayOfWeek': 2, 'hourOfDay': 14, 'minuteOfHour': 30, 'device_activity': 0.7,
+       'device_batteryLevel': 0.8, 'device_screenActive': 1, 'device_appInForeground': 0,
+       'device_audioPlaying': 0}
+
+def measure(calls):
+    """Wall-clock and thread CPU microseconds of each ``record`` call"""
+    wall, cpu = np.empty(calls), np.empty(calls)
+    for i in range(calls):
+        started, started_cpu = time.perf_counter(), time.thread_time()
+        prediction_log.record("0123456789ab", f"user_{i % 100}", ROW, 123.4)
+        wall[i] = time.perf_counter() - started
+        cpu[i] = time.thread_time() - started_cpu
+        if i % 1000 == 999:
+            # Let the writer thread drain the buffer, as request gaps would
+            time.sleep(0.002)
+    return wall * 1e6, cpu * 1e6
+
+def report(label, wall, cpu):
+    print(f"{label:>8}  {np.percentile(wall, 50):>8.1f}  {np.percentile(wall, 99):>8.1f}  "
+          f"{np.percentile(cpu, 50):>8.1f}  {np.percentile(cpu, 99):>8.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time prediction_log.record alone and under load")
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=7, help="busy request threads in the loaded run")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", UserWarning)
+
+    log_dir = tempfile.mkdtemp(prefix="prediction_log_")
+    prediction_log.LOG_DIR = log_dir
+    rng = np.random.default_rng(0)
+    X = rng.random((5000, len(ROW)))
+    model = RandomForestRegressor(n_estimators=100, random_state=0).fit(X, X.sum(axis=1))
+
+    app = Flask(__name__)
+    @app.route('/predict', methods=['POST'])
+    def predict():
+        data = request.json
+        features = np.array([[float(data[name]) for name in ROW]])
+        return jsonify({"prediction": float(model.predict(features)[0]), "status": "success"})
+    try:
+        measure(1000)  # warm up
+        print(f"{'':>8}  {'wall p50':>8}  {'wall p99':>8}  {'cpu p50':>8}  {'cpu p99':>8}  (us)")
+        report("alone", *measure(args.calls))
+
+        stop = threading.Event()
+        def busy():
+            client = app.test_client()
+            while not stop.is_set():
+                client.post('/predict', json=ROW)
+        workers = [threading.Thread(target=busy, daemon=True) for _ in range(args.threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            report("loaded", *measure(args.calls))
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        prediction_log.flush()
+        print(f"Logged {prediction_log.stats()['logged']} records, dropped {prediction_log.stats()['dropped']}")
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
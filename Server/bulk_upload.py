@@ -0,0 +1,272 @@
+"""
+Streaming, resumable ingestion of contributed training data.
+
+A client creates an upload (``create_upload``), then sends the file in
+chunks of at most MAX_CHUNK_BYTES, each tagged with its byte offset. Every
+chunk is parsed and validated as it arrives: complete lines are turned into
+rows and normalized by ``ingest_schema`` (rows that fail validation are
+counted and dropped), and the accepted rows are written to the training
+store as ``processed_upload_<id>_<offset>.csv`` in the partitions of the
+rows' own days (rows without a timestamp go to the day the upload
+started, so a reprocessed chunk lands where it did before). Only the unfinished last line is carried over to
+the next chunk, so memory stays bounded by the chunk size whatever the
+size of the file, and the raw upload is never stored.
+
+Upload state (offset, CSV header, carried bytes, counts) lives in
+``uploaded_data/<id>.json`` and is updated under a per-upload file lock, so
+chunks may be handled by different workers, and an interrupted upload is
+resumed from the offset the server reports. Output files are named by
+offset, so a chunk that is processed twice overwrites its own output.
+Finished uploads keep their state for COMPLETED_RETENTION_SECONDS, so the
+client can still read the final counts, and abandoned ones for
+ABANDONED_RETENTION_SECONDS; expired state and lock files are removed
+whenever an upload is created. Single-request uploads (``ingest_stream``)
+remove theirs as soon as they finish.
+
+Formats: CSV with a header line, or NDJSON with one row object (or one
+``{"deviceContext": ..., "sessions": [...]}`` submission) per line.
+Records must not span lines.
+"""
+import os
+import io
+import json
+import time
+import uuid
+import fcntl
+
+import pandas as pd
+
+import ingest_schema
+import ingest_writer
+import partitions
+from features import submission_rows
+
+UPLOAD_DIR = "uploaded_data"
+MAX_CHUNK_BYTES = 8 * 1024 * 1024
+MAX_LINE_BYTES = 1024 * 1024
+MAX_ERROR_SAMPLES = 20
+FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+COMPLETED_RETENTION_SECONDS = 24 * 3600
+ABANDONED_RETENTION_SECONDS = 7 * 24 * 3600
+
+class OffsetMismatch(ValueError):
+    """A chunk did not start where the upload currently ends"""
+    def __init__(self, expected):
+        super().__init__(f"Chunk must start at offset {expected}")
+        self.expected = expected
+
+class UnknownUpload(LookupError):
+    """No upload with this id (never created, or expired)"""
+
+class _UploadLock:
+    """Cross-process lock for one upload's state"""
+    def __init__(self, upload_id):
+        self.path = os.path.join(UPLOAD_DIR, f".{upload_id}.lock")
+
+    def __enter__(self):
+        self._f = open(self.path, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+
+def _state_path(upload_id):
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.json")
+
+def _remove_upload(upload_id):
+    """Delete an upload's state, then its lock file; caller holds _UploadLock"""
+    for path in (_state_path(upload_id), _UploadLock(upload_id).path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def expire_uploads(now=None):
+    """Remove the state of uploads finished or abandoned long enough ago; returns how many"""
+    now = time.time() if now is None else now
+    upload_ids = set()
+    for name in os.listdir(UPLOAD_DIR):
+        if name.endswith(".json"):
+            upload_ids.add(name[:-len(".json")])
+        elif name.startswith(".") and name.endswith(".lock"):
+            upload_ids.add(name[1:-len(".lock")])
+    removed = 0
+    for upload_id in upload_ids:
+        # The state file changes with every chunk; the lock file only tells when it was created
+        paths = [_state_path(upload_id), _UploadLock(upload_id).path]
+        try:
+            age = now - next(os.path.getmtime(p) for p in paths if os.path.exists(p))
+        except (StopIteration, OSError):
+            continue
+        if len(upload_id) != 32 or age < COMPLETED_RETENTION_SECONDS:
+            continue
+        with _UploadLock(upload_id):
+            state = get_upload(upload_id)
+            # A lock file without state is left by a request for a removed upload
+            if state is None or state["complete"] or age >= ABANDONED_RETENTION_SECONDS:
+                _remove_upload(upload_id)
+                removed += 1
+    return removed
+
+def _save_state(state):
+    ingest_writer.write_atomic(_state_path(state["upload_id"]),
+                               lambda f: json.dump(state, f), mode='w')
+
+def create_upload(filename, size=None, fmt=None):
+    """Start an upload and return its state; ``fmt`` defaults from the file extension"""
+    fmt = fmt or FORMATS.get(os.path.splitext(filename or "")[1].lower())
+    if fmt not in ("csv", "ndjson"):
+        raise ValueError("format must be csv or ndjson (or use a .csv/.ndjson/.jsonl filename)")
+    if size is not None and int(size) < 0:
+        raise ValueError("size must not be negative")
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    expire_uploads()
+    state = {
+        "upload_id": uuid.uuid4().hex,
+        # Partition of rows without a timestamp
+        "day": partitions.day_of(),
+        "filename": filename,
+        "format": fmt,
+        "size": int(size) if size is not None else None,
+        "offset": 0,
+        "complete": False,
+        "header": None,
+        "carry": "",
+        "skip_line": False,
+        "accepted": 0,
+        "rejected": 0,
+        "errors": [],
+        "files": [],
+    }
+    _save_state(state)
+    return state
+
+def get_upload(upload_id):
+    """Return the state of an upload, or None if it does not exist"""
+    if not all(c in "0123456789abcdef" for c in upload_id) or len(upload_id) != 32:
+        return None
+    try:
+        with open(_state_path(upload_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def public_state(state):
+    """State fields worth reporting to the client"""
+    return {k: state[k] for k in ("upload_id", "filename", "format", "size", "offset",
+                                  "complete", "accepted", "rejected", "errors")}
+
+def append_chunk(upload_id, offset, payload, last=False):
+    """
+    Validate and store the rows in one chunk, returning the new state.
+
+    ``last`` marks the final chunk when the upload was created without a
+    size. Raises OffsetMismatch if ``offset`` is not the current end and
+    UnknownUpload if the upload does not exist (any more).
+    """
+    if len(payload) > MAX_CHUNK_BYTES:
+        raise ValueError(f"Chunks are limited to {MAX_CHUNK_BYTES} bytes")
+    # Also checks the id's shape before it names a lock file
+    if get_upload(upload_id) is None:
+        raise UnknownUpload(upload_id)
+    with _UploadLock(upload_id):
+        state = get_upload(upload_id)
+        if state is None:
+            raise UnknownUpload(upload_id)
+        if state["complete"]:
+            raise ValueError("Upload is already complete")
+        if offset != state["offset"]:
+            raise OffsetMismatch(state["offset"])
+        end = offset + len(payload)
+        if state["size"] is not None and end > state["size"]:
+            raise ValueError(f"Chunk ends past the declared size of {state['size']} bytes")
+        last = last or (state["size"] is not None and end == state["size"])
+
+        data = state["carry"].encode('latin-1') + payload
+        if last:
+            complete, carry = data, b""
+        else:
+            cut = data.rfind(b"\n") + 1
+            complete, carry = data[:cut], data[cut:]
+
+        if state["skip_line"]:
+            # Drop the rest of an over-long line from the previous chunk
+            newline = complete.find(b"\n")
+            if newline < 0 and not last:
+                complete, carry = b"", b""
+            else:
+                complete = complete[newline + 1:] if newline >= 0 else b""
+                state["skip_line"] = False
+        if len(carry) > MAX_LINE_BYTES:
+            _reject(state, 1, f"Line at byte {end - len(carry)} is longer than {MAX_LINE_BYTES} bytes")
+            carry, state["skip_line"] = b"", True
+
+        if complete.strip():
+            rows, rejected = _parse(state, complete)
+            _reject(state, rejected, f"{rejected} lines could not be parsed near byte {offset}" if rejected else None)
+            rows, report = ingest_schema.normalize(rows)
+            invalid = report["rejected"]
+            _reject(state, invalid, f"{invalid} rows failed validation near byte {offset} "
+                                    f"(bad {', '.join(sorted(report['reasons']))})" if invalid else None)
+            if len(rows):
+                name = f"processed_upload_{upload_id}_{offset:012d}.csv"
+                partitions.write_rows(rows, name=name, day=state["day"])
+                state["accepted"] += len(rows)
+                state["files"].append(name)
+
+        state["offset"] = end
+        state["carry"] = carry.decode('latin-1')  # lossless for a partial UTF-8 character
+        state["complete"] = last
+        _save_state(state)
+    if last:
+        ingest_writer.sync()
+    return state
+
+def _reject(state, count, message):
+    state["rejected"] += count
+    if message and len(state["errors"]) < MAX_ERROR_SAMPLES:
+        state["errors"].append(message)
+
+def _parse(state, data):
+    """Turn complete lines into a DataFrame; returns (rows, unparseable line count)"""
+    lines = [line for line in data.split(b"\n") if line.strip()]
+    if state["format"] == "csv":
+        if state["header"] is None:
+            state["header"] = [c.strip() for c in pd.read_csv(io.BytesIO(lines[0]), nrows=0).columns]
+            lines = lines[1:]
+        if not lines:
+            return pd.DataFrame(), 0
+        rows = pd.read_csv(io.BytesIO(b"\n".join(lines)), header=None, names=state["header"],
+                           on_bad_lines='skip', skip_blank_lines=True)
+        return rows, len(lines) - len(rows)
+
+    records, bad = [], 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            bad += 1
+            continue
+        if isinstance(record, dict) and 'sessions' in record:
+            records.extend(submission_rows(record))
+        elif isinstance(record, dict):
+            records.append(record)
+        else:
+            bad += 1
+    return pd.DataFrame(records), bad
+
+def ingest_stream(stream, filename, fmt=None):
+    """Run a whole file-like object through an upload, one chunk at a time"""
+    state = create_upload(filename, fmt=fmt)
+    offset = 0
+    while True:
+        chunk = stream.read(MAX_CHUNK_BYTES)
+        state = append_chunk(state["upload_id"], offset, chunk, last=not chunk)
+        if not chunk:
+            # Nobody resumes or polls a single-request upload
+            with _UploadLock(state["upload_id"]):
+                _remove_upload(state["upload_id"])
+            return state
+        offset += len(chunk)
@@ -0,0 +1,118 @@
+"""
+CoreML export stage for trained scikit-learn models.
+
+Conversion runs in a separate worker process, so ``coremltools`` is only
+imported there (never by the web app or at training-module import time),
+and it runs while the caller writes the pickle and evaluates the model.
+Results are cached in ``output_models/coreml_cache/`` under the SHA-256 of
+the pickled model plus its feature list: exporting an unchanged model again
+returns the cached file without starting a worker.
+
+    export = coreml_export.start(model_bytes, features)
+    ...  # save the pickle, evaluate
+    coreml_path = export.result()   # cached .mlmodel path, or None on failure
+"""
+import os
+import json
+import pickle
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+OUTPUT_DIR = "output_models"
+CACHE_DIR = os.path.join(OUTPUT_DIR, "coreml_cache")
+MAX_CACHED = 10                  # exported models kept in the cache
+EXPORT_TIMEOUT_SECONDS = 600
+OUTPUT_NAME = 'notificationTime'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def cache_key(model_bytes, features):
+    """Hash identifying an export: the pickled model and its input features"""
+    digest = hashlib.sha256(model_bytes)
+    digest.update(json.dumps(list(features)).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.mlmodel")
+
+def _convert(model_bytes, features, target):
+    """Worker process: unpickle, convert and atomically store the CoreML model"""
+    import coremltools as ct
+
+    model = pickle.loads(model_bytes)
+    coreml_model = ct.converters.sklearn.convert(
+        model,
+        input_features=[(f, ct.TensorType(shape=(1,))) for f in features],
+        output_feature_names=[OUTPUT_NAME],
+    )
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    coreml_model.save(tmp_path)
+    os.replace(tmp_path, target)
+    return target
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: the web app has threads, which fork does not copy safely
+            _executor = ProcessPoolExecutor(max_workers=1,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+def _reset_executor():
+    """Drop a pool whose worker died so the next export starts a fresh one"""
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+def _prune():
+    files = sorted((os.path.join(CACHE_DIR, n) for n in os.listdir(CACHE_DIR) if n.endswith(".mlmodel")),
+                   key=os.path.getmtime, reverse=True)
+    for path in files[MAX_CACHED:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class Export:
+    """Handle for a running or cached export"""
+    def __init__(self, key, future, cached=False):
+        self.key = key
+        self.future = future
+        self.cached = cached
+
+    def result(self, timeout=EXPORT_TIMEOUT_SECONDS):
+        """Path of the exported model, or None if conversion failed"""
+        try:
+            path = self.future.result(timeout=timeout)
+        except BrokenProcessPool as e:
+            _reset_executor()
+            print(f"Error converting to CoreML: {str(e)}")
+            return None
+        except Exception as e:
+            print(f"Error converting to CoreML: {str(e)}")
+            return None
+        _prune()
+        return path
+
+def start(model_bytes, features):
+    """Begin exporting a pickled model; returns an Export at once"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    key = cache_key(model_bytes, features)
+    target = cache_path(key)
+    if os.path.exists(target):
+        os.utime(target)  # keep recently used exports out of pruning
+        done = Future()
+        done.set_result(target)
+        return Export(key, done, cached=True)
+
+    try:
+        future = _get_executor().submit(_convert, model_bytes, list(features), target)
+    except Exception as e:
+        future = Future()
+        future.set_exception(e)
+    return Export(key, future)
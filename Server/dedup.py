@@ -0,0 +1,280 @@
+"""
+Duplicate detection for study-data submissions.
+
+Devices retry uploads on flaky networks, so the same payload can arrive
+several times. Each submission gets a key: the client's ``Idempotency-Key``
+header when it sends one, otherwise the SHA-256 of the canonical JSON
+payload, namespaced by device. A key is a duplicate if it was seen
+
+* in the exact recent window (keys seen in the last RECENT_WINDOW_SECONDS,
+  at most RECENT_MAX_KEYS), or
+* in a rotating Bloom filter that keys enter when they age out of the
+  window. Two generations of BLOOM_BITS bits each cover the last
+  BLOOM_ROTATE_SECONDS to twice that, in a few megabytes for millions of
+  keys; a false positive (about 1 in 2000 at capacity) drops a new upload.
+
+All of it lives in a memory-mapped file next to the archive
+(``DEDUP_STATE_PATH``), shared by every ingest worker under ``flock`` as
+in admission control, and kept across restarts. The recent window is a
+ring of ``(key, first seen)`` entries in arrival order plus an
+open-addressing table pointing into it, so a check probes a few slots.
+When the file is first created, keys archived in the last
+RECENT_WINDOW_SECONDS are added by a background thread in small batches;
+requests are checked meanwhile against what is there so far.
+"""
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+
+import numpy as np
+
+import submission_archive
+
+STATE_PATH = os.environ.get("DEDUP_STATE_PATH", os.path.join(submission_archive.ARCHIVE_DIR, "dedup.bin"))
+RECENT_WINDOW_SECONDS = 24 * 3600
+RECENT_MAX_KEYS = 200000
+TABLE_SLOTS = 1 << 19              # power of two, over twice RECENT_MAX_KEYS
+BLOOM_BITS = 1 << 24               # per generation (2 MiB)
+BLOOM_HASHES = 7
+BLOOM_CAPACITY = 1000000           # keys per generation before it rotates early
+BLOOM_ROTATE_SECONDS = 7 * 24 * 3600
+SEED_BATCH = 1000                  # archived keys added per lock hold
+
+COUNTERS = ["checked", "duplicates", "recent_hits", "bloom_hits"]
+HEADER_DTYPE = np.dtype([('head', '<i8'), ('tail', '<i8'), ('bloom_current', '<i8'),
+                         ('bloom_count', '<i8'), ('bloom_previous_count', '<i8'),
+                         ('bloom_started', '<f8'), ('seeded', '<i8'), ('seeding_pid', '<i8')] +
+                        [(name, '<i8') for name in COUNTERS])
+ENTRY_DTYPE = np.dtype([('k1', '<u8'), ('k2', '<u8'), ('seen', '<f8')])
+STATE_SIZE = HEADER_DTYPE.itemsize + RECENT_MAX_KEYS * ENTRY_DTYPE.itemsize + \
+    TABLE_SLOTS * 8 + 2 * (BLOOM_BITS // 8)
+
+_state = {"pid": None, "fd": None, "header": None, "ring": None, "table": None, "bloom": None}
+_thread_lock = threading.Lock()
+
+class _Locked:
+    """Exclusive access to the shared state from this thread and process"""
+    def __enter__(self):
+        _thread_lock.acquire()
+        try:
+            _open_state()
+            fcntl.flock(_state["fd"], fcntl.LOCK_EX)
+        except Exception:
+            _thread_lock.release()
+            raise
+        return _state
+
+    def __exit__(self, *exc):
+        fcntl.flock(_state["fd"], fcntl.LOCK_UN)
+        _thread_lock.release()
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _open_state():
+    """Map the state file once per process (again after a fork); seed it if it is new"""
+    pid = os.getpid()
+    if _state["pid"] == pid:
+        return
+    os.makedirs(os.path.dirname(STATE_PATH) or ".", exist_ok=True)
+    fd = os.open(STATE_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        if os.fstat(fd).st_size != STATE_SIZE:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, STATE_SIZE)
+        offset = 0
+        header = np.memmap(STATE_PATH, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+        offset += HEADER_DTYPE.itemsize
+        ring = np.memmap(STATE_PATH, dtype=ENTRY_DTYPE, mode='r+', offset=offset, shape=(RECENT_MAX_KEYS,))
+        offset += RECENT_MAX_KEYS * ENTRY_DTYPE.itemsize
+        table = np.memmap(STATE_PATH, dtype='<i8', mode='r+', offset=offset, shape=(TABLE_SLOTS,))
+        offset += TABLE_SLOTS * 8
+        bloom = np.memmap(STATE_PATH, dtype=np.uint8, mode='r+', offset=offset, shape=(2, BLOOM_BITS // 8))
+        # One process rebuilds the recent window of a new file from the archive
+        owner = int(header['seeding_pid'][0])
+        seed = not header['seeded'][0] and (owner == 0 or not _pid_alive(owner))
+        if seed:
+            header['seeding_pid'][0] = pid
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+    if _state["fd"] is not None:
+        os.close(_state["fd"])
+    _state.update(pid=pid, fd=fd, header=header, ring=ring, table=table, bloom=bloom)
+    if seed:
+        threading.Thread(target=_seed, name="dedup-seed", daemon=True).start()
+
+def submission_key(data, device_id, idempotency_key=None):
+    """16-byte key identifying a submission"""
+    if idempotency_key:
+        material = f"key\0{device_id}\0{idempotency_key}".encode('utf-8')
+    else:
+        payload = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        material = f"body\0{device_id}\0{payload}".encode('utf-8')
+    return hashlib.sha256(material).digest()[:16]
+
+def _split(key):
+    return int.from_bytes(key[:8], 'little'), int.from_bytes(key[8:16], 'little')
+
+def _bloom_positions(key):
+    h1, h2 = _split(key)
+    with np.errstate(over='ignore'):
+        positions = np.uint64(h1) + np.arange(BLOOM_HASHES, dtype=np.uint64) * np.uint64(h2 | 1)
+    return positions & np.uint64(BLOOM_BITS - 1)
+
+def _bloom_contains(bits, positions):
+    return bool(np.all(bits[positions >> np.uint64(3)] & (1 << (positions & np.uint64(7))).astype(np.uint8)))
+
+def _bloom_add(key, now):
+    header, bloom = _state["header"], _state["bloom"]
+    if header['bloom_started'][0] == 0:
+        header['bloom_started'][0] = now
+    elif header['bloom_count'][0] >= BLOOM_CAPACITY or now - header['bloom_started'][0] >= BLOOM_ROTATE_SECONDS:
+        # The previous generation is cleared and becomes the current one
+        current = 1 - int(header['bloom_current'][0])
+        bloom[current] = 0
+        header['bloom_current'][0] = current
+        header['bloom_previous_count'][0] = header['bloom_count'][0]
+        header['bloom_count'][0] = 0
+        header['bloom_started'][0] = now
+    positions = _bloom_positions(key)
+    np.bitwise_or.at(bloom[int(header['bloom_current'][0])], positions >> np.uint64(3),
+                     (1 << (positions & np.uint64(7))).astype(np.uint8))
+    header['bloom_count'][0] += 1
+
+def _find(k1, k2):
+    """``(table slot, ring position)`` of a key in the recent window, or ``(free slot, None)``"""
+    table, ring = _state["table"], _state["ring"]
+    i = k1 & (TABLE_SLOTS - 1)
+    while True:
+        entry = int(table[i])
+        if entry == 0:
+            return i, None
+        position = entry - 1
+        if int(ring['k1'][position]) == k1 and int(ring['k2'][position]) == k2:
+            return i, position
+        i = (i + 1) & (TABLE_SLOTS - 1)
+
+def _unlink(i):
+    """Empty table slot ``i``, moving later entries of its probe run back into the gap"""
+    table, ring = _state["table"], _state["ring"]
+    table[i] = 0
+    j = i
+    while True:
+        j = (j + 1) & (TABLE_SLOTS - 1)
+        entry = int(table[j])
+        if entry == 0:
+            return
+        home = int(ring['k1'][entry - 1]) & (TABLE_SLOTS - 1)
+        # The entry may fill the gap unless its home lies cyclically in (i, j]
+        if (i < j and (home <= i or home > j)) or (i > j and home <= i and home > j):
+            table[i], table[j] = entry, 0
+            i = j
+
+def _expire(now, room=0):
+    """Move keys that left the recent window (or need to make room) into the Bloom filter"""
+    header, ring = _state["header"], _state["ring"]
+    while header['head'][0] < header['tail'][0]:
+        position = int(header['head'][0] % RECENT_MAX_KEYS)
+        seen = float(ring['seen'][position])
+        full = header['tail'][0] - header['head'][0] + room > RECENT_MAX_KEYS
+        k1, k2 = int(ring['k1'][position]), int(ring['k2'][position])
+        if k1 or k2:
+            if now - seen < RECENT_WINDOW_SECONDS and not full:
+                break
+            slot, found = _find(k1, k2)
+            if found == position:
+                _unlink(slot)
+            _bloom_add(k1.to_bytes(8, 'little') + k2.to_bytes(8, 'little'), now)
+        header['head'][0] += 1
+
+def _remember(key, seen, now):
+    """Add a key that is not in the recent window; caller holds _Locked"""
+    _expire(now, room=1)
+    header, ring, table = _state["header"], _state["ring"], _state["table"]
+    k1, k2 = _split(key)
+    slot, _ = _find(k1, k2)
+    position = int(header['tail'][0] % RECENT_MAX_KEYS)
+    ring[position] = (k1, k2, seen)
+    table[slot] = position + 1
+    header['tail'][0] += 1
+
+def _seed():
+    """Add keys archived in the recent window to a new state file, a batch per lock hold"""
+    start = time.time() - RECENT_WINDOW_SECONDS
+    try:
+        records = sorted(submission_archive.iter_submissions(start=start),
+                         key=lambda r: r["received_at"])
+        keys = []
+        for record in records:
+            key = record.get("key")
+            keys.append((bytes.fromhex(key) if key else submission_key(record["data"], record["device_id"]),
+                         record["received_at"]))
+        for batch in range(0, len(keys), SEED_BATCH):
+            now = time.time()
+            with _Locked():
+                for key, seen in keys[batch:batch + SEED_BATCH]:
+                    if _find(*_split(key))[1] is None:
+                        _remember(key, seen, now)
+    except Exception as e:
+        print(f"Error seeding duplicate detection from the archive: {str(e)}")
+        with _Locked() as state:
+            state["header"]['seeding_pid'][0] = 0
+        return
+    with _Locked() as state:
+        state["header"]['seeded'][0] = 1
+    print(f"Duplicate detection seeded with {len(keys)} archived keys")
+
+def check_and_remember(key):
+    """
+    Return True if ``key`` was already seen; otherwise remember it.
+
+    Callers that fail to store a new submission must ``forget`` its key so
+    the client's retry is accepted.
+    """
+    now = time.time()
+    with _Locked() as state:
+        header = state["header"]
+        _expire(now)
+        header['checked'][0] += 1
+        if _find(*_split(key))[1] is not None:
+            header['duplicates'][0] += 1
+            header['recent_hits'][0] += 1
+            return True
+        positions = _bloom_positions(key)
+        if _bloom_contains(state["bloom"][0], positions) or _bloom_contains(state["bloom"][1], positions):
+            header['duplicates'][0] += 1
+            header['bloom_hits'][0] += 1
+            return True
+        _remember(key, now, now)
+        return False
+
+def forget(key):
+    """Drop a key remembered by ``check_and_remember`` (it is still in the recent window)"""
+    with _Locked() as state:
+        slot, position = _find(*_split(key))
+        if position is not None:
+            _unlink(slot)
+            # The ring entry is skipped when it expires
+            state["ring"][position] = (0, 0, 0.0)
+
+def stats():
+    """Duplicate counts since the state file was created, plus seen-set sizes"""
+    with _Locked() as state:
+        header = state["header"][0]
+        return {
+            **{name: int(header[name]) for name in COUNTERS},
+            "recent_keys": int(header['tail'] - header['head']),
+            "bloom_keys": int(header['bloom_count'] + header['bloom_previous_count']),
+            "seeded": bool(header['seeded']),
+        }
@@ -1,20 +1,18 @@
 #!/usr/bin/env python
 import os
-import shutil
 import subprocess
 import argparse
 import time
 from datetime import datetime
+import model_registry
 
 # Constants
 SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_DIR = os.path.join(SERVER_DIR, "output_models")
-BACKUP_DIR = os.path.join(SERVER_DIR, "model_backups")
 LOG_FILE = os.path.join(SERVER_DIR, "deployment.log")
 
 # Ensure directories exist
 os.makedirs(MODEL_DIR, exist_ok=True)
-os.makedirs(BACKUP_DIR, exist_ok=True)
 
 def log_message(message):
     """Log a message to file and console"""
@@ -26,22 +24,18 @@ def log_message(message):
         f.write(log_line + "\n")
 
 def backup_current_model():
-    """Backup the current model before deploying a new one"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # Check if models exist before backing up
+    """Register the current model before deploying a new one"""
+    # Registry versions are content-hashed, so backing up an unchanged
+    # model again does not store another copy
     sklearn_model = os.path.join(MODEL_DIR, "NotificationTimePredictor.pkl")
     coreml_model = os.path.join(MODEL_DIR, "NotificationTimePredictor.mlmodel")
     
     if os.path.exists(sklearn_model):
-        backup_path = os.path.join(BACKUP_DIR, f"NotificationTimePredictor_{timestamp}.pkl")
-        shutil.copy2(sklearn_model, backup_path)
-        log_message(f"Backed up sklearn model to {backup_path}")
-    
-    if os.path.exists(coreml_model):
-        backup_path = os.path.join(BACKUP_DIR, f"NotificationTimePredictor_{timestamp}.mlmodel")
-        shutil.copy2(coreml_model, backup_path)
-        log_message(f"Backed up CoreML model to {backup_path}")
+        version = model_registry.register_model(sklearn_model, coreml_model)
+        log_message(f"Current model registered as version {version}")
+        log_message(f"Roll back with: python model_registry.py promote {version}")
+        return version
+    return None
 
 def generate_data():
     """Generate synthetic data for training"""
@@ -56,11 +50,11 @@ def generate_data():
         log_message(f"ERROR: {result.stderr}")
     return result.returncode == 0
 
-def train_model():
-    """Run the model training script"""
+def train_model(candidate=False):
+    """Run the model training script (``candidate``: register it for shadowing only)"""
     log_message("Training model...")
     result = subprocess.run(
-        ["python", os.path.join(SERVER_DIR, "train_model.py")],
+        ["python", os.path.join(SERVER_DIR, "train_model.py")] + (["--candidate"] if candidate else []),
         capture_output=True,
         text=True
     )
@@ -110,14 +104,32 @@ def restart_server():
         log_message(f"Error starting server: {str(e)}")
         return False
 
-def deploy():
+def train_shadowed_model(previous_version):
+    """
+    Train a new model as the shadow candidate while the previous one stays served.
+
+    The new version never becomes current (or published) here; it is
+    promoted by hand once /shadow/summary shows it is better.
+    """
+    if not previous_version:
+        log_message("No previous model to compare against, serving the new model directly")
+        return train_model()
+    if not train_model(candidate=True):
+        return False
+    new_version = model_registry.candidate_version()
+    log_message(f"Serving {previous_version}, shadow-evaluating {new_version}")
+    log_message(f"Compare at /shadow/summary, then: python model_registry.py promote {new_version}")
+    return True
+
+def deploy(shadow=False):
     """Run the full deployment process"""
     log_message("Starting deployment process...")
     
-    backup_current_model()
+    backed_up_version = backup_current_model()
+    previous_version = model_registry.current_version() or backed_up_version
     
     if generate_data():
-        if train_model():
+        if train_shadowed_model(previous_version) if shadow else train_model():
             if restart_server():
                 log_message("Deployment completed successfully!")
                 return True
@@ -136,13 +148,16 @@ if __name__ == "__main__":
     parser.add_argument("--skip-data", action="store_true", help="Skip data generation step")
     parser.add_argument("--skip-training", action="store_true", help="Skip model training step")
     parser.add_argument("--restart-only", action="store_true", help="Only restart the server")
+    parser.add_argument("--shadow", action="store_true",
+                        help="Keep serving the current model and shadow-evaluate the new one")
     
     args = parser.parse_args()
     
     if args.restart_only:
         restart_server()
     else:
-        backup_current_model()
+        backed_up_version = backup_current_model()
+        previous_version = model_registry.current_version() or backed_up_version
         
         if not args.skip_data:
             generate_data()
@@ -150,7 +165,10 @@ if __name__ == "__main__":
             log_message("Skipping data generation")
             
         if not args.skip_training:
-            train_model()
+            if args.shadow:
+                train_shadowed_model(previous_version)
+            else:
+                train_model()
         else:
             log_message("Skipping model training")
             
@@ -63,7 +63,7 @@ After=network.target
 [Service]
 User=$EC2_USER
 WorkingDirectory=$REMOTE_DIR
-ExecStart=$REMOTE_DIR/venv/bin/gunicorn --workers=2 --bind=0.0.0.0:5001 wsgi:app
+ExecStart=$REMOTE_DIR/venv/bin/gunicorn --workers=2 --threads=8 --bind=0.0.0.0:5001 wsgi:app
 Restart=always
 Environment=\"PATH=$REMOTE_DIR/venv/bin\"
 
@@ -35,7 +35,7 @@ echo "Setting up Supervisor configuration..."
 ssh ${SERVER_USER}@${SERVER_HOST} "sudo tee /etc/supervisor/conf.d/ml_prediction.conf > /dev/null << EOF
 [program:ml_prediction]
 directory=${REMOTE_DIR}
-command=${REMOTE_DIR}/venv/bin/gunicorn --workers=2 --bind=127.0.0.1:5001 wsgi:app
+command=${REMOTE_DIR}/venv/bin/gunicorn --workers=2 --threads=8 --bind=127.0.0.1:5001 wsgi:app
 autostart=true
 autorestart=true
 stderr_logfile=/var/log/ml_prediction.err.log
@@ -72,5 +72,11 @@ ssh ${SERVER_USER}@${SERVER_HOST} "sudo supervisorctl reread && \
     sudo supervisorctl update && \
     sudo supervisorctl restart ml_prediction"
 
+# Wait until the workers have warmed up before calling the deployment done
+echo "Waiting for the server to become ready..."
+ssh ${SERVER_USER}@${SERVER_HOST} "for i in \$(seq 1 60); do \
+    curl -sf http://127.0.0.1:5001/ready && exit 0; sleep 1; done; \
+    echo 'Server did not report ready within 60s'; exit 1"
+
 echo "Deployment complete! Your ML prediction server should now be available at https://ml.bitbyte.lol"
 echo "To test: curl -X POST https://ml.bitbyte.lol/predict -H 'Content-Type: application/json' -d '{\"dayOfWeek\": 2, \"hourOfDay\": 14, \"minuteOfHour\": 30, \"device_activity\": 0.7, \"device_batteryLevel\": 0.8}'"
@@ -0,0 +1,230 @@
+"""
+Streaming drift monitor for /predict inputs.
+
+A sketch is a fixed-size histogram per feature. ``build_sketch`` derives
+up to BINS bins from quantiles of the training set and stores their edges
+and counts, and ``train_model`` saves the result with the model in the
+registry metadata (``drift_sketch``). Missing values get a bin of their own.
+
+Live traffic is counted in the same bins. ``observe`` costs one bisect
+per feature and increments a per-process buffer. Every FLUSH_SECONDS the
+buffer is added to a memory-mapped file shared by all gunicorn workers
+(under ``flock``, as in admission control). The shared counts decay with
+a half-life of HALF_LIFE_HOURS, so they describe recent traffic. Memory
+is bounded by MAX_FEATURES x (BINS + 1) counters however much traffic
+arrives, and no request is stored.
+
+``scores`` compares the two histograms with the population stability
+index (PSI): below 0.1 is stable, 0.1-0.25 a moderate shift and above
+0.25 a significant one. The live counts belong to one training sketch. A
+new default model resets them.
+"""
+import os
+import json
+import time
+import fcntl
+import bisect
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+STATE_PATH = os.environ.get("DRIFT_STATE_PATH",
+                            os.path.join(tempfile.gettempdir(), "bitbyte_drift.bin"))
+HALF_LIFE_HOURS = float(os.environ.get("DRIFT_HALF_LIFE_HOURS", 6))
+FLUSH_SECONDS = 2.0
+BINS = 16                    # value bins per feature; one more counts missing values
+MAX_FEATURES = 32
+MIN_LIVE_COUNT = 100         # live observations before a feature gets a status
+PSI_MODERATE = 0.1
+PSI_SIGNIFICANT = 0.25
+SMOOTHING = 1e-4             # added to bin shares so empty bins do not divide by zero
+
+HEADER_DTYPE = np.dtype([('sketch_id', '<u8'), ('decayed_at', '<f8')])
+STATE_SIZE = HEADER_DTYPE.itemsize + MAX_FEATURES * (BINS + 1) * 8
+
+_state = {"pid": None, "fd": None, "header": None, "counts": None}
+_pending = {"sketch_id": None, "counts": np.zeros((MAX_FEATURES, BINS + 1)), "flushed_at": 0.0}
+_lock = threading.Lock()        # the pending buffer
+_state_lock = threading.Lock()  # the shared mapping
+
+def build_sketch(X, columns=None):
+    """Training histogram of every column of ``X`` (DataFrame, or array plus ``columns``)"""
+    columns = list(X.columns) if columns is None else list(columns)
+    matrix = np.asarray(X, dtype=np.float64)
+    features = {}
+    for i, name in enumerate(columns[:MAX_FEATURES]):
+        values = matrix[:, i]
+        present = values[~np.isnan(values)]
+        if len(present):
+            cuts = np.quantile(present, np.linspace(0, 1, BINS + 1)[1:-1])
+            edges = np.unique(cuts)
+        else:
+            edges = np.array([])
+        counts = np.zeros(BINS + 1)
+        counts[:len(edges) + 1] = np.bincount(np.searchsorted(edges, present, side='right'),
+                                              minlength=len(edges) + 1)
+        counts[BINS] = len(values) - len(present)
+        features[name] = {"edges": edges.tolist(), "counts": counts.tolist()}
+    return {"rows": int(len(matrix)), "bins": BINS, "features": features}
+
+def prepare(sketch):
+    """Lookup structures for a stored sketch; build once per model, not per request"""
+    names = list(sketch["features"])
+    digest = hashlib.blake2b(json.dumps(sketch, sort_keys=True).encode('utf-8'), digest_size=8).digest()
+    return {
+        "id": int.from_bytes(digest, 'little') or 1,
+        "names": names,
+        "index": {name: i for i, name in enumerate(names)},
+        "edges": [sketch["features"][n]["edges"] for n in names],
+        "edge_arrays": [np.array(sketch["features"][n]["edges"]) for n in names],
+        "reference": np.array([sketch["features"][n]["counts"] for n in names]),
+    }
+
+class _Locked:
+    """Exclusive access to the shared live counts from this thread and process"""
+    def __enter__(self):
+        _state_lock.acquire()
+        try:
+            _open_state()
+            fcntl.flock(_state["fd"], fcntl.LOCK_EX)
+        except Exception:
+            _state_lock.release()
+            raise
+        return _state
+
+    def __exit__(self, *exc):
+        fcntl.flock(_state["fd"], fcntl.LOCK_UN)
+        _state_lock.release()
+
+def _open_state():
+    """Map the shared counts once per process (again after a fork)"""
+    pid = os.getpid()
+    if _state["pid"] == pid:
+        return
+    fd = os.open(STATE_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        if os.fstat(fd).st_size != STATE_SIZE:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, STATE_SIZE)
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    header = np.memmap(STATE_PATH, dtype=HEADER_DTYPE, mode='r+', shape=(1,))
+    counts = np.memmap(STATE_PATH, dtype='<f8', mode='r+', offset=HEADER_DTYPE.itemsize,
+                       shape=(MAX_FEATURES, BINS + 1))
+    if _state["fd"] is not None:
+        os.close(_state["fd"])
+    _state.update(pid=pid, fd=fd, header=header, counts=counts)
+
+def _merge(sketch_id, pending, now):
+    """Decay the shared counts and add ``pending``; caller holds _Locked"""
+    header, counts = _state["header"], _state["counts"]
+    if int(header['sketch_id'][0]) != sketch_id:
+        counts[:] = 0
+        header[0] = (sketch_id, now)
+    elapsed = now - float(header['decayed_at'][0])
+    if elapsed > 0:
+        counts *= 0.5 ** (elapsed / (HALF_LIFE_HOURS * 3600))
+        header['decayed_at'][0] = now
+    if pending is not None:
+        counts += pending
+
+def flush(now=None):
+    """Add this process's buffered counts to the shared state"""
+    now = time.time() if now is None else now
+    with _lock:
+        sketch_id = _pending["sketch_id"]
+        pending = _pending["counts"].copy()
+        _pending["counts"][:] = 0
+        _pending["flushed_at"] = now
+    if sketch_id is None:
+        return
+    with _Locked():
+        _merge(sketch_id, pending, now)
+
+def _count(prepared, bins_by_feature):
+    """Buffer bin hits, flushing when the buffer is old enough"""
+    now = time.time()
+    with _lock:
+        if _pending["sketch_id"] != prepared["id"]:
+            _pending["counts"][:] = 0
+            _pending["sketch_id"] = prepared["id"]
+        for i, hits in bins_by_feature:
+            if np.isscalar(hits):
+                _pending["counts"][i, hits] += 1
+            else:
+                np.add.at(_pending["counts"][i], hits, 1)
+        due = now - _pending["flushed_at"] >= FLUSH_SECONDS
+    if due:
+        try:
+            flush(now)
+        except OSError as e:
+            # Monitoring must never fail a prediction
+            print(f"Drift monitor unavailable: {str(e)}")
+
+def observe(prepared, data):
+    """Count one request's feature values (a dict of name -> value; absent counts as missing)"""
+    hits = []
+    for i, name in enumerate(prepared["names"]):
+        try:
+            value = float(data.get(name))
+        except (TypeError, ValueError):
+            value = float('nan')
+        hits.append((i, BINS if value != value else bisect.bisect_right(prepared["edges"][i], value)))
+    _count(prepared, hits)
+
+def observe_matrix(prepared, columns, matrix):
+    """Count every row of a batch (columns name the matrix columns)"""
+    hits = []
+    for j, name in enumerate(columns):
+        i = prepared["index"].get(name)
+        if i is None:
+            continue
+        values = matrix[:, j]
+        bins = np.searchsorted(prepared["edge_arrays"][i], values, side='right')
+        bins[np.isnan(values)] = BINS
+        hits.append((i, bins))
+    _count(prepared, hits)
+
+def _psi(reference, live):
+    expected = reference / max(reference.sum(), 1.0) + SMOOTHING
+    actual = live / max(live.sum(), 1.0) + SMOOTHING
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+def _status(psi, live_count):
+    if live_count < MIN_LIVE_COUNT:
+        return "insufficient_data"
+    if psi < PSI_MODERATE:
+        return "stable"
+    return "moderate" if psi < PSI_SIGNIFICANT else "significant"
+
+def scores(prepared, detail=False):
+    """PSI per feature between the training sketch and recent live traffic"""
+    flush()
+    with _Locked() as state:
+        if int(state["header"]['sketch_id'][0]) == prepared["id"]:
+            _merge(prepared["id"], None, time.time())
+            live = np.array(state["counts"][:len(prepared["names"])])
+        else:
+            live = np.zeros((len(prepared["names"]), BINS + 1))
+
+    features = {}
+    for i, name in enumerate(prepared["names"]):
+        live_count = float(live[i].sum())
+        psi = _psi(prepared["reference"][i], live[i])
+        entry = {"psi": round(psi, 4), "live_count": round(live_count, 1),
+                 "status": _status(psi, live_count)}
+        if detail:
+            entry["edges"] = prepared["edges"][i]
+            entry["training"] = prepared["reference"][i].tolist()
+            entry["live"] = np.round(live[i], 2).tolist()
+        features[name] = entry
+    ranked = [f for f in features.values() if f["status"] != "insufficient_data"]
+    return {
+        "features": features,
+        "max_psi": max((f["psi"] for f in ranked), default=None),
+        "drifting": sorted(n for n, f in features.items() if f["status"] == "significant"),
+        "half_life_hours": HALF_LIFE_HOURS,
+    }
@@ -0,0 +1,196 @@
+"""
+Materialized float32 feature matrices for training.
+
+A cache entry is a raw little-endian float32 file (``<name>.f32``) holding
+one row per sample, with the target as the last column, and a manifest
+(``<name>.json``) recording the column layout and, for every source file,
+its size, mtime, SHA-1 and the number of rows it contributed. Entries that
+need more precision (epoch seconds) are stored as float64 (``<name>.f64``).
+
+On each load only sources that are new, or that grew by appending (archive
+segments), are parsed; their rows are appended to the matrix in fixed-size
+chunks. If a source was modified in place or removed, or the column layout
+changed, the entry is rebuilt from scratch. Re-training on an unchanged
+dataset therefore memory-maps the matrix without parsing anything.
+"""
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+
+CACHE_DIR = os.path.join("collected_data", "feature_cache")
+CHUNK_ROWS = 8192  # rows buffered before each write to the matrix file
+
+def _paths(name, cache_dir, dtype='<f4'):
+    base = os.path.join(cache_dir, name)
+    return base + (".f64" if dtype == '<f8' else ".f32"), base + ".json", base + ".lock"
+
+def file_sha1(path, length=None):
+    """SHA-1 of a file, or of its first ``length`` bytes"""
+    digest = hashlib.sha1()
+    remaining = length
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            block = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+def _load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading feature cache manifest: {str(e)}")
+        return None
+
+def _save_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+def _plan(manifest, sources, columns, appendable, dtype):
+    """
+    Compare sources against the manifest.
+
+    Returns ``(rebuild, pending)`` where ``pending`` lists
+    ``(path, offset, size)`` jobs that still need extracting. ``size`` is
+    the file size observed now; bytes written after it are left for the
+    next load.
+    """
+    def everything():
+        return True, [(path, 0, os.path.getsize(path)) for path in sources]
+
+    if manifest is None or manifest.get("columns") != list(columns) or \
+            manifest.get("dtype", "<f4") != dtype:
+        return everything()
+
+    known = manifest["sources"]
+    if set(known) - set(sources):
+        return everything()
+
+    pending = []
+    for path in sources:
+        entry = known.get(path)
+        st = os.stat(path)
+        if entry is None:
+            pending.append((path, 0, st.st_size))
+            continue
+        if st.st_size == entry["size"] and st.st_mtime == entry["mtime"]:
+            continue
+        if st.st_size == entry["size"] and file_sha1(path) == entry["sha1"]:
+            continue
+        if (appendable is not None and appendable(path) and st.st_size > entry["size"]
+                and file_sha1(path, entry["size"]) == entry["sha1"]):
+            pending.append((path, entry["size"], st.st_size))
+            continue
+        return everything()
+    return False, pending
+
+class _ChunkWriter:
+    """Copy row blocks into a fixed-size buffer and append it to a file when full"""
+    def __init__(self, f, width, dtype):
+        self.f = f
+        self.dtype = dtype
+        self.chunk = np.empty((CHUNK_ROWS, width), dtype=dtype)
+        self.filled = 0
+        self.written = 0
+
+    def append(self, rows):
+        start = 0
+        while start < len(rows):
+            take = min(CHUNK_ROWS - self.filled, len(rows) - start)
+            self.chunk[self.filled:self.filled + take] = rows[start:start + take]
+            self.filled += take
+            start += take
+            if self.filled == CHUNK_ROWS:
+                self.flush()
+
+    def flush(self):
+        if self.filled:
+            self.f.write(self.chunk[:self.filled].astype(self.dtype, copy=False).tobytes())
+            self.written += self.filled
+            self.filled = 0
+
+def load(name, sources, columns, extract, appendable=None, cache_dir=CACHE_DIR, dtype='<f4'):
+    """
+    Return a read-only memmap of shape ``(rows, len(columns))`` for ``sources``.
+
+    ``extract`` receives a list of ``(path, offset, size)`` jobs and must
+    yield ``(path, rows)`` pairs, where ``rows`` is a float array laid out
+    as ``columns`` built from bytes ``offset:size`` of the file, or None
+    if the file could not be read; such a file is not recorded, so the
+    next load tries it again.
+    ``appendable(path)`` says whether a grown file may be read from its
+    previous size onwards instead of being re-parsed. ``dtype`` is
+    ``'<f4'`` or ``'<f8'``. Returns ``None`` when no rows are available.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path, manifest_path, lock_path = _paths(name, cache_dir, dtype)
+    width = len(columns)
+    row_bytes = width * np.dtype(dtype).itemsize
+
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = _load_manifest(manifest_path)
+        if manifest is not None and not os.path.exists(data_path):
+            manifest = None
+        rebuild, pending = _plan(manifest, sources, columns, appendable, dtype)
+
+        if rebuild:
+            manifest = {"columns": list(columns), "dtype": dtype, "rows": 0, "sources": {}}
+            open(data_path, 'wb').close()
+        elif manifest is not None and manifest["rows"] * row_bytes != os.path.getsize(data_path):
+            # Interrupted append: drop the partial tail
+            with open(data_path, 'r+b') as f:
+                f.truncate(manifest["rows"] * row_bytes)
+
+        if pending:
+            print(f"Feature cache '{name}': extracting {len(pending)} of {len(sources)} sources")
+            with open(data_path, 'ab') as f:
+                writer = _ChunkWriter(f, width, dtype)
+                counts, failed = {}, set()
+                for path, rows in extract(pending):
+                    if rows is None:
+                        failed.add(path)
+                        continue
+                    writer.append(rows)
+                    counts[path] = counts.get(path, 0) + len(rows)
+                writer.flush()
+                f.flush()
+                os.fsync(f.fileno())
+
+            if failed:
+                print(f"Feature cache '{name}': {len(failed)} sources failed, retried on the next load")
+            for path, offset, size in pending:
+                if path in failed:
+                    continue
+                previous = manifest["sources"].get(path, {}).get("rows", 0) if offset else 0
+                manifest["sources"][path] = {
+                    "size": size,
+                    "mtime": os.path.getmtime(path) if os.path.getsize(path) == size else None,
+                    "sha1": file_sha1(path, size),
+                    "rows": previous + counts.get(path, 0),
+                }
+            manifest["rows"] += writer.written
+            _save_manifest(manifest_path, manifest)
+        elif not rebuild:
+            print(f"Feature cache '{name}': {manifest['rows']} rows up to date")
+        else:
+            _save_manifest(manifest_path, manifest)
+
+    if manifest["rows"] == 0:
+        return None
+    return np.memmap(data_path, dtype=dtype, mode='r', shape=(manifest["rows"], width))
+
+def cached_columns(name, cache_dir=CACHE_DIR):
+    """Return the column layout of a cache entry, or None if it does not exist"""
+    manifest = _load_manifest(_paths(name, cache_dir)[1])
+    return manifest["columns"] if manifest else None
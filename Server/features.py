@@ -0,0 +1,23 @@
+"""
+Shared feature layout for training and serving.
+
+``submission_rows`` flattens a study-data submission the way ingestion
+lays it out before ``ingest_schema.normalize``: one row per session, with
+every ``deviceContext`` key broadcast as a ``device_<key>`` column.
+"""
+
+# Feature order of the seed model (matches simple_prediction_api.py)
+SEED_FEATURES = ['dayOfWeek', 'hourOfDay', 'minuteOfHour',
+                 'device_activity', 'device_batteryLevel']
+TARGET = 'responseTime'
+
+def submission_rows(data):
+    """Flatten ``sessions`` plus ``deviceContext`` into a list of row dicts"""
+    device_columns = {f"device_{key}": value
+                      for key, value in (data.get('deviceContext') or {}).items()}
+    rows = []
+    for session in data.get('sessions') or []:
+        row = dict(session)
+        row.update(device_columns)
+        rows.append(row)
+    return rows
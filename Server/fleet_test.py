@@ -0,0 +1,184 @@
+"""
+End-to-end test of pull-based model distribution on one machine.
+
+Starts several serving nodes (each a prediction API process in its own
+directory, with a ``model_sync.py agent`` next to it) and a model source,
+either a plain directory or the local object store stand-in. It then:
+
+1. releases version A and waits until every node serves it
+2. releases version B (hot swap, no restart)
+3. releases a version whose blob is corrupted, and checks that every node
+   reports ``failed`` and keeps serving B
+4. rolls back to A, which nodes still have locally
+
+    python fleet_test.py --nodes 3 --store http
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(check, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.25)
+    raise TimeoutError(f"Timed out waiting for {what}")
+
+def make_model(seed):
+    from features import SEED_FEATURES
+    rng = np.random.default_rng(seed)
+    X = rng.random((500, len(SEED_FEATURES)))
+    y = X @ rng.random(len(SEED_FEATURES)) * 100
+    return RandomForestRegressor(n_estimators=10, random_state=seed).fit(X, y)
+
+def register(publisher_dir, seed):
+    """Register a fresh model in the publisher's registry and return its version"""
+    import model_registry
+    os.chdir(publisher_dir)
+    os.makedirs("output_models", exist_ok=True)
+    path = os.path.join("output_models", f"candidate_{seed}.pkl")
+    with open(path, 'wb') as f:
+        pickle.dump(make_model(seed), f)
+    from features import SEED_FEATURES
+    return model_registry.register_model(path, features=SEED_FEATURES, extra={"seed": seed})
+
+def predict_version(port):
+    body = json.dumps({"dayOfWeek": 2, "hourOfDay": 14, "minuteOfHour": 30,
+                       "device_activity": 0.7, "device_batteryLevel": 0.8}).encode('utf-8')
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/predict", data=body,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.load(response).get("version")
+    except OSError:
+        return None
+
+def start_node(root, index, source, env):
+    node_dir = os.path.join(root, f"node{index}")
+    os.makedirs(node_dir)
+    port = free_port()
+    node_env = dict(env, ADMISSION_STATE_PATH=os.path.join(node_dir, "admission.bin"),
+                    DRIFT_STATE_PATH=os.path.join(node_dir, "drift.bin"))
+    log = open(os.path.join(node_dir, "node.log"), 'w')
+    api = subprocess.Popen(
+        [sys.executable, "-c",
+         f"import sys; sys.path.insert(0, {SERVER_DIR!r}); from prediction_api import app; "
+         f"app.run(host='127.0.0.1', port={port}, threaded=True)"],
+        cwd=node_dir, env=node_env, stdout=log, stderr=subprocess.STDOUT)
+    agent = subprocess.Popen(
+        [sys.executable, os.path.join(SERVER_DIR, "model_sync.py"), "agent", "--source", source,
+         "--node", f"node{index}", "--node-url", f"http://127.0.0.1:{port}", "--interval", "0.5"],
+        cwd=node_dir, env=node_env, stdout=log, stderr=subprocess.STDOUT)
+    return {"name": f"node{index}", "port": port, "procs": [api, agent]}
+
+def _reachable(url):
+    try:
+        urllib.request.urlopen(url + "/status/", timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+def rollout(source, version, nodes, timeout=60):
+    """Wait until every node reports ``version`` active and serves it"""
+    import model_sync
+    started = time.time()
+    wait_for(lambda: (lambda s: s["target"] == version and s["active"] == len(nodes))(
+        model_sync.rollout_status(source)), timeout, f"rollout of {version}")
+    served = {n["name"]: predict_version(n["port"]) for n in nodes}
+    print(f"  {version} active on {len(nodes)} nodes in {time.time() - started:.1f}s, serving: {served}")
+    return all(v == version for v in served.values())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test model rollout across local serving nodes")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--store", choices=["dir", "http"], default="dir")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="fleet_test_")
+    publisher_dir = os.path.join(root, "publisher")
+    os.makedirs(publisher_dir)
+    print(f"Working directory: {root}")
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    procs = []
+    ok = True
+    try:
+        store_dir = os.path.join(root, "store")
+        if args.store == "http":
+            port = free_port()
+            procs.append(subprocess.Popen(
+                [sys.executable, os.path.join(SERVER_DIR, "model_sync.py"), "store",
+                 "--dir", store_dir, "--port", str(port)], env=env, stdout=subprocess.DEVNULL))
+            source = f"http://127.0.0.1:{port}"
+            wait_for(lambda: _reachable(source), 10, "the object store")
+        else:
+            source = store_dir
+
+        version_a = register(publisher_dir, 1)
+        version_b = register(publisher_dir, 2)
+        version_bad = register(publisher_dir, 3)
+        nodes = [start_node(root, i, source, env) for i in range(args.nodes)]
+        procs += [p for n in nodes for p in n["procs"]]
+
+        import model_sync
+        print(f"1. Releasing {version_a} to {source}")
+        model_sync.publish(version_a, source)
+        ok &= rollout(source, version_a, nodes)
+
+        print(f"2. Releasing {version_b}")
+        model_sync.publish(version_b, source)
+        ok &= rollout(source, version_b, nodes)
+
+        print(f"3. Releasing {version_bad} with a corrupted blob")
+        import model_registry
+        # The blob exists before the release, so publish keeps the corrupted copy
+        entry = model_sync._file_entry(model_registry.model_path(version_bad, "sklearn"))
+        model_sync.put_object(source, entry["blob"], b"corrupted")
+        model_sync.publish(version_bad, source)
+        status = wait_for(lambda: (lambda s: s if sum(n["state"] == "failed" for n in s["nodes"]) == len(nodes)
+                                   else None)(model_sync.rollout_status(source)), 60, "nodes to reject the release")
+        served = {n["name"]: predict_version(n["port"]) for n in nodes}
+        print(f"  rejected by all nodes ({status['nodes'][0].get('error')}), serving: {served}")
+        ok &= all(v == version_b for v in served.values())
+
+        print(f"4. Rolling back to {version_a}")
+        model_sync.publish(version_a, source)
+        ok &= rollout(source, version_a, nodes)
+        # Every node still had A in its registry, so nothing was downloaded
+        logs = [open(os.path.join(root, n["name"], "node.log")).read() for n in nodes]
+        reused = sum(log.count(f"Swapped in version {version_a} (0 bytes") for log in logs)
+        print(f"  swapped back without downloading on {reused} of {len(nodes)} nodes")
+        ok &= reused == len(nodes)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        ok = False
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+        os.chdir(SERVER_DIR)
+        if ok:
+            shutil.rmtree(root, ignore_errors=True)
+    print("PASS" if ok else f"FAIL (logs in {root})")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,117 @@
+"""
+Prediction intervals from the spread of a random forest's trees.
+
+All trees are flattened once per model into shared node arrays (children,
+split feature, threshold, leaf value) with global node ids. A batch is
+then scored by walking every (row, tree) pair down the forest together,
+one NumPy step per tree level, so the per-tree outputs of the whole batch
+come out of a single vectorized traversal instead of ``n_estimators``
+separate ``predict`` calls. Their mean equals ``model.predict``; the
+standard deviation and quantiles describe how much the trees disagree.
+"""
+import threading
+import weakref
+
+import numpy as np
+from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
+
+DEFAULT_QUANTILES = (0.1, 0.5, 0.9)
+CHUNK_ROWS = 2048          # rows traversed at once (memory ~ rows x trees)
+
+_flat = weakref.WeakKeyDictionary()
+_flat_lock = threading.Lock()
+
+def supports(model):
+    return isinstance(model, (RandomForestRegressor, ExtraTreesRegressor)) and model.n_outputs_ == 1
+
+def _flatten(model):
+    """Concatenate the node arrays of every tree, with children as global ids"""
+    lefts, rights, features, thresholds, values, missing_left, roots = [], [], [], [], [], [], []
+    offset = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        n = tree.node_count
+        ids = np.arange(offset, offset + n)
+        leaf = tree.children_left == -1
+        # Leaves point at themselves so finished pairs stay put
+        lefts.append(np.where(leaf, ids, tree.children_left + offset))
+        rights.append(np.where(leaf, ids, tree.children_right + offset))
+        features.append(np.where(leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        values.append(tree.value[:, 0, 0])
+        missing = getattr(tree, 'missing_go_to_left', None)
+        missing_left.append(np.zeros(n, dtype=bool) if missing is None else missing.astype(bool))
+        roots.append(offset)
+        offset += n
+    return {
+        "left": np.concatenate(lefts),
+        "right": np.concatenate(rights),
+        "feature": np.concatenate(features),
+        "threshold": np.concatenate(thresholds),
+        "value": np.concatenate(values),
+        "missing_left": np.concatenate(missing_left),
+        "is_leaf": np.concatenate(lefts) == np.arange(offset),
+        "roots": np.array(roots),
+    }
+
+def _get_flat(model):
+    with _flat_lock:
+        flat = _flat.get(model)
+    if flat is None:
+        flat = _flatten(model)
+        with _flat_lock:
+            _flat[model] = flat
+    return flat
+
+def tree_predictions(model, X):
+    """``(rows, n_estimators)`` matrix of every tree's prediction for every row of ``X``"""
+    if not supports(model):
+        raise ValueError("Prediction intervals need a single-output random forest")
+    flat = _get_flat(model)
+    # Trees compare float32 features against float64 thresholds, as sklearn does
+    X = np.asarray(X, dtype=np.float32)
+    n_trees = len(flat["roots"])
+    out = np.empty((len(X), n_trees), dtype=np.float64)
+
+    for start in range(0, len(X), CHUNK_ROWS):
+        chunk = X[start:start + CHUNK_ROWS]
+        rows = np.repeat(np.arange(len(chunk)), n_trees)
+        nodes = np.tile(flat["roots"], len(chunk))
+        active = np.flatnonzero(~flat["is_leaf"][nodes])
+        while len(active):
+            node = nodes[active]
+            x = chunk[rows[active], flat["feature"][node]].astype(np.float64)
+            go_left = x <= flat["threshold"][node]
+            nan = np.isnan(x)
+            if nan.any():
+                go_left[nan] = flat["missing_left"][node[nan]]
+            node = np.where(go_left, flat["left"][node], flat["right"][node])
+            nodes[active] = node
+            active = active[~flat["is_leaf"][node]]
+        out[start:start + len(chunk)] = flat["value"][nodes].reshape(len(chunk), n_trees)
+    return out
+
+def intervals(model, X, quantiles=DEFAULT_QUANTILES):
+    """Mean, standard deviation and quantiles over the trees, one entry per row"""
+    quantiles = [float(q) for q in quantiles]
+    if any(not 0.0 <= q <= 1.0 for q in quantiles):
+        raise ValueError("quantiles must be between 0 and 1")
+    per_tree = tree_predictions(model, X)
+    values = np.quantile(per_tree, quantiles, axis=1) if quantiles else []
+    return {
+        "mean": per_tree.mean(axis=1),
+        "std": per_tree.std(axis=1),
+        "quantiles": dict(zip(quantiles, values)),
+    }
+
+def parse_quantiles(value):
+    """Parse a ``0.1,0.5,0.9`` query parameter (empty means the defaults)"""
+    if not value:
+        return list(DEFAULT_QUANTILES)
+    try:
+        quantiles = [float(q) for q in value.split(',') if q.strip()]
+    except ValueError:
+        quantiles = [-1.0]
+    if any(not 0.0 <= q <= 1.0 for q in quantiles):
+        raise ValueError("quantiles must be comma-separated numbers between 0 and 1")
+    return quantiles
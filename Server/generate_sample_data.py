@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 import random
 from datetime import datetime, timedelta
+import partitions
 
 DATA_DIR = "collected_data"
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -83,10 +84,10 @@ if __name__ == "__main__":
     synthetic_data = generate_synthetic_data(num_samples=2000)
     
     # Save to CSV
-    output_path = os.path.join(DATA_DIR, f"processed_synthetic_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
-    synthetic_data.to_csv(output_path, index=False)
+    output_paths = partitions.write_rows(
+        synthetic_data, name=f"processed_synthetic_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
     
-    print(f"Generated {len(synthetic_data)} samples and saved to {output_path}")
+    print(f"Generated {len(synthetic_data)} samples and saved them to {len(output_paths)} day partitions")
     print("\nSample data:")
     print(synthetic_data.head())
     
@@ -0,0 +1,194 @@
+"""
+Schema of processed training rows.
+
+Every ingest path (``/api/submit-study-data``, bulk uploads, the seed model
+reading the raw archive) passes its rows through ``normalize`` before
+anything is written. It works on whole columns at once: each COLUMNS
+entry is coerced to its type with ``pd.to_numeric`` and range-checked
+against RANGES with NumPy masks, with no per-row Python code.
+
+Bad values are handled per column:
+
+* REQUIRED columns (time of day and the target) reject the row when they
+  are missing, non-numeric, fractional where an integer is expected, or
+  out of range. Missing time fields are first derived from ``timestamp``.
+* Optional device columns are repaired. Battery levels reported in
+  percent (1-100) are scaled to 0-1, flags accept booleans and
+  ``true``/``false``, and any other invalid value is cleared to empty.
+* ``epochTime`` is the session's instant in epoch seconds: the row's own
+  ``epochTime``, else its ``timestamp`` when that names a zone ("Z",
+  "+02:00"). A local timestamp without one leaves it empty rather than
+  guessing the device's UTC offset.
+
+The result always has exactly COLUMNS, in order. Keys outside the schema
+(``deviceType``, debug fields) are not written, so training sees one
+numeric layout and no garbage.
+"""
+import numpy as np
+import pandas as pd
+
+from features import TARGET
+
+INT, FLOAT, FLAG, TEXT, TIME, EPOCH = "int", "float", "flag", "text", "time", "epoch"
+
+# Fixed layout of processed CSVs
+COLUMNS = {
+    "timestamp": TIME,
+    "epochTime": EPOCH,
+    "userId": TEXT,
+    "dayOfWeek": INT,
+    "hourOfDay": INT,
+    "minuteOfHour": INT,
+    "device_activity": FLOAT,
+    "device_batteryLevel": FLOAT,
+    "device_screenActive": FLAG,
+    "device_appInForeground": FLAG,
+    "device_audioPlaying": FLAG,
+    TARGET: FLOAT,
+}
+RANGES = {
+    "epochTime": (0.0, np.inf),
+    "dayOfWeek": (0, 6),
+    "hourOfDay": (0, 23),
+    "minuteOfHour": (0, 59),
+    "device_activity": (0.0, 1.0),
+    "device_batteryLevel": (0.0, 1.0),
+    "device_screenActive": (0, 1),
+    "device_appInForeground": (0, 1),
+    "device_audioPlaying": (0, 1),
+    TARGET: (0.0, np.inf),
+}
+REQUIRED = ["dayOfWeek", "hourOfDay", "minuteOfHour", TARGET]
+FEATURES = [c for c, kind in COLUMNS.items() if kind in (INT, FLOAT, FLAG) and c != TARGET]
+
+FLAG_WORDS = {"true": 1.0, "false": 0.0, "yes": 1.0, "no": 0.0}
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+# Date and wall-clock time; a trailing zone ("Z", "+02:00") is ignored, as
+# the rest of the pipeline treats timestamps as the client's local time
+# (the zone only sets ``epochTime``)
+TIMESTAMP_PATTERN = r"^\s*(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?)"
+ZONED_PATTERN = TIMESTAMP_PATTERN + r"\d*\s*(?:Z|[+-]\d{2}:?\d{2})\s*$"
+UNIX_EPOCH = pd.Timestamp(0, tz="UTC")
+
+def _numeric(values, kind):
+    """float64 array of a column; anything unparseable becomes NaN"""
+    if kind == FLAG and values.dtype == object:
+        words = values.astype(str).str.strip().str.lower().map(FLAG_WORDS)
+        values = words.where(words.notna(), values)
+    # Booleans convert to 1.0/0.0
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+
+def _timestamps(values):
+    """Parse timestamps as local wall-clock times; unparseable ones become NaT"""
+    if np.issubdtype(values.dtype, np.datetime64):
+        return pd.to_datetime(values)
+    parts = values.astype(str).str.extract(TIMESTAMP_PATTERN)
+    return pd.to_datetime(parts[0] + " " + parts[1], errors='coerce')
+
+def _epoch_seconds(rows):
+    """Epoch seconds of each row from ``epochTime`` or a zoned ``timestamp``; NaN otherwise"""
+    n = len(rows)
+    seconds = _numeric(rows["epochTime"], FLOAT) if "epochTime" in rows.columns else np.full(n, np.nan)
+    if "timestamp" in rows.columns and rows["timestamp"].dtype == object:
+        zoned = rows["timestamp"].astype(str).str.match(ZONED_PATTERN).to_numpy(dtype=bool)
+        missing = np.isnan(seconds) & zoned
+        if missing.any():
+            parsed = pd.to_datetime(rows["timestamp"][missing], utc=True, errors='coerce')
+            seconds[missing] = ((parsed - UNIX_EPOCH) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64)
+    return seconds
+
+def normalize(rows):
+    """
+    Coerce, check and repair a DataFrame of raw rows.
+
+    Returns ``(normalized, report)``: ``normalized`` has exactly COLUMNS
+    and only valid rows; ``report`` counts ``rejected`` rows, values
+    ``repaired`` and values ``cleared``, and why rows were rejected
+    (``reasons``, per column).
+    """
+    n = len(rows)
+    report = {"rows": n, "accepted": 0, "rejected": 0, "repaired": 0, "cleared": 0, "reasons": {}}
+    if n == 0:
+        return pd.DataFrame({c: pd.Series(dtype=object) for c in COLUMNS}), report
+
+    timestamps = _timestamps(rows["timestamp"]) if "timestamp" in rows.columns \
+        else pd.Series(pd.NaT, index=rows.index)
+    derived = {"dayOfWeek": timestamps.dt.dayofweek, "hourOfDay": timestamps.dt.hour,
+               "minuteOfHour": timestamps.dt.minute}
+
+    valid = np.ones(n, dtype=bool)
+    out, repaired, cleared = {}, [], []
+    for column, kind in COLUMNS.items():
+        if kind == TIME:
+            out[column] = timestamps.dt.strftime(TIMESTAMP_FORMAT).to_numpy(dtype=object)
+            continue
+        if kind == TEXT:
+            if column in rows.columns:
+                text = rows[column].astype(str).str.strip()
+                out[column] = text.where(rows[column].notna() & (text != ""), None).to_numpy(dtype=object)
+            else:
+                out[column] = np.full(n, None, dtype=object)
+            continue
+
+        if kind == EPOCH:
+            values = _epoch_seconds(rows)
+        else:
+            values = _numeric(rows[column], kind) if column in rows.columns else np.full(n, np.nan)
+        if column in derived:
+            missing = np.isnan(values)
+            values[missing] = derived[column].to_numpy(dtype=np.float64)[missing]
+        if column == "device_batteryLevel":
+            # Percent instead of a fraction
+            percent = (values > 1.0) & (values <= 100.0)
+            values[percent] /= 100.0
+            repaired.append(percent)
+
+        low, high = RANGES.get(column, (-np.inf, np.inf))
+        with np.errstate(invalid='ignore'):
+            ok = (values >= low) & (values <= high)
+            if kind in (INT, FLAG):
+                ok &= values == np.floor(values)
+        if column in REQUIRED:
+            bad = ~ok & valid
+            if bad.any():
+                report["reasons"][column] = int(bad.sum())
+            valid &= ok
+        else:
+            bad = ~ok & ~np.isnan(values)
+            values[bad] = np.nan
+            cleared.append(bad)
+        out[column] = values
+
+    normalized = pd.DataFrame({c: v[valid] for c, v in out.items()}, columns=list(COLUMNS))
+    for column, kind in COLUMNS.items():
+        if kind in (INT, FLAG):
+            # Whole numbers in the CSV; optional ones may be empty
+            normalized[column] = normalized[column].astype(np.int64 if column in REQUIRED else "Int64")
+    report["repaired"] = int(sum((mask & valid).sum() for mask in repaired))
+    report["cleared"] = int(sum((mask & valid).sum() for mask in cleared))
+    report["accepted"] = int(valid.sum())
+    report["rejected"] = n - report["accepted"]
+    return normalized, report
+
+def normalize_submission(data):
+    """
+    Normalize the sessions of a study-data submission.
+
+    ``deviceContext`` values are broadcast to every session as
+    ``device_<key>`` columns (they override session keys of the same name,
+    as in ``features.submission_rows``). Raises ValueError when
+    ``sessions`` is not a list of objects or ``deviceContext`` not an object.
+    """
+    sessions = data.get('sessions')
+    context = data.get('deviceContext')
+    context = {} if context is None else context
+    if not isinstance(sessions, list) or not all(isinstance(s, dict) for s in sessions):
+        raise ValueError("sessions must be a list of objects")
+    if not isinstance(context, dict):
+        raise ValueError("deviceContext must be an object")
+    rows = pd.DataFrame(sessions)
+    for key, value in context.items():
+        column = f"device_{key}"
+        if column in COLUMNS:
+            rows[column] = value
+    return normalize(rows)
@@ -0,0 +1,276 @@
+"""
+Bandwidth- and worker-friendly model downloads.
+
+Publishing (``publish_models``, run whenever the served model changes)
+hashes each well-known model file once, stores an immutable copy named by
+its SHA-256 in ``output_models/published/`` next to precompressed variants
+(gzip, and zstd when ``zstandard`` is installed), and records size, hash,
+mtime and variants in ``manifest.json``. Only publishing writes the
+manifest (``model_registry.set_current`` does it on every deploy or
+rollback); downloads answer 404 until there is one. Files a new manifest
+no longer lists stay for PRUNE_GRACE_SECONDS, so downloads that started
+from the previous manifest (or resume it with ``Range``) still find them.
+
+Downloads are then answered from the in-memory manifest without touching
+the model files: the hash is a strong ETag, ``If-None-Match`` gets a 304,
+and the body is either handed to nginx with ``X-Accel-Redirect`` (set
+``MODEL_ACCEL_PREFIX`` to the internal location, see ``nginx.conf``) or
+streamed through the WSGI file wrapper, which gunicorn serves with
+``os.sendfile``. ``Range`` requests are served from the uncompressed copy.
+"""
+import os
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+
+from flask import Response, request, send_file
+from werkzeug.wsgi import wrap_file
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+OUTPUT_DIR = "output_models"
+PUBLISH_DIR = os.path.join(OUTPUT_DIR, "published")
+MANIFEST_PATH = os.path.join(PUBLISH_DIR, "manifest.json")
+MODEL_FILES = {
+    "sklearn": os.path.join(OUTPUT_DIR, "NotificationTimePredictor.pkl"),
+    "coreml": os.path.join(OUTPUT_DIR, "NotificationTimePredictor.mlmodel"),
+}
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+MANIFEST_CHECK_SECONDS = 2   # how often workers look for a newer manifest
+PRUNE_GRACE_SECONDS = 3600   # how long replaced files stay downloadable
+
+# nginx internal location that maps to PUBLISH_DIR, e.g. "/protected_models/"
+X_ACCEL_PREFIX = os.environ.get("MODEL_ACCEL_PREFIX")
+
+_manifest = {"data": None, "mtime": None, "checked": 0.0}
+_manifest_lock = threading.Lock()
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _write_variant(source, target, compress):
+    if os.path.exists(target):
+        return
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+        compress(src, dst)
+    os.replace(tmp_path, target)
+
+def _copy(src, dst):
+    shutil.copyfileobj(src, dst, 1 << 20)
+
+def _gzip(src, dst):
+    with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as out:
+        shutil.copyfileobj(src, out)
+
+def _zstd(src, dst):
+    zstd.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, dst)
+
+def publish(path):
+    """
+    Store an immutable, content-addressed copy of ``path`` plus its variants.
+
+    Returns the manifest entry. Republishing identical content is free and
+    different versions never overwrite each other, so a download that is
+    in flight while a new model is published still gets consistent bytes.
+    """
+    st = os.stat(path)
+    sha256 = _sha256(path)
+    os.makedirs(PUBLISH_DIR, exist_ok=True)
+
+    identity = os.path.join(PUBLISH_DIR, sha256)
+    if not os.path.exists(identity):
+        try:
+            os.link(path, identity)
+        except OSError:
+            _write_variant(path, identity, _copy)
+
+    variants = {}
+    codecs = [("gzip", ".gz", _gzip)] + ([("zstd", ".zst", _zstd)] if zstd is not None else [])
+    for encoding, ext, compress in codecs:
+        target = identity + ext
+        _write_variant(path, target, compress)
+        size = os.path.getsize(target)
+        # Only offer a compressed variant if it actually saves bytes
+        if size < st.st_size:
+            variants[encoding] = {"file": os.path.basename(target), "size": size}
+
+    return {
+        "file": sha256,
+        "sha256": sha256,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "variants": variants,
+    }
+
+def _read_manifest():
+    try:
+        with open(MANIFEST_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def publish_models():
+    """Publish every well-known model file and atomically replace the manifest"""
+    now = time.time()
+    files = {kind: publish(path) for kind, path in MODEL_FILES.items() if os.path.exists(path)}
+    current = {entry["sha256"] for entry in files.values()}
+
+    # Hashes the previous manifest served, with when they stopped being served
+    previous = _read_manifest() or {}
+    retired = {sha256: at for sha256, at in previous.get("retired", {}).items()
+               if sha256 not in current and now - at < PRUNE_GRACE_SECONDS}
+    for entry in previous.get("files", {}).values():
+        if entry["sha256"] not in current:
+            retired.setdefault(entry["sha256"], now)
+
+    manifest = {"published_at": now, "files": files, "retired": retired}
+    os.makedirs(PUBLISH_DIR, exist_ok=True)
+    tmp_path = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+    prune(current | set(retired))
+    return manifest
+
+def prune(keep_hashes):
+    """Delete published files whose content hash is not in ``keep_hashes``"""
+    removed = 0
+    for name in os.listdir(PUBLISH_DIR):
+        if name.startswith("manifest") or name.endswith(".tmp"):
+            continue
+        if name.split('.')[0] not in keep_hashes:
+            os.remove(os.path.join(PUBLISH_DIR, name))
+            removed += 1
+    return removed
+
+def get_manifest():
+    """Return the manifest, re-reading it at most every MANIFEST_CHECK_SECONDS"""
+    now = time.time()
+    with _manifest_lock:
+        if now - _manifest["checked"] < MANIFEST_CHECK_SECONDS:
+            return _manifest["data"]
+        _manifest["checked"] = now
+    try:
+        mtime = os.path.getmtime(MANIFEST_PATH)
+    except OSError:
+        return None
+    if mtime != _manifest["mtime"]:
+        try:
+            with open(MANIFEST_PATH, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading model manifest: {str(e)}")
+            return _manifest["data"]
+        with _manifest_lock:
+            _manifest["data"], _manifest["mtime"] = data, mtime
+    return _manifest["data"]
+
+def published_entry(kind):
+    """Manifest entry for a model kind, or None until one is published"""
+    manifest = get_manifest()
+    return manifest["files"].get(kind) if manifest else None
+
+def etag_matches(etag):
+    """True if the request's If-None-Match names ``etag``"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or f'"{etag}"' in tags or f'W/"{etag}"' in tags
+
+def _accepted_encodings():
+    accepted = {}
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        fields = part.strip().split(';')
+        if not fields[0]:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            if param.strip().startswith('q='):
+                try:
+                    q = float(param.strip()[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[fields[0].strip().lower()] = q
+    return accepted
+
+def send_published(kind, download_name):
+    """
+    Send a published model from its manifest entry.
+
+    Returns None when no model of that kind exists.
+    """
+    entry = published_entry(kind)
+    if entry is None:
+        return None
+
+    encoding = None
+    if 'Range' not in request.headers:
+        accepted = _accepted_encodings()
+        for candidate in ("zstd", "gzip"):
+            if candidate in entry["variants"] and accepted.get(candidate, 0) > 0:
+                encoding = candidate
+                break
+
+    if encoding is None:
+        file_name, size, etag = entry["file"], entry["size"], entry["sha256"]
+    else:
+        variant = entry["variants"][encoding]
+        file_name, size, etag = variant["file"], variant["size"], f"{entry['sha256']}-{encoding}"
+
+    headers = {
+        'ETag': f'"{etag}"',
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': 'no-cache',
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+    }
+    if encoding:
+        headers['Content-Encoding'] = encoding
+
+    if etag_matches(etag):
+        return Response(status=304, headers=headers)
+
+    path = os.path.join(PUBLISH_DIR, file_name)
+    if X_ACCEL_PREFIX:
+        # nginx streams the file (sendfile, Range) and frees the worker immediately
+        headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + file_name
+        return Response(status=200, headers=headers, mimetype='application/octet-stream')
+
+    if 'Range' in request.headers:
+        response = send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                             download_name=download_name, etag=etag, conditional=True)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    headers['Content-Length'] = str(size)
+    headers['Accept-Ranges'] = 'bytes'
+    body = wrap_file(request.environ, open(path, 'rb'))
+    return Response(body, status=200, headers=headers, mimetype='application/octet-stream',
+                    direct_passthrough=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish model files for download")
+    parser.add_argument("command", choices=["publish", "show"])
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        manifest = publish_models()
+        for kind, entry in manifest["files"].items():
+            sizes = ", ".join(f"{enc}={v['size']}" for enc, v in entry["variants"].items())
+            print(f"{kind}: {entry['sha256'][:12]} {entry['size']} bytes ({sizes or 'no variants'})")
+    else:
+        print(json.dumps(get_manifest(), indent=2))
@@ -0,0 +1,278 @@
+"""
+Content-addressed registry of trained models.
+
+Every registered model lives in ``output_models/registry/<version>/`` where
+``<version>`` is the first 12 hex digits of the SHA-256 of its pickle. The
+directory holds ``model.pkl``, an optional ``model.mlmodel`` and a
+``metadata.json`` with the feature list, MAE, number of training rows and
+creation time. ``CURRENT`` names the version served by default, so a
+rollback is a one-line pointer swap rather than a redeploy. ``CANDIDATE``
+optionally names a version evaluated in shadow mode on live traffic.
+
+Further predictors (for example one per notification category or app) are
+served under a name: ``names/<name>`` points at a version just like
+``CURRENT`` does, and ``/predict/<name>`` routes to it.
+"""
+import os
+import re
+import json
+import shutil
+import pickle
+import hashlib
+import argparse
+from datetime import datetime
+import model_distribution
+
+OUTPUT_DIR = "output_models"
+REGISTRY_DIR = os.path.join(OUTPUT_DIR, "registry")
+CURRENT_PATH = os.path.join(REGISTRY_DIR, "CURRENT")
+CANDIDATE_PATH = os.path.join(REGISTRY_DIR, "CANDIDATE")
+NAMES_DIR = os.path.join(REGISTRY_DIR, "names")
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+VERSION_PATTERN = re.compile(r"^[0-9a-f]{12}$")
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def is_version(version):
+    """Whether ``version`` is shaped like a version id (it may still be unregistered)"""
+    return isinstance(version, str) and VERSION_PATTERN.match(version) is not None
+
+def version_dir(version):
+    return os.path.join(REGISTRY_DIR, version)
+
+def register_model(sklearn_path, coreml_path=None, features=None, mae=None,
+                   training_rows=None, extra=None, make_current=False, name=None):
+    """
+    Copy a trained model into the registry and return its version id.
+
+    Registering the same pickle twice is a no-op that returns the existing
+    version (metadata from the first registration is kept).
+    """
+    version = _sha256(sklearn_path)[:12]
+    target_dir = version_dir(version)
+    metadata_path = os.path.join(target_dir, "metadata.json")
+
+    if not os.path.exists(metadata_path):
+        tmp_dir = f"{target_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        shutil.copy2(sklearn_path, os.path.join(tmp_dir, "model.pkl"))
+        if coreml_path and os.path.exists(coreml_path):
+            shutil.copy2(coreml_path, os.path.join(tmp_dir, "model.mlmodel"))
+        metadata = {
+            "version": version,
+            "features": list(features) if features is not None else None,
+            "mae": float(mae) if mae is not None else None,
+            "training_rows": int(training_rows) if training_rows is not None else None,
+            "created_at": datetime.now().isoformat(timespec='seconds'),
+        }
+        metadata.update(extra or {})
+        with open(os.path.join(tmp_dir, "metadata.json"), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        try:
+            os.rename(tmp_dir, target_dir)
+        except OSError:
+            # Another process registered the same model concurrently
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if make_current:
+        set_current(version)
+    if name:
+        set_named(name, version)
+    return version
+
+def get_metadata(version):
+    """Return the metadata dict of a version, or None if it is not registered"""
+    if not is_version(version):
+        return None
+    try:
+        with open(os.path.join(version_dir(version), "metadata.json"), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def update_metadata(version, **fields):
+    """Merge ``fields`` into a registered version's metadata"""
+    metadata = get_metadata(version)
+    if metadata is None:
+        raise KeyError(f"Unknown model version: {version}")
+    metadata.update(fields)
+    path = os.path.join(version_dir(version), "metadata.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(tmp_path, path)
+    return metadata
+
+def list_versions():
+    """Return metadata for every registered version, newest first"""
+    if not os.path.isdir(REGISTRY_DIR):
+        return []
+    versions = []
+    for name in os.listdir(REGISTRY_DIR):
+        metadata = get_metadata(name)
+        if metadata is not None:
+            versions.append(metadata)
+    versions.sort(key=lambda m: m.get("created_at") or "", reverse=True)
+    return versions
+
+def current_version():
+    """Return the version id served by default, or None"""
+    try:
+        with open(CURRENT_PATH, 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def set_current(version):
+    """Point CURRENT at ``version`` (atomically) and mirror it into OUTPUT_DIR"""
+    if get_metadata(version) is None:
+        raise KeyError(f"Unknown model version: {version}")
+    tmp_path = f"{CURRENT_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, CURRENT_PATH)
+
+    # Keep the well-known file names used by clients and older tooling in sync,
+    # then publish them for download (hashes and compressed variants, once)
+    for name, ext in (("model.pkl", ".pkl"), ("model.mlmodel", ".mlmodel")):
+        source = os.path.join(version_dir(version), name)
+        target = os.path.join(OUTPUT_DIR, f"NotificationTimePredictor{ext}")
+        if os.path.exists(source):
+            tmp_target = f"{target}.{os.getpid()}.tmp"
+            shutil.copy2(source, tmp_target)
+            os.replace(tmp_target, target)
+        elif os.path.exists(target):
+            # A version without a CoreML export must not leave the previous one published
+            os.remove(target)
+    model_distribution.publish_models()
+
+def candidate_version():
+    """Return the version being shadow-evaluated, or None"""
+    try:
+        with open(CANDIDATE_PATH, 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def set_candidate(version):
+    """Shadow-evaluate ``version`` on live traffic; ``None`` stops shadowing"""
+    if version is None:
+        if os.path.exists(CANDIDATE_PATH):
+            os.remove(CANDIDATE_PATH)
+        return
+    if get_metadata(version) is None:
+        raise KeyError(f"Unknown model version: {version}")
+    tmp_path = f"{CANDIDATE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, CANDIDATE_PATH)
+
+def _name_path(name):
+    if not NAME_PATTERN.match(name or ""):
+        raise ValueError(f"Invalid model name: {name!r} (letters, digits, '_' and '-')")
+    return os.path.join(NAMES_DIR, name)
+
+def named_version(name):
+    """Return the version served as model ``name``, or None"""
+    try:
+        with open(_name_path(name), 'r') as f:
+            return f.read().strip() or None
+    except (OSError, ValueError):
+        return None
+
+def set_named(name, version):
+    """Serve ``version`` as model ``name``; ``None`` removes the name"""
+    path = _name_path(name)
+    if version is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    if get_metadata(version) is None:
+        raise KeyError(f"Unknown model version: {version}")
+    os.makedirs(NAMES_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(version)
+    os.replace(tmp_path, path)
+
+def list_named():
+    """Return ``{name: version}`` for every named model"""
+    if not os.path.isdir(NAMES_DIR):
+        return {}
+    names = {}
+    for name in sorted(os.listdir(NAMES_DIR)):
+        if NAME_PATTERN.match(name):
+            version = named_version(name)
+            if version:
+                names[name] = version
+    return names
+
+def model_path(version, kind="sklearn"):
+    if not is_version(version):
+        raise ValueError(f"Invalid model version: {version!r}")
+    name = "model.pkl" if kind == "sklearn" else "model.mlmodel"
+    return os.path.join(version_dir(version), name)
+
+def load_version(version):
+    """Unpickle the scikit-learn model of a registered version"""
+    with open(model_path(version), 'rb') as f:
+        payload = f.read()
+    # The version is the pickle's hash, so only the registered bytes are unpickled
+    if hashlib.sha256(payload).hexdigest()[:12] != version:
+        raise ValueError(f"Model file of version {version} does not match its hash")
+    return pickle.loads(payload)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage registered model versions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="List registered versions")
+    promote = sub.add_parser("promote", help="Serve a version by default (rollback/roll forward)")
+    promote.add_argument("version")
+    shadow = sub.add_parser("shadow", help="Shadow-evaluate a version on live traffic")
+    shadow.add_argument("version", nargs="?", help="Version to evaluate (omit to stop)")
+    named = sub.add_parser("name", help="Serve a version as /predict/<name>")
+    named.add_argument("name")
+    named.add_argument("version", nargs="?", help="Version to serve (omit to remove the name)")
+    register = sub.add_parser("register", help="Register the model currently in output_models/")
+    register.add_argument("--model", help="Pickle to register instead of output_models/'s")
+    register.add_argument("--coreml", help="CoreML file to register with it")
+    register.add_argument("--metadata", help="metadata.json of the version on another registry")
+    register.add_argument("--current", action="store_true", help="Also make it the default version")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        current = current_version()
+        candidate = candidate_version()
+        for m in list_versions():
+            marker = "*" if m["version"] == current else ("~" if m["version"] == candidate else " ")
+            print(f"{marker} {m['version']}  {m['created_at']}  mae={m.get('mae')}  rows={m.get('training_rows')}")
+        for name, version in list_named().items():
+            print(f"  /predict/{name} -> {version}")
+    elif args.command == "promote":
+        set_current(args.version)
+        print(f"Version {args.version} is now the default")
+    elif args.command == "shadow":
+        set_candidate(args.version)
+        print(f"Shadowing version {args.version}" if args.version else "Shadow evaluation stopped")
+    elif args.command == "name":
+        set_named(args.name, args.version)
+        print(f"/predict/{args.name} serves version {args.version}" if args.version
+              else f"Model name {args.name} removed")
+    elif args.command == "register":
+        sklearn_path = args.model or os.path.join(OUTPUT_DIR, "NotificationTimePredictor.pkl")
+        coreml_path = args.coreml if args.model else os.path.join(OUTPUT_DIR, "NotificationTimePredictor.mlmodel")
+        metadata = {}
+        if args.metadata:
+            with open(args.metadata, 'r') as f:
+                metadata = json.load(f)
+        extra = {k: v for k, v in metadata.items()
+                 if k not in ("version", "features", "mae", "training_rows", "created_at")}
+        version = register_model(sklearn_path, coreml_path, features=metadata.get("features"),
+                                 mae=metadata.get("mae"), training_rows=metadata.get("training_rows"),
+                                 extra=extra, make_current=args.current)
+        print(f"Registered version {version}")
@@ -0,0 +1,419 @@
+"""
+Pull-based model distribution to a fleet of serving nodes.
+
+A model source is either a directory (local disk or a shared mount) or the
+base URL of an object store that answers plain ``GET``/``PUT`` per key, such
+as an S3-compatible bucket behind presigned URLs or the stand-in started with
+``python model_sync.py store``. It holds:
+
+* ``blobs/<sha256>``: model files, named by their content hash
+* ``release.json``: the version the fleet should serve, with the hash and
+  size of each file and the version's registry metadata
+* ``status/<node>.json``: the rollout state reported by each node
+
+``publish`` uploads a registry version and then replaces ``release.json``.
+On every node an agent (``python model_sync.py agent``) polls the release.
+When the release names a version the node does not serve yet, the agent:
+
+1. streams each blob into ``output_models/staging/`` while hashing it
+2. rejects it unless the SHA-256 and size match the release
+3. registers the staged files in the local registry
+4. points ``CURRENT`` at the new version
+
+Serving workers pick up ``CURRENT`` within seconds without a restart. With
+``--node-url`` the agent waits until the node reports the version loaded.
+The node then reports ``active`` (or ``failed`` with the error), and the
+previous version keeps serving whenever something goes wrong.
+``python model_sync.py status`` prints the rollout across the fleet.
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import argparse
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import model_registry
+
+RELEASE_KEY = "release.json"
+BLOB_PREFIX = "blobs/"
+STATUS_PREFIX = "status/"
+STAGING_DIR = os.path.join(model_registry.OUTPUT_DIR, "staging")
+POLL_SECONDS = 10
+RETRY_FAILED_SECONDS = 300       # a release that failed verification is retried this late
+CONFIRM_TIMEOUT_SECONDS = 60     # how long to wait for the node to load a swapped model
+HTTP_TIMEOUT_SECONDS = 30
+BLOCK_SIZE = 1 << 20
+
+class VerificationError(Exception):
+    """A downloaded file does not match the release"""
+
+def _is_http(source):
+    return source.startswith("http://") or source.startswith("https://")
+
+def _local_path(source, key):
+    root = os.path.abspath(source[len("file://"):] if source.startswith("file://") else source)
+    return os.path.join(root, *key.split('/'))
+
+def _url(source, key):
+    return source.rstrip('/') + '/' + key
+
+def get_object(source, key):
+    """Bytes stored under ``key``, or None if there is none"""
+    if _is_http(source):
+        try:
+            with urllib.request.urlopen(_url(source, key), timeout=HTTP_TIMEOUT_SECONDS) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+    try:
+        with open(_local_path(source, key), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def open_object(source, key):
+    """Readable stream of the object under ``key``"""
+    if _is_http(source):
+        return urllib.request.urlopen(_url(source, key), timeout=HTTP_TIMEOUT_SECONDS)
+    return open(_local_path(source, key), 'rb')
+
+def object_exists(source, key):
+    if _is_http(source):
+        request = urllib.request.Request(_url(source, key), method='HEAD')
+        try:
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT_SECONDS):
+                return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+    return os.path.exists(_local_path(source, key))
+
+def put_object(source, key, data=None, path=None):
+    """Store ``data`` (bytes) or the file at ``path`` under ``key``, atomically"""
+    if _is_http(source):
+        if path is not None:
+            with open(path, 'rb') as body:
+                request = urllib.request.Request(_url(source, key), data=body, method='PUT',
+                                                 headers={"Content-Length": str(os.path.getsize(path))})
+                urllib.request.urlopen(request, timeout=HTTP_TIMEOUT_SECONDS).close()
+        else:
+            request = urllib.request.Request(_url(source, key), data=data, method='PUT')
+            urllib.request.urlopen(request, timeout=HTTP_TIMEOUT_SECONDS).close()
+        return
+    target = _local_path(source, key)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    if path is not None:
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+                dst.write(block)
+    else:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+    os.replace(tmp_path, target)
+
+def list_objects(source, prefix):
+    """Names of the objects directly under ``prefix``"""
+    if _is_http(source):
+        listing = get_object(source, prefix)
+        return json.loads(listing) if listing else []
+    directory = _local_path(source, prefix)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(n for n in os.listdir(directory) if not n.endswith(".tmp"))
+
+def _file_entry(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+    return {"sha256": sha256, "size": os.path.getsize(path), "blob": BLOB_PREFIX + sha256}
+
+def publish(version, source):
+    """Upload a registry version's files and make it the fleet's release"""
+    metadata = model_registry.get_metadata(version)
+    if metadata is None:
+        raise KeyError(f"Unknown model version: {version}")
+    files = {}
+    for kind in ("sklearn", "coreml"):
+        path = model_registry.model_path(version, kind)
+        if not os.path.exists(path):
+            continue
+        entry = _file_entry(path)
+        # Blobs are immutable, so a version is uploaded once
+        if not object_exists(source, entry["blob"]):
+            put_object(source, entry["blob"], path=path)
+        files[kind] = entry
+    release = {"version": version, "files": files, "metadata": metadata, "released_at": time.time()}
+    put_object(source, RELEASE_KEY, json.dumps(release, indent=2).encode('utf-8'))
+    return release
+
+def _download(source, entry, name):
+    """Stream a blob into the staging area, verifying its hash and size"""
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    target = os.path.join(STAGING_DIR, name)
+    part = f"{target}.{os.getpid()}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open_object(source, entry["blob"]) as src, open(part, 'wb') as dst:
+            for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+                digest.update(block)
+                size += len(block)
+                dst.write(block)
+        if size != entry["size"] or digest.hexdigest() != entry["sha256"]:
+            raise VerificationError(f"{entry['blob']}: got {size} bytes with sha256 "
+                                    f"{digest.hexdigest()[:12]}, release says {entry['size']} "
+                                    f"bytes with {entry['sha256'][:12]}")
+        os.replace(part, target)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return target
+
+def _served_version(node_url):
+    """Version the node serves on /predict, if it has it loaded"""
+    try:
+        with urllib.request.urlopen(node_url.rstrip('/') + "/models", timeout=5) as response:
+            models = json.load(response)["models"]
+    except (OSError, ValueError, KeyError):
+        return None
+    default = next((m for m in models if m.get("name") is None), None)
+    return default["version"] if default and default.get("loaded") else None
+
+def install(release, source):
+    """Download, verify, register and swap in a release; returns timings"""
+    started = time.perf_counter()
+    if model_registry.get_metadata(release["version"]) is not None:
+        # Already in the local registry (e.g. a rollback): nothing to download
+        model_registry.set_current(release["version"])
+        return {"download_ms": 0.0, "swap_ms": round((time.perf_counter() - started) * 1000, 1), "bytes": 0}
+    staged = {}
+    try:
+        for kind, entry in release["files"].items():
+            staged[kind] = _download(source, entry, entry["sha256"] + (".pkl" if kind == "sklearn" else ".mlmodel"))
+        if "sklearn" not in staged:
+            raise VerificationError("Release has no scikit-learn model")
+        downloaded = time.perf_counter()
+
+        metadata = dict(release.get("metadata") or {})
+        fields = {k: metadata.pop(k, None) for k in ("features", "mae", "training_rows")}
+        for k in ("version", "created_at"):
+            metadata.pop(k, None)
+        version = model_registry.register_model(staged["sklearn"], staged.get("coreml"),
+                                                extra=metadata, **fields)
+        if version != release["version"]:
+            raise VerificationError(f"Registered as {version}, release is {release['version']}")
+        model_registry.set_current(version)
+    finally:
+        for path in staged.values():
+            if os.path.exists(path):
+                os.remove(path)
+    return {
+        "download_ms": round((downloaded - started) * 1000, 1),
+        "swap_ms": round((time.perf_counter() - downloaded) * 1000, 1),
+        "bytes": sum(e["size"] for e in release["files"].values()),
+    }
+
+def report(source, node, state, **fields):
+    """Write this node's rollout state to the source"""
+    status = {
+        "node": node,
+        "host": socket.gethostname(),
+        "state": state,
+        "version": model_registry.current_version(),
+        "updated_at": time.time(),
+        **fields,
+    }
+    try:
+        put_object(source, f"{STATUS_PREFIX}{node}.json", json.dumps(status).encode('utf-8'))
+    except OSError as e:
+        print(f"Could not report status to {source}: {str(e)}")
+    return status
+
+def sync_once(source, node, node_url=None, failed=None):
+    """
+    Bring this node to the current release once; returns its status.
+
+    ``failed`` maps release hashes to when they failed, so a broken
+    release is not downloaded again on every poll.
+    """
+    failed = {} if failed is None else failed
+    raw = get_object(source, RELEASE_KEY)
+    if raw is None:
+        return report(source, node, "idle", target=None)
+    release = json.loads(raw)
+    target = release["version"]
+    sha256 = release["files"].get("sklearn", {}).get("sha256")
+
+    if model_registry.current_version() == target:
+        if node_url and _served_version(node_url) != target:
+            return report(source, node, "loading", target=target)
+        return report(source, node, "active", target=target)
+    if sha256 in failed and time.time() - failed[sha256]["at"] < RETRY_FAILED_SECONDS:
+        return report(source, node, "failed", target=target, error=failed[sha256]["error"])
+
+    report(source, node, "downloading", target=target)
+    try:
+        timings = install(release, source)
+    except Exception as e:
+        failed[sha256] = {"at": time.time(), "error": str(e)}
+        print(f"Rollout of {target} failed: {str(e)}")
+        return report(source, node, "failed", target=target, error=str(e))
+    print(f"Swapped in version {target} ({timings['bytes']} bytes, {timings['download_ms']} ms download)")
+
+    if node_url:
+        deadline = time.time() + CONFIRM_TIMEOUT_SECONDS
+        while _served_version(node_url) != target:
+            if time.time() > deadline:
+                return report(source, node, "loading", target=target, error="Node has not loaded the model",
+                              **timings)
+            time.sleep(0.5)
+    return report(source, node, "active", target=target, **timings)
+
+def run_agent(source, node, node_url=None, interval=POLL_SECONDS):
+    """Poll the source forever"""
+    print(f"Model sync agent {node}: polling {source} every {interval}s")
+    failed = {}
+    while True:
+        try:
+            sync_once(source, node, node_url, failed)
+        except Exception as e:
+            # The source being unreachable must not stop the agent
+            print(f"Model sync error: {str(e)}")
+        time.sleep(interval)
+
+def rollout_status(source, stale_seconds=3 * POLL_SECONDS):
+    """Release version and every node's reported state"""
+    raw = get_object(source, RELEASE_KEY)
+    target = json.loads(raw)["version"] if raw else None
+    nodes = []
+    for name in list_objects(source, STATUS_PREFIX):
+        raw_status = get_object(source, STATUS_PREFIX + name)
+        if not raw_status:
+            continue
+        status = json.loads(raw_status)
+        status["stale"] = time.time() - status["updated_at"] > stale_seconds
+        nodes.append(status)
+    done = [n for n in nodes if n["state"] == "active" and n["version"] == target and not n["stale"]]
+    return {"target": target, "nodes": nodes, "active": len(done), "total": len(nodes)}
+
+class _StoreHandler(SimpleHTTPRequestHandler):
+    """GET/HEAD/PUT of keys below the store directory; a trailing slash lists a prefix"""
+    def log_message(self, format, *args):
+        pass
+
+    def _path(self):
+        key = self.path.split('?')[0].lstrip('/')
+        root = os.path.abspath(self.directory)
+        path = os.path.abspath(os.path.join(root, key))
+        if path != root and not path.startswith(root + os.sep):
+            return None
+        return path
+
+    def do_GET(self):
+        path = self._path()
+        if path is not None and self.path.endswith('/'):
+            names = sorted(os.listdir(path)) if os.path.isdir(path) else []
+            body = json.dumps([n for n in names if not n.endswith(".tmp")]).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        super().do_GET()
+
+    def do_HEAD(self):
+        path = self._path()
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        super().do_HEAD()
+
+    def do_PUT(self):
+        path = self._path()
+        if path is None or self.path.endswith('/'):
+            self.send_error(400)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        remaining = int(self.headers.get('Content-Length', 0))
+        with open(tmp_path, 'wb') as f:
+            while remaining:
+                block = self.rfile.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+        if remaining:
+            os.remove(tmp_path)
+            self.send_error(400, "Incomplete body")
+            return
+        os.replace(tmp_path, path)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def serve_store(directory, port):
+    """Local stand-in for an object store (no authentication, for tests)"""
+    os.makedirs(directory, exist_ok=True)
+    handler = lambda *args, **kwargs: _StoreHandler(*args, directory=directory, **kwargs)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"Serving {directory} on http://127.0.0.1:{port}/")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pull-based model distribution")
+    sub = parser.add_subparsers(dest="command", required=True)
+    pub = sub.add_parser("publish", help="Make a registry version the fleet's release")
+    pub.add_argument("version", nargs="?", help="Version to publish (default: CURRENT)")
+    pub.add_argument("--source", required=True, help="Directory or object store URL")
+    agent = sub.add_parser("agent", help="Keep this node on the current release")
+    agent.add_argument("--source", required=True, help="Directory or object store URL")
+    agent.add_argument("--node", default=socket.gethostname(), help="Name reported for this node")
+    agent.add_argument("--node-url", help="This node's API, e.g. http://127.0.0.1:5001")
+    agent.add_argument("--interval", type=float, default=POLL_SECONDS)
+    agent.add_argument("--once", action="store_true", help="Sync once and exit")
+    status = sub.add_parser("status", help="Show the rollout across nodes")
+    status.add_argument("--source", required=True, help="Directory or object store URL")
+    store = sub.add_parser("store", help="Run a local object store stand-in")
+    store.add_argument("--dir", required=True)
+    store.add_argument("--port", type=int, default=8700)
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        version = args.version or model_registry.current_version()
+        if not version:
+            parser.error("No version given and no CURRENT version in the registry")
+        release = publish(version, args.source)
+        print(f"Released {release['version']} to {args.source}")
+    elif args.command == "agent":
+        if args.once:
+            print(json.dumps(sync_once(args.source, args.node, args.node_url), indent=2))
+        else:
+            run_agent(args.source, args.node, args.node_url, args.interval)
+    elif args.command == "status":
+        rollout = rollout_status(args.source)
+        print(f"Release: {rollout['target']}  ({rollout['active']}/{rollout['total']} nodes active)")
+        for node in rollout["nodes"]:
+            age = time.time() - node["updated_at"]
+            line = f"  {node['node']:<20} {node['state']:<12} serving={node['version']}  {age:.0f}s ago"
+            if node["stale"]:
+                line += "  STALE"
+            if node.get("error"):
+                line += f"  error: {node['error']}"
+            print(line)
+    else:
+        serve_store(args.dir, args.port)
@@ -0,0 +1,175 @@
+"""
+Day-partitioned training data.
+
+Processed rows are written to ``collected_data/partitions/<YYYY-MM-DD>/``,
+one CSV per submission or upload chunk and day, where the day is that of
+each row's ``timestamp`` (the client's local date of the session). Rows
+without a usable timestamp, or dated after tomorrow by a skewed device
+clock, go to the day they were ingested. Each partition has a small
+``_partition.json`` with its row count, the rows of every file and the
+union of their columns.
+
+A training window is resolved from directory names alone, so partitions
+outside it are pruned before anything is opened, and column layouts and
+per-day counts (the dashboard chart) come from the partition metadata
+rather than from the CSVs.
+
+CSVs written before partitioning (``collected_data/processed_*.csv``) are
+split into partitions the same way by ``python partitions.py migrate``
+(falling back to the file's mtime day). Until then they have no day, so
+they are only used when training on all data; a bounded window that
+leaves them out says so.
+"""
+import os
+import re
+import glob
+import json
+import fcntl
+import argparse
+from datetime import datetime, date, timedelta
+
+import pandas as pd
+
+import ingest_writer
+
+DATA_DIR = "collected_data"
+PARTITION_DIR = os.path.join(DATA_DIR, "partitions")
+META_NAME = "_partition.json"
+DAY_FORMAT = "%Y-%m-%d"
+DAY_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+class _PartitionLock:
+    """Cross-process lock for one partition's metadata"""
+    def __init__(self, day):
+        self.path = os.path.join(partition_dir(day), ".lock")
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._f = open(self.path, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+
+def day_of(timestamp=None):
+    """Partition name for an epoch timestamp (default: now)"""
+    moment = datetime.now() if timestamp is None else datetime.fromtimestamp(timestamp)
+    return moment.strftime(DAY_FORMAT)
+
+def partition_dir(day):
+    return os.path.join(PARTITION_DIR, day)
+
+def load_meta(day):
+    """Metadata of one partition, or an empty entry"""
+    try:
+        with open(os.path.join(partition_dir(day), META_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"day": day, "rows": 0, "files": {}, "columns": []}
+
+def _record_file(day, name, rows, columns):
+    with _PartitionLock(day):
+        meta = load_meta(day)
+        meta["files"][name] = int(rows)
+        meta["rows"] = sum(meta["files"].values())
+        meta["columns"] += [c for c in columns if c not in meta["columns"]]
+        ingest_writer.write_atomic(os.path.join(partition_dir(day), META_NAME),
+                                   lambda f: json.dump(meta, f), mode='w')
+
+def row_days(df, default=None):
+    """Partition day of every row: its timestamp's date, else ``default`` (today)"""
+    default = default or day_of()
+    if "timestamp" not in df.columns:
+        return pd.Series(default, index=df.index)
+    days = pd.to_datetime(df["timestamp"].astype(str).str[:10], format=DAY_FORMAT,
+                          errors='coerce').dt.strftime(DAY_FORMAT)
+    # Tomorrow is allowed for clients east of the server
+    latest = (datetime.strptime(default, DAY_FORMAT) + timedelta(days=1)).strftime(DAY_FORMAT)
+    return days.where(days.notna() & (days <= latest), default)
+
+def write_rows(df, name=None, day=None):
+    """
+    Write processed rows into the partitions of their days; returns the file paths.
+
+    Rows without a timestamp go to ``day`` (default today). Writing the
+    same ``name`` again replaces those files and their row counts, which
+    keeps retried writes idempotent.
+    """
+    name = name or f"processed_{ingest_writer.unique_id()}.csv"
+    paths = []
+    for row_day, rows in df.groupby(row_days(df, day), sort=True):
+        os.makedirs(partition_dir(row_day), exist_ok=True)
+        paths.append(ingest_writer.write_atomic(os.path.join(partition_dir(row_day), name),
+                                                lambda f, rows=rows: rows.to_csv(f, index=False), mode='w'))
+        _record_file(row_day, name, len(rows), list(df.columns))
+    return paths
+
+def list_days(start=None, end=None):
+    """Partition days within [start, end] (inclusive ``YYYY-MM-DD`` strings), oldest first"""
+    if not os.path.isdir(PARTITION_DIR):
+        return []
+    days = sorted(d for d in os.listdir(PARTITION_DIR) if DAY_PATTERN.match(d))
+    return [d for d in days if (start is None or d >= start) and (end is None or d <= end)]
+
+def window(days=None, since=None, until=None, today=None):
+    """Turn "last ``days`` days" or explicit dates into (start, end) day strings"""
+    if days is not None:
+        today = today or date.today()
+        since = (today - timedelta(days=int(days) - 1)).strftime(DAY_FORMAT)
+    return since, until
+
+def window_files(start=None, end=None, include_legacy=None):
+    """
+    Return ``[(day, [csv paths])]`` for the partitions in the window.
+
+    Unpartitioned legacy CSVs are included (as day ``"legacy"``) only for
+    an unbounded window unless ``include_legacy`` says otherwise.
+    """
+    result = []
+    legacy = sorted(glob.glob(os.path.join(DATA_DIR, "processed_*.csv")))
+    if include_legacy if include_legacy is not None else (start is None and end is None):
+        if legacy:
+            result.append(("legacy", legacy))
+    elif legacy:
+        print(f"Leaving out {len(legacy)} unpartitioned CSVs (run 'python partitions.py migrate')")
+    for day in list_days(start, end):
+        names = sorted(load_meta(day)["files"])
+        if names:
+            result.append((day, [os.path.join(partition_dir(day), n) for n in names]))
+    return result
+
+def training_files(start=None, end=None):
+    """Flat list of the CSVs in the window"""
+    return [path for _, paths in window_files(start, end) for path in paths]
+
+def rows_per_day(start=None, end=None):
+    """``{day: rows}`` from partition metadata"""
+    return {day: load_meta(day)["rows"] for day in list_days(start, end)}
+
+def migrate_legacy(data_dir=DATA_DIR):
+    """Split loose ``processed_*.csv`` files into the partitions of their rows' days"""
+    moved = 0
+    for path in sorted(glob.glob(os.path.join(data_dir, "processed_*.csv"))):
+        try:
+            df = pd.read_csv(path)
+        except Exception as e:
+            print(f"Error loading file {path}: {str(e)}")
+            continue
+        # Rows without a timestamp keep the day the file was written
+        write_rows(df, name=os.path.basename(path), day=day_of(os.path.getmtime(path)))
+        os.remove(path)
+        moved += 1
+    return moved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage day-partitioned training data")
+    parser.add_argument("command", choices=["list", "migrate"])
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        print(f"Moved {migrate_legacy()} legacy CSV files into partitions")
+    else:
+        for day, rows in rows_per_day().items():
+            print(f"{day}  rows={rows}  files={len(load_meta(day)['files'])}")
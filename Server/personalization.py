@@ -0,0 +1,292 @@
+"""
+Per-user residual corrections on top of the global model.
+
+For every ``userId`` in the training CSVs we fit a small ridge regression
+on the residuals of the global forest (``responseTime`` minus an
+out-of-bag prediction): a bias, plus linear weights on standardized
+features once the user has enough samples. Users with few samples get a bias that is shrunk towards
+zero, so sparse users fall back to the global model.
+
+The corrections are stored in a binary file in ``output_models/``: an
+open-addressing hash table of 64-bit user-id hashes (load factor <= 0.5)
+followed by fixed-size records. ``user_residuals.json`` names the current
+file and describes its layout; replacing it is the atomic publish step.
+Serving memory-maps the file, so a lookup touches one or two table slots
+and one record regardless of how many users exist, and resident memory
+stays bounded by the pages actually used.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+
+OUTPUT_DIR = "output_models"
+RESIDUALS_META_PATH = os.path.join(OUTPUT_DIR, "user_residuals.json")
+
+RIDGE = 10.0               # penalty on the standardized feature weights
+BIAS_PRIOR = 5.0           # pseudo-samples shrinking each user's bias towards zero
+MIN_LINEAR_SAMPLES = 20    # users below this only get a bias correction
+RELOAD_CHECK_SECONDS = 5   # how often serving checks for a rebuilt file
+
+SLOT_DTYPE = np.dtype([('key', '<u8'), ('row', '<u4'), ('pad', '<u4')])
+
+def _record_dtype(n_features):
+    return np.dtype([('bias', '<f4'), ('weights', '<f4', (n_features,)), ('count', '<u4')])
+
+def user_key(user_id):
+    """Stable non-zero 64-bit hash of a user id"""
+    digest = hashlib.blake2b(str(user_id).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+def _accumulate(stats, users, X, residuals):
+    """Add per-user sufficient statistics for one chunk of rows"""
+    A = np.hstack([np.ones((len(X), 1)), X])
+    index = stats["index"]
+    rows = np.array([index.setdefault(u, len(index)) for u in users])
+    needed = len(index)
+    if needed > len(stats["count"]):
+        grow = max(needed, 2 * len(stats["count"]))
+        width = A.shape[1]
+        for name, shape in (("count", ()), ("AtA", (width, width)), ("Atr", (width,))):
+            bigger = np.zeros((grow,) + shape)
+            bigger[:len(stats[name])] = stats[name]
+            stats[name] = bigger
+    size = len(stats["count"])
+    width = A.shape[1]
+    stats["count"] += np.bincount(rows, minlength=size)
+    for j in range(width):
+        stats["Atr"][:, j] += np.bincount(rows, weights=A[:, j] * residuals, minlength=size)
+        for k in range(j, width):
+            total = np.bincount(rows, weights=A[:, j] * A[:, k], minlength=size)
+            stats["AtA"][:, j, k] += total
+            if k != j:
+                stats["AtA"][:, k, j] += total
+    stats["sum"] += X.sum(axis=0)
+    stats["sumsq"] += (X ** 2).sum(axis=0)
+    stats["n"] += len(X)
+
+def _solve(stats, n_features):
+    """Turn accumulated statistics into standardized per-user coefficients"""
+    U = len(stats["index"])
+    count = stats["count"][:U]
+    mean = stats["sum"] / stats["n"]
+    std = np.sqrt(np.maximum(stats["sumsq"] / stats["n"] - mean ** 2, 0))
+    std = np.where(std > 1e-9, std, 1.0)
+
+    # Change of basis from [1, x] to [1, (x - mean) / std]
+    M = np.zeros((n_features + 1, n_features + 1))
+    M[0, 0] = 1.0
+    M[1:, 0] = -mean / std
+    M[1:, 1:] = np.diag(1.0 / std)
+    ZtZ = M @ stats["AtA"][:U] @ M.T
+    Ztr = stats["Atr"][:U] @ M.T
+
+    penalty = np.zeros((U, n_features + 1))
+    penalty[:, 0] = BIAS_PRIOR
+    penalty[:, 1:] = np.where(count[:, None] >= MIN_LINEAR_SAMPLES, RIDGE, 1e12)
+    ZtZ[:, np.arange(n_features + 1), np.arange(n_features + 1)] += penalty
+    theta = np.linalg.solve(ZtZ, Ztr[:, :, None])[:, :, 0]
+    return theta, count, mean, std
+
+def _out_of_bag_predictions(model, X, y, frame):
+    """
+    Predictions of a copy of ``model`` for rows it did not see.
+
+    The copy is refitted on these rows with ``oob_score``; each row is
+    predicted only by the trees whose bootstrap sample left it out. The
+    served model's own predictions on its training rows are close to the
+    targets, so residuals against them would shrink towards zero.
+    """
+    reference = clone(model).set_params(oob_score=True, bootstrap=True)
+    inputs = frame if hasattr(model, 'feature_names_in_') else X
+    reference.fit(inputs, y)
+    return reference.oob_prediction_
+
+def build(csv_files, model, features, base_version, chunksize=50000):
+    """
+    Fit residual corrections for every user in ``csv_files``.
+
+    ``model`` must be a random forest: residuals are taken against
+    out-of-bag predictions of a copy refitted on these rows, like those
+    the served model makes for inputs it was not trained on. The rows are
+    held in memory for that fit, as in training.
+    """
+    n_features = len(features)
+    width = n_features + 1
+    stats = {"index": {}, "count": np.zeros(0), "AtA": np.zeros((0, width, width)),
+             "Atr": np.zeros((0, width)), "sum": np.zeros(n_features),
+             "sumsq": np.zeros(n_features), "n": 0}
+    usecols = set(features) | {'userId', 'responseTime'}
+
+    chunks = []
+    for file in csv_files:
+        try:
+            reader = pd.read_csv(file, usecols=lambda c: c in usecols, chunksize=chunksize)
+            for chunk in reader:
+                if 'userId' not in chunk.columns or 'responseTime' not in chunk.columns:
+                    break
+                chunk = chunk.reindex(columns=['userId', 'responseTime'] + list(features)).dropna()
+                if not chunk.empty:
+                    chunks.append(chunk)
+        except Exception as e:
+            print(f"Error loading file {file}: {str(e)}")
+
+    if not chunks:
+        print("No rows with userId, features and responseTime found")
+        return 0
+
+    rows = pd.concat(chunks, ignore_index=True)
+    X = rows[features].to_numpy(dtype=np.float64)
+    y = rows['responseTime'].to_numpy(dtype=np.float64)
+    residuals = y - _out_of_bag_predictions(model, X, y, rows[features])
+    _accumulate(stats, rows['userId'].astype(str).to_numpy(), X, residuals)
+
+    theta, count, mean, std = _solve(stats, n_features)
+    write_index(list(stats["index"]), theta, count, features, mean, std, base_version)
+    return len(stats["index"])
+
+def write_index(user_ids, theta, count, features, mean, std, base_version):
+    """Write the hash table and records atomically"""
+    n_users = len(user_ids)
+    n_slots = 1
+    while n_slots < 2 * max(n_users, 1):
+        n_slots *= 2
+
+    slots = np.zeros(n_slots, dtype=SLOT_DTYPE)
+    mask = n_slots - 1
+    for row, user_id in enumerate(user_ids):
+        key = user_key(user_id)
+        i = key & mask
+        while slots['key'][i] != 0:
+            i = (i + 1) & mask
+        slots['key'][i] = key
+        slots['row'][i] = row
+
+    records = np.zeros(n_users, dtype=_record_dtype(len(features)))
+    records['bias'] = theta[:, 0]
+    records['weights'] = theta[:, 1:]
+    records['count'] = count
+
+    data_file = f"user_residuals_{int(time.time())}_{os.getpid()}.bin"
+    with open(os.path.join(OUTPUT_DIR, data_file), 'wb') as f:
+        f.write(slots.tobytes())
+        f.write(records.tobytes())
+    meta = {
+        "data_file": data_file,
+        "base_version": base_version,
+        "features": list(features),
+        "mean": [float(v) for v in mean],
+        "std": [float(v) for v in std],
+        "n_users": n_users,
+        "n_slots": n_slots,
+        "created_at": time.time(),
+    }
+    tmp_meta = f"{RESIDUALS_META_PATH}.{os.getpid()}.tmp"
+    with open(tmp_meta, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta, RESIDUALS_META_PATH)
+
+    # Workers that still map an old file keep their pages until they reload
+    for name in os.listdir(OUTPUT_DIR):
+        if name.startswith("user_residuals_") and name.endswith(".bin") and name != data_file:
+            os.remove(os.path.join(OUTPUT_DIR, name))
+    return data_file
+
+class ResidualIndex:
+    """Read-only, memory-mapped view of a residual file"""
+    def __init__(self, meta_path=RESIDUALS_META_PATH):
+        with open(meta_path, 'r') as f:
+            self.meta = json.load(f)
+        path = os.path.join(os.path.dirname(meta_path), self.meta["data_file"])
+        self.features = self.meta["features"]
+        self.base_version = self.meta["base_version"]
+        self.mean = np.array(self.meta["mean"])
+        self.std = np.array(self.meta["std"])
+        n_slots = self.meta["n_slots"]
+        self.mask = n_slots - 1
+        self.slots = np.memmap(path, dtype=SLOT_DTYPE, mode='r', shape=(n_slots,))
+        self.records = np.memmap(path, dtype=_record_dtype(len(self.features)), mode='r',
+                                 offset=n_slots * SLOT_DTYPE.itemsize,
+                                 shape=(self.meta["n_users"],))
+
+    def lookup(self, user_id):
+        """Return the user's record, or None"""
+        key = user_key(user_id)
+        i = key & self.mask
+        while True:
+            slot_key = int(self.slots['key'][i])
+            if slot_key == 0:
+                return None
+            if slot_key == key:
+                return self.records[self.slots['row'][i]]
+            i = (i + 1) & self.mask
+
+    def correction(self, user_id, data):
+        """Residual to add to the global prediction for this user and input"""
+        record = self.lookup(user_id)
+        if record is None:
+            return None
+        x = np.array([float(data.get(f, np.nan)) for f in self.features])
+        z = np.nan_to_num((x - self.mean) / self.std)  # missing features contribute nothing
+        return float(record['bias'] + np.dot(record['weights'], z))
+
+    def corrections(self, user_id, columns, X):
+        """Vectorized ``correction`` for the rows of ``X`` laid out as ``columns``"""
+        record = self.lookup(user_id)
+        if record is None:
+            return None
+        positions = {c: i for i, c in enumerate(columns)}
+        Z = np.zeros((len(X), len(self.features)))
+        for j, feature in enumerate(self.features):
+            if feature in positions:
+                Z[:, j] = (X[:, positions[feature]] - self.mean[j]) / self.std[j]
+        Z = np.nan_to_num(Z)
+        return record['bias'] + Z @ record['weights']
+
+_index = {"index": None, "mtime": None, "checked": 0.0}
+
+def get_index():
+    """Return the current ResidualIndex, reopening it when the file is rebuilt"""
+    now = time.time()
+    if now - _index["checked"] >= RELOAD_CHECK_SECONDS:
+        _index["checked"] = now
+        try:
+            mtime = os.path.getmtime(RESIDUALS_META_PATH)
+        except OSError:
+            _index["index"], _index["mtime"] = None, None
+            return None
+        if mtime != _index["mtime"]:
+            try:
+                _index["index"], _index["mtime"] = ResidualIndex(), mtime
+            except Exception as e:
+                print(f"Error loading user residuals: {str(e)}")
+                _index["index"] = None
+    return _index["index"]
+
+if __name__ == "__main__":
+    import model_registry
+    import partitions
+    from features import SEED_FEATURES
+
+    parser = argparse.ArgumentParser(description="Fit per-user residual corrections")
+    parser.add_argument("--version", help="Registry version to personalize (default: CURRENT)")
+    parser.add_argument("--days", type=int, help="Only use the last N days of partitions")
+    args = parser.parse_args()
+
+    version = args.version or model_registry.current_version()
+    if not version:
+        print("No registered model version to personalize")
+        raise SystemExit(1)
+    model = model_registry.load_version(version)
+    features = (model_registry.get_metadata(version) or {}).get("features")
+    if not features:
+        features = list(getattr(model, 'feature_names_in_', [])) or SEED_FEATURES[:model.n_features_in_]
+
+    start, end = partitions.window(args.days)
+    csv_files = partitions.training_files(start, end)
+    users = build(csv_files, model, features, version)
+    print(f"Wrote residual corrections for {users} users (see {RESIDUALS_META_PATH})")
@@ -1,9 +1,29 @@
 from flask import Flask, request, jsonify, send_from_directory
 import pandas as pd
+import numpy as np
 import os
 import pickle
 import sys
+import time
+import hashlib
+import warnings
 import logging
+import threading
+from collections import OrderedDict
+import model_registry
+import admission
+import forest_intervals
+import drift
+import prediction_log
+import warmup
+import batch_protocol
+import bulk_upload
+import shadow
+import personalization
+import slot_search
+import model_distribution
+from datetime import datetime
+from features import SEED_FEATURES
 
 # Log only in the master process or the first worker
 if os.getpid() == os.getppid() or os.getpid() == os.getppid() + 1:
@@ -17,7 +37,16 @@ MODEL_PATH = "output_models/NotificationTimePredictor.mlmodel"
 SKLEARN_MODEL_PATH = "output_models/NotificationTimePredictor.pkl"
 PORT = 5001  # Changed from 5000 to avoid conflict with AirPlay
 
-DATA_UPLOAD_DIR = "uploaded_data"
+MAX_LOADED_VERSIONS = 4      # registry versions preloaded at startup
+# Loaded models per worker are evicted least recently used first beyond this
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", 1024))
+CURRENT_CHECK_SECONDS = 2    # how often the registry CURRENT pointer is re-read
+MODEL_INFO_WAIT_SECONDS = 55     # longest /model_info/wait hold (below proxy read timeouts)
+MODEL_INFO_POLL_SECONDS = 1      # how often a held request re-checks the snapshot
+MODEL_INFO_MAX_WAITERS = 4       # held requests per worker; keep below gunicorn --threads
+WARMUP_BATCH_SIZES = (1, 16, 256)    # synthetic batch sizes run through each model at startup
+
+DATA_UPLOAD_DIR = bulk_upload.UPLOAD_DIR
 os.makedirs(DATA_UPLOAD_DIR, exist_ok=True)
 
 # Try to load the model - first check if we can use CoreML
@@ -58,21 +87,296 @@ def load_model():
 model = load_model()
 model_type = "coreml" if use_coreml else "sklearn"
 
+# Registry versions loaded in this worker, least recently used first
+loaded_versions = OrderedDict()
+_residency = {}              # version -> bytes, load_ms, loaded_at, last_used, hits
+_model_counters = {"loads": 0, "evictions": 0, "resident_bytes": 0}
+_versions_lock = threading.Lock()
+_load_locks = {}
+# "current" is the version served, "target" the registry's CURRENT, which is
+# served once it is loaded and warmed ("swapping" while that runs)
+_pointers = {"current": None, "target": None, "swapping": None, "candidate": None,
+             "names": {}, "checked": 0.0}
+_swap_lock = threading.Lock()
+_model_info = {"manifest": None, "version": None, "info": None, "etag": None}
+_model_info_waiters = threading.BoundedSemaphore(MODEL_INFO_MAX_WAITERS)
+
+def _refresh_pointers():
+    now = time.time()
+    if now - _pointers["checked"] >= CURRENT_CHECK_SECONDS:
+        startup = _pointers["checked"] == 0.0
+        target = model_registry.current_version()
+        _pointers["candidate"] = model_registry.candidate_version()
+        _pointers["names"] = model_registry.list_named()
+        _pointers["checked"] = now
+        with _swap_lock:
+            _pointers["target"] = target
+            if startup or not target:
+                # At startup the warm-up loads it before /ready passes
+                _pointers["current"] = target
+            elif target != _pointers["current"] and target != _pointers["swapping"]:
+                # CURRENT appeared or was swapped (promote, rollout): keep serving
+                # the previous version until this one is loaded and warmed
+                _pointers["swapping"] = target
+                threading.Thread(target=_swap_in, args=(target,), daemon=True).start()
+
+def _swap_in(version):
+    """Load and warm a new default version in the background, then serve it"""
+    started = time.perf_counter()
+    try:
+        loaded = get_version_model(version)
+        if loaded is None:
+            raise ValueError("not in the registry")
+        warmup.run_steps(_warmup_steps(version, loaded, np.random.default_rng(0)))
+    except Exception as e:
+        # Retried on a later pointer check; the previous version stays served
+        print(f"Error loading model version {version}: {str(e)}")
+        with _swap_lock:
+            _pointers["swapping"] = None
+        return
+    with _swap_lock:
+        _pointers["swapping"] = None
+        if _pointers["target"] != version:
+            return
+        _pointers["current"] = version
+    print(f"Serving model version {version} (loaded and warmed in "
+          f"{(time.perf_counter() - started) * 1000:.0f} ms)")
+
+def default_version():
+    """Registry version served when the request does not ask for one"""
+    _refresh_pointers()
+    return _pointers["current"]
+
+def candidate_model():
+    """Return (model, version) of the shadow candidate, or (None, None)"""
+    _refresh_pointers()
+    version = _pointers["candidate"]
+    if not version:
+        return None, None
+    return get_version_model(version), version
+
+def named_version(name):
+    """Registry version served as /predict/<name>, or None"""
+    _refresh_pointers()
+    return _pointers["names"].get(name)
+
+def _evict(keep):
+    """Drop least recently used models until the budget holds; caller holds _versions_lock"""
+    budget = MODEL_MEMORY_BUDGET_MB * 1024 * 1024
+    # The default version would only be loaded again by the next request
+    pinned = {keep, _pointers["current"], _pointers["swapping"]}
+    for version in list(loaded_versions):
+        if _model_counters["resident_bytes"] <= budget:
+            break
+        if version in pinned:
+            continue
+        del loaded_versions[version]
+        _model_counters["resident_bytes"] -= _residency.pop(version)["bytes"]
+        _model_counters["evictions"] += 1
+        print(f"Evicted model version {version} (memory budget {MODEL_MEMORY_BUDGET_MB:g} MB)")
+
+def get_version_model(version):
+    """Return the model for a registry version, loading it on first use"""
+    with _versions_lock:
+        if version in loaded_versions:
+            loaded_versions.move_to_end(version)
+            _residency[version]["last_used"] = time.time()
+            _residency[version]["hits"] += 1
+            return loaded_versions[version]
+    # Unknown versions (e.g. from ?version=) get no load lock, so they cannot pile up
+    if model_registry.get_metadata(version) is None:
+        return None
+    with _versions_lock:
+        load_lock = _load_locks.setdefault(version, threading.Lock())
+    
+    # One thread loads a version; concurrent requests for it wait instead of loading it again
+    with load_lock:
+        try:
+            with _versions_lock:
+                if version in loaded_versions:
+                    _residency[version]["hits"] += 1
+                    return loaded_versions[version]
+            start_time = time.perf_counter()
+            loaded = model_registry.load_version(version)
+            load_ms = (time.perf_counter() - start_time) * 1000
+            # The pickle size tracks the in-memory size of the model's arrays
+            size = os.path.getsize(model_registry.model_path(version))
+            
+            with _versions_lock:
+                loaded_versions[version] = loaded
+                loaded_versions.move_to_end(version)
+                now = time.time()
+                _residency[version] = {"bytes": size, "load_ms": round(load_ms, 2), "loaded_at": now,
+                                       "last_used": now, "hits": 1}
+                _model_counters["resident_bytes"] += size
+                _model_counters["loads"] += 1
+                _evict(version)
+        finally:
+            with _versions_lock:
+                _load_locks.pop(version, None)
+    return loaded
+
+def residency():
+    """Which models this worker holds in memory, against the budget"""
+    with _versions_lock:
+        loaded = {version: dict(entry) for version, entry in _residency.items()}
+        return {
+            "budget_bytes": int(MODEL_MEMORY_BUDGET_MB * 1024 * 1024),
+            "resident_bytes": _model_counters["resident_bytes"],
+            "loads": _model_counters["loads"],
+            "evictions": _model_counters["evictions"],
+            "loaded": loaded,
+        }
+
+def resolve_model(version=None):
+    """Return (model, model_type, version) for a requested or the default version"""
+    version = version or default_version()
+    if version:
+        return get_version_model(version), "sklearn", version
+    # No registry yet: fall back to the model file loaded at startup
+    return model, model_type, None
+
+_drift_reference = {"version": None, "prepared": None}
+
+def drift_reference(version):
+    """Prepared training sketch of a registry version, or None if it has none"""
+    if not version:
+        return None
+    if _drift_reference["version"] != version:
+        metadata = model_registry.get_metadata(version) or {}
+        sketch = metadata.get("drift_sketch")
+        _drift_reference.update(version=version, prepared=drift.prepare(sketch) if sketch else None)
+    return _drift_reference["prepared"]
+
+def missing_features(model, data):
+    """Features the model was fitted with that a request does not provide"""
+    return [c for c in slot_search.model_columns(model, SEED_FEATURES) if c not in data]
+
+def feature_frame(model, data):
+    """One-row DataFrame in the column order the model was fitted with"""
+    features = pd.DataFrame([data])
+    names = getattr(model, 'feature_names_in_', None)
+    if names is not None:
+        features = features.reindex(columns=names)
+    return features
+
+def preload_versions():
+    """Load the default version plus the most recent ones so switching is instant"""
+    # Named models are loaded lazily, on their first request
+    named = set(model_registry.list_named().values())
+    wanted = [default_version(), model_registry.candidate_version()] + \
+        [m["version"] for m in model_registry.list_versions() if m["version"] not in named]
+    for version in [v for v in dict.fromkeys(wanted) if v][:MAX_LOADED_VERSIONS]:
+        try:
+            get_version_model(version)
+        except Exception as e:
+            print(f"Error loading model version {version}: {str(e)}")
+
+def _synthetic_rows(columns, rows, rng):
+    """Plausible feature rows: whole time values in range, device readings in [0, 1]"""
+    X = rng.random((rows, len(columns)))
+    limits = {'dayOfWeek': 7, 'hourOfDay': 24, 'minuteOfHour': 60}
+    for i, column in enumerate(columns):
+        if column in limits:
+            X[:, i] = np.floor(X[:, i] * limits[column])
+    return X
+
+def _warmup_steps(label, served_model, rng):
+    """Warm-up steps for one model: synthetic batches, a single row, intervals, slot search"""
+    columns = slot_search.model_columns(served_model, SEED_FEATURES)
+    named = hasattr(served_model, 'feature_names_in_')
+    for rows in WARMUP_BATCH_SIZES:
+        X = _synthetic_rows(columns, rows, rng)
+        inputs = pd.DataFrame(X, columns=columns) if named else X
+        yield f"{label}:predict_{rows}", lambda m=served_model, inputs=inputs: m.predict(inputs)
+    row = dict(zip(columns, _synthetic_rows(columns, 1, rng)[0]))
+    yield f"{label}:single_row", lambda m=served_model: m.predict(feature_frame(m, row))
+    if forest_intervals.supports(served_model):
+        yield f"{label}:intervals", lambda m=served_model, X=X: forest_intervals.intervals(m, X)
+    # Default horizon and step of /optimal_slots, so its week matrix is cached
+    yield f"{label}:optimal_slots", lambda m=served_model: slot_search.search(m, columns, row)
+
+def warmup_tasks():
+    """Warm-up steps: every served model on synthetic batches, plus the request-path caches"""
+    rng = np.random.default_rng(0)
+    primary, primary_type, version = resolve_model(None)
+    served = []
+    if primary is not None and primary_type == "sklearn":
+        served.append((version or "default", primary))
+    candidate, candidate_version = candidate_model()
+    if candidate is not None:
+        served.append((candidate_version, candidate))
+    
+    for label, served_model in served:
+        yield from _warmup_steps(label, served_model, rng)
+    
+    if primary is None:
+        return
+    yield "personalization", personalization.get_index
+    yield "drift_sketch", lambda: drift_reference(version)
+    def encode_json():
+        with app.app_context():
+            jsonify({"prediction": 0.0, "model_type": primary_type, "version": version})
+    yield "json", encode_json
+
+preload_versions()
+shadow.start(candidate_model)
+warmup.start(warmup_tasks)
+
 # Serve the web interface
 @app.route('/')
 def index():
     return send_from_directory('static', 'index.html')
 
 @app.route('/predict', methods=['POST'])
-def predict():
+@app.route('/predict/<model_name>', methods=['POST'])
+@admission.guarded
+def predict(model_name=None):
+    requested_version = request.args.get('version')
+    if model_name is not None:
+        # Named models load on first use; shadowing and drift follow the default model only
+        requested_version = named_version(model_name)
+        if requested_version is None:
+            return jsonify({"error": f"Unknown model: {model_name}"}), 404
+    try:
+        model, model_type, version = resolve_model(requested_version)
+    except Exception as e:
+        return jsonify({"error": f"Error loading model version {requested_version}: {str(e)}"}), 500
+    
     if model is None:
+        if requested_version:
+            return jsonify({"error": f"Unknown model version: {requested_version}"}), 404
         return jsonify({"error": "No model available for prediction"}), 404
     
+    if request.mimetype in batch_protocol.CONTENT_TYPES:
+        return predict_batch(model, model_type, version, monitored=not requested_version)
+    
     # Get features from request
     data = request.json
     
     if not data:
         return jsonify({"error": "No data provided"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    
+    # userId selects a personal correction; it is not a model feature
+    user_id = data.pop('userId', None)
+    if model_type == "sklearn":
+        # Filling absent features with NaN would predict from made-up inputs
+        missing = missing_features(model, data)
+        if missing:
+            return jsonify({"error": f"Missing features: {', '.join(missing)}"}), 400
+    personalized = False
+    
+    # ?intervals=1[&quantiles=0.1,0.9] adds a band from the spread of the trees
+    want_interval = request.args.get('intervals', '').lower() in ('1', 'true')
+    if want_interval:
+        try:
+            quantiles = forest_intervals.parse_quantiles(request.args.get('quantiles'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if model_type != "sklearn" or not forest_intervals.supports(model):
+            return jsonify({"error": "Prediction intervals need a random forest model"}), 400
     
     try:
         if model_type == "coreml":
@@ -83,26 +387,239 @@ def predict():
         else:
             # Scikit-learn prediction
             # Convert to dataframe with expected features
-            features = pd.DataFrame([data])
-            prediction = model.predict(features)[0]
+            features = feature_frame(model, data)
+            start_time = time.perf_counter()
+            if want_interval:
+                # One traversal gives every tree's output; their mean is the prediction
+                interval = forest_intervals.intervals(model, features.to_numpy(dtype=np.float32), quantiles)
+                prediction = interval["mean"][0]
+            else:
+                prediction = model.predict(features)[0]
             result = float(prediction)
+            
+            # Offer live default-version traffic to the shadow candidate
+            if not requested_version and _pointers["candidate"]:
+                shadow.submit(features, result, time.perf_counter() - start_time, version)
+            
+            # Count the inputs against the served model's training distribution
+            reference = None if requested_version else drift_reference(version)
+            if reference is not None:
+                drift.observe(reference, data)
+            
+            # Per-user residual correction fitted against this model version
+            if user_id is not None and version:
+                residuals = personalization.get_index()
+                if residuals is not None and residuals.base_version == version:
+                    correction = residuals.correction(user_id, data)
+                    if correction is not None:
+                        result += correction
+                        personalized = True
         
-        return jsonify({
+        # Keep what was served so it can be joined with the outcome users report
+        prediction_log.record(version, user_id, data, result)
+        
+        response = {
             "prediction": result,
             "model_type": model_type,
+            "version": version,
+            "personalized": personalized,
             "status": "success"
-        })
+        }
+        if want_interval:
+            # The band moves with the personal correction; its width is the forest's
+            shift = result - float(interval["mean"][0])
+            response["interval"] = {
+                "mean": result,
+                "std": float(interval["std"][0]),
+                "quantiles": {str(q): float(v[0]) + shift for q, v in interval["quantiles"].items()},
+            }
+        return jsonify(response)
         
     except Exception as e:
         return jsonify({"error": f"{str(e)}", "model_type": model_type}), 500
 
+def predict_batch(model, model_type, version, monitored=True):
+    """Score a binary float32 (or msgpack) matrix in one call, see batch_protocol"""
+    if model_type != "sklearn":
+        return jsonify({"error": "Binary batch prediction needs a scikit-learn model"}), 400
+    try:
+        columns, matrix = batch_protocol.decode(request.mimetype, request.headers,
+                                                request.get_data(cache=False))
+        X = batch_protocol.model_matrix(columns, matrix, slot_search.model_columns(model, SEED_FEATURES))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    
+    reference = drift_reference(version) if monitored else None
+    if reference is not None:
+        drift.observe_matrix(reference, columns, matrix)
+    
+    if request.args.get('intervals', '').lower() in ('1', 'true'):
+        # Columns mean, std, then one per quantile (named in X-Columns)
+        try:
+            quantiles = forest_intervals.parse_quantiles(request.args.get('quantiles'))
+            if not forest_intervals.supports(model):
+                raise ValueError("Prediction intervals need a random forest model")
+            interval = forest_intervals.intervals(model, X, quantiles)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        names = ["mean", "std"] + [f"q{q:g}" for q in interval["quantiles"]]
+        result = np.column_stack([interval["mean"], interval["std"], *interval["quantiles"].values()])
+        prediction_log.record_batch(version, columns, matrix, interval["mean"])
+        return batch_protocol.encode(request.mimetype, result, version, names)
+    
+    if len(X) == 0:
+        return batch_protocol.encode(request.mimetype, [], version)
+    try:
+        with warnings.catch_warnings():
+            # Columns were already put in the fitted order, names would only add a copy
+            warnings.simplefilter("ignore", UserWarning)
+            predictions = model.predict(X)
+    except Exception as e:
+        return jsonify({"error": f"{str(e)}", "model_type": model_type}), 500
+    prediction_log.record_batch(version, columns, matrix, predictions)
+    return batch_protocol.encode(request.mimetype, predictions, version)
+
+@app.route('/optimal_slots', methods=['POST'])
+@admission.guarded
+def optimal_slots():
+    """Return the top-k send times over a horizon for the given device state"""
+    data = request.json
+    if not data:
+        return jsonify({"error": "No data provided"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    
+    requested_version = request.args.get('version')
+    try:
+        model, model_type, version = resolve_model(requested_version)
+    except Exception as e:
+        return jsonify({"error": f"Error loading model version {requested_version}: {str(e)}"}), 500
+    if model is None or model_type != "sklearn":
+        return jsonify({"error": "No model available for prediction"}), 404
+    
+    # Control fields; everything else is device state
+    data = dict(data)
+    user_id = data.pop('userId', None)
+    horizon_hours = data.pop('horizonHours', 24)
+    step_minutes = data.pop('stepMinutes', 15)
+    top_k = data.pop('topK', 5)
+    start = data.pop('start', None)
+    # Time features come from each slot; device state must be complete
+    missing = [c for c in missing_features(model, data) if c not in slot_search.TIME_FEATURES]
+    if missing:
+        return jsonify({"error": f"Missing features: {', '.join(missing)}"}), 400
+    
+    residuals = None
+    if user_id is not None and version:
+        residuals = personalization.get_index()
+        if residuals is not None and residuals.base_version != version:
+            residuals = None
+    
+    try:
+        start = datetime.fromisoformat(start) if start else None
+        columns = slot_search.model_columns(model, SEED_FEATURES)
+        slots, evaluated = slot_search.search(
+            model, columns, data, start=start,
+            horizon_hours=float(horizon_hours), step_minutes=int(step_minutes),
+            top_k=int(top_k), residuals=residuals, user_id=user_id,
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"{str(e)}", "model_type": model_type}), 500
+    
+    return jsonify({
+        "slots": slots,
+        "evaluated": evaluated,
+        "version": version,
+        "personalized": residuals is not None,
+        "status": "success"
+    })
+
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({"status": "ok", "model_available": model is not None})
+    return jsonify({"status": "ok", "model_available": model is not None or bool(loaded_versions)})
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe: 200 only once a model is loaded and this worker has warmed up"""
+    if model is None and not loaded_versions:
+        return jsonify({"ready": False, "reason": "No model loaded"}), 503
+    status = warmup.status()
+    if not warmup.ready():
+        return jsonify({"ready": False, "reason": "Warming up", "warmup": status}), 503
+    return jsonify({"ready": True, "warmup": status["state"], "warmup_ms": status["duration_ms"]})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Operational counters for monitoring"""
+    return jsonify({
+        "admission": admission.stats(),
+        "prediction_log": prediction_log.stats(),
+        "warmup": warmup.status(),
+        "models": residency(),
+    })
+
+@app.route('/drift', methods=['GET'])
+def drift_scores():
+    """How far recent /predict inputs have moved from the served model's training data"""
+    version = default_version()
+    reference = drift_reference(version)
+    if reference is None:
+        return jsonify({"error": "The served model has no training sketch, retrain it to monitor drift"}), 404
+    try:
+        scores = drift.scores(reference, detail=request.args.get('detail', '').lower() in ('1', 'true'))
+    except OSError as e:
+        return jsonify({"error": f"Drift state unavailable: {str(e)}"}), 503
+    scores["version"] = version
+    return jsonify(scores)
+
+@app.route('/shadow/summary', methods=['GET'])
+def shadow_summary():
+    """Compare the shadow candidate against the served model on sampled traffic"""
+    summary = shadow.summary(request.args.get('version'))
+    summary["primary_version"] = default_version()
+    summary["candidate_version"] = _pointers["candidate"]
+    return jsonify(summary)
+
+@app.route('/versions', methods=['GET'])
+def versions():
+    """List registered model versions and which ones this worker has loaded"""
+    current = default_version()
+    result = []
+    for metadata in model_registry.list_versions():
+        entry = dict(metadata)
+        entry["current"] = metadata["version"] == current
+        entry["loaded"] = metadata["version"] in loaded_versions
+        result.append(entry)
+    return jsonify({"current": current, "versions": result})
+
+@app.route('/models', methods=['GET'])
+def models():
+    """Named models, the versions behind them and what this worker keeps in memory"""
+    current = default_version()
+    state = residency()
+    routes = [("/predict", None, current)] + \
+        [(f"/predict/{name}", name, version) for name, version in _pointers["names"].items()]
+    result = []
+    for route, name, version in routes:
+        entry = {"route": route, "name": name, "version": version}
+        loaded = state["loaded"].get(version)
+        entry["loaded"] = loaded is not None
+        if loaded is not None:
+            entry.update(loaded)
+        result.append(entry)
+    return jsonify({
+        "models": result,
+        "budget_bytes": state["budget_bytes"],
+        "resident_bytes": state["resident_bytes"],
+        "loads": state["loads"],
+        "evictions": state["evictions"],
+    })
 
 @app.route('/upload_data', methods=['POST'])
 def upload_data():
-    """Endpoint to upload user-contributed data"""
+    """Ingest a user-contributed CSV or NDJSON file, streamed chunk by chunk"""
     if 'file' not in request.files:
         return jsonify({"error": "No file provided"}), 400
     
@@ -110,51 +627,158 @@ def upload_data():
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
     
-    file_path = os.path.join(DATA_UPLOAD_DIR, file.filename)
-    file.save(file_path)
-    return jsonify({"message": "Data uploaded successfully"}), 200
+    try:
+        state = bulk_upload.ingest_stream(file.stream, file.filename, request.form.get('format'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"message": "Data uploaded successfully", **bulk_upload.public_state(state)}), 200
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload: {"filename": ..., "size": ..., "format": "csv"|"ndjson"}"""
+    params = request.get_json(silent=True) or {}
+    try:
+        state = bulk_upload.create_upload(params.get('filename'), params.get('size'), params.get('format'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(bulk_upload.public_state(state)), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Offset to resume from, and rows accepted/rejected so far"""
+    state = bulk_upload.get_upload(upload_id)
+    if state is None:
+        return jsonify({"error": "Unknown upload"}), 404
+    return jsonify(bulk_upload.public_state(state))
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Append one chunk; requires an Upload-Offset header (Upload-Complete: 1 on the last one)"""
+    if bulk_upload.get_upload(upload_id) is None:
+        return jsonify({"error": "Unknown upload"}), 404
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Upload-Offset header is required"}), 400
+    too_large = {"error": f"Chunks are limited to {bulk_upload.MAX_CHUNK_BYTES} bytes"}
+    if (request.content_length or 0) > bulk_upload.MAX_CHUNK_BYTES:
+        return jsonify(too_large), 413
+    # Chunked transfer encoding sends no Content-Length, so never read past the limit
+    payload = request.stream.read(bulk_upload.MAX_CHUNK_BYTES + 1)
+    if len(payload) > bulk_upload.MAX_CHUNK_BYTES:
+        return jsonify(too_large), 413
+    
+    last = request.headers.get('Upload-Complete', '').lower() in ('1', 'true')
+    try:
+        state = bulk_upload.append_chunk(upload_id, offset, payload, last)
+    except bulk_upload.UnknownUpload:
+        return jsonify({"error": "Unknown upload"}), 404
+    except bulk_upload.OffsetMismatch as e:
+        return jsonify({"error": str(e), "offset": e.expected}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(bulk_upload.public_state(state))
 
 @app.route('/download_model', methods=['GET'])
 def download_model():
     """Endpoint to download the latest global model"""
     model_type = request.args.get('type', 'sklearn')
-    model_path = SKLEARN_MODEL_PATH if model_type == 'sklearn' else MODEL_PATH
+    kind = 'sklearn' if model_type == 'sklearn' else 'coreml'
+    model_path = SKLEARN_MODEL_PATH if kind == 'sklearn' else MODEL_PATH
     
-    if os.path.exists(model_path):
-        return send_from_directory('output_models', os.path.basename(model_path), as_attachment=True)
-    else:
+    response = model_distribution.send_published(kind, os.path.basename(model_path))
+    if response is None:
         return jsonify({"error": "Model not available"}), 404
+    return response
 
 # Add model info endpoint to check if new model is available
-@app.route('/model_info', methods=['GET'])
-def model_info():
-    """Returns information about available models and their versions"""
+def model_info_snapshot():
+    """
+    Return (info, etag) describing the published models.
+
+    Built from the download manifest, which workers re-read only when it
+    changes, so answering /model_info never touches the model files. The
+    served version switches only once a new default is warmed, after the
+    manifest changed, so it is part of the snapshot's key and ETag.
+    """
+    manifest = model_distribution.get_manifest()
+    version = default_version()
+    if manifest is not None and manifest is _model_info["manifest"] and version == _model_info["version"]:
+        return _model_info["info"], _model_info["etag"]
+    
     info = {
         "available_models": [],
-        "latest_update": None
+        "latest_update": None,
+        "published_at": manifest["published_at"] if manifest else None,
+        "version": version,
     }
-    
-    # Check CoreML model
-    if os.path.exists(MODEL_PATH):
-        model_stats = os.stat(MODEL_PATH)
+    files = manifest["files"] if manifest else {}
+    for kind in ("coreml", "sklearn"):
+        entry = files.get(kind)
+        if entry is None:
+            continue
         info["available_models"].append({
-            "type": "coreml",
-            "size_bytes": model_stats.st_size,
-            "last_modified": model_stats.st_mtime,
+            "type": kind,
+            "size_bytes": entry["size"],
+            "last_modified": entry["mtime"],
+            "sha256": entry["sha256"],
         })
-        info["latest_update"] = max(info["latest_update"] or 0, model_stats.st_mtime)
+        info["latest_update"] = max(info["latest_update"] or 0, entry["mtime"])
     
-    # Check sklearn model
-    if os.path.exists(SKLEARN_MODEL_PATH):
-        model_stats = os.stat(SKLEARN_MODEL_PATH)
-        info["available_models"].append({
-            "type": "sklearn",
-            "size_bytes": model_stats.st_size,
-            "last_modified": model_stats.st_mtime,
-        })
-        info["latest_update"] = max(info["latest_update"] or 0, model_stats.st_mtime)
+    identity = "|".join([f"version:{version}"] +
+                        [f"{m['type']}:{m['sha256']}" for m in info["available_models"]])
+    etag = hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+    if manifest is not None:
+        _model_info.update(manifest=manifest, version=version, info=info, etag=etag)
+    return info, etag
+
+def model_info_response(info, etag):
+    response = jsonify(info)
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/model_info', methods=['GET'])
+def model_info():
+    """Returns information about available models and their versions"""
+    info, etag = model_info_snapshot()
+    if model_distribution.etag_matches(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+    return model_info_response(info, etag)
+
+@app.route('/model_info/wait', methods=['GET'])
+def model_info_wait():
+    """
+    Long-poll for a newly published model.
+
+    Returns the new /model_info as soon as its ETag differs from ``since``
+    (immediately if it already does), or 304 after ``timeout`` seconds.
+    """
+    since = request.args.get('since', '').strip('"')
+    try:
+        timeout = min(max(float(request.args.get('timeout', MODEL_INFO_WAIT_SECONDS)), 0),
+                      MODEL_INFO_WAIT_SECONDS)
+    except ValueError:
+        return jsonify({"error": "timeout must be a number of seconds"}), 400
+    
+    info, etag = model_info_snapshot()
+    if etag != since:
+        return model_info_response(info, etag)
     
-    return jsonify(info)
+    # Each waiter holds a worker thread, so leave the rest for predictions
+    if not _model_info_waiters.acquire(blocking=False):
+        return jsonify({"error": "Too many clients waiting for model updates"}), 503, \
+            {'Retry-After': str(int(MODEL_INFO_WAIT_SECONDS))}
+    try:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(min(MODEL_INFO_POLL_SECONDS, max(deadline - time.time(), 0)))
+            info, etag = model_info_snapshot()
+            if etag != since:
+                return model_info_response(info, etag)
+    finally:
+        _model_info_waiters.release()
+    return '', 304, {'ETag': f'"{etag}"'}
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,254 @@
+"""
+Append-only binary log of served predictions.
+
+Every prediction is one fixed-size 64-byte record (RECORD_DTYPE): time,
+64-bit hash of the ``userId`` (0 when anonymous), model version, the
+LOG_FEATURES vector (NaN when absent) and the prediction. The request
+path only copies the values into a preallocated in-memory buffer. A
+background thread appends full or stale buffers to this worker's active
+segment in ``collected_data/predictions/``. When the buffer is full
+because the disk is behind, records are dropped and counted rather than
+making the request wait. Segments roll over by size and are deleted after
+RETENTION_DAYS.
+
+Segments are raw record arrays, so readers ``np.memmap`` them directly.
+``join`` matches training rows (``userId`` + ``timestamp``) to the last
+prediction served to that user shortly before, which lets ``train_model``
+measure how the served models did on the outcomes users reported.
+"""
+import os
+import glob
+import time
+import atexit
+import threading
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+from personalization import user_key
+
+LOG_DIR = os.path.join("collected_data", "predictions")
+LOG_FEATURES = ['dayOfWeek', 'hourOfDay', 'minuteOfHour', 'device_activity', 'device_batteryLevel',
+                'device_screenActive', 'device_appInForeground', 'device_audioPlaying']
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('user', '<u8'), ('version', 'S12'),
+                         ('features', '<f4', (len(LOG_FEATURES),)), ('prediction', '<f4')])
+
+BUFFER_RECORDS = 8192              # records held in memory per worker
+FLUSH_SECONDS = 1.0                # max age of a buffered record
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+RETENTION_DAYS = 30
+JOIN_WINDOW_SECONDS = 6 * 3600     # how long before an outcome its prediction may have been served
+TIMING_SAMPLES = 2000              # per-request costs kept for stats()
+
+_buffer = np.zeros(BUFFER_RECORDS, dtype=RECORD_DTYPE)
+_fill = 0
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+_wake = threading.Event()
+_writer = {"pid": None, "thread": None, "segment": None, "seq": 0}
+_counters = {"logged": 0, "written": 0, "dropped": 0, "write_errors": 0}
+_cost_us = deque(maxlen=TIMING_SAMPLES)   # wall clock, including waits for the GIL
+_cpu_us = deque(maxlen=TIMING_SAMPLES)    # CPU time of the request thread
+_nan_features = np.full(len(LOG_FEATURES), np.nan, dtype=np.float32)
+
+def _ensure_writer():
+    """Start the writer thread once per process (again after a fork)"""
+    if _writer["pid"] == os.getpid() and _writer["thread"].is_alive():
+        return
+    _writer.update(pid=os.getpid(), segment=None)
+    _writer["thread"] = threading.Thread(target=_run, name="prediction-log", daemon=True)
+    _writer["thread"].start()
+
+def _take(count):
+    """Reserve ``count`` buffer rows; returns the start index or None if full"""
+    global _fill
+    if _fill + count > BUFFER_RECORDS:
+        _counters["dropped"] += count
+        return None
+    start = _fill
+    _fill += count
+    _counters["logged"] += count
+    if _fill >= BUFFER_RECORDS // 2:
+        _wake.set()
+    return start
+
+def record(version, user_id, data, prediction):
+    """Log one served prediction (``data`` maps feature names to values)"""
+    started, started_cpu = time.perf_counter(), time.thread_time()
+    features = _nan_features.copy()
+    for i, name in enumerate(LOG_FEATURES):
+        value = data.get(name)
+        if value is not None:
+            try:
+                features[i] = value
+            except (TypeError, ValueError):
+                pass
+    user = user_key(user_id) if user_id is not None else 0
+    with _lock:
+        _ensure_writer()
+        i = _take(1)
+        if i is not None:
+            _buffer[i] = (time.time(), user, (version or "").encode('ascii'), features, prediction)
+    _cost_us.append((time.perf_counter() - started) * 1e6)
+    _cpu_us.append((time.thread_time() - started_cpu) * 1e6)
+
+def record_batch(version, columns, matrix, predictions):
+    """Log a batch of anonymous predictions (``columns`` name the matrix columns)"""
+    started, started_cpu = time.perf_counter(), time.thread_time()
+    positions = {c: j for j, c in enumerate(columns)}
+    with _lock:
+        _ensure_writer()
+        i = _take(len(predictions))
+        if i is not None:
+            rows = _buffer[i:i + len(predictions)]
+            rows['timestamp'] = time.time()
+            rows['user'] = 0
+            rows['version'] = (version or "").encode('ascii')
+            rows['features'] = np.nan
+            for k, name in enumerate(LOG_FEATURES):
+                if name in positions:
+                    rows['features'][:, k] = matrix[:, positions[name]]
+            rows['prediction'] = predictions
+    _cost_us.append((time.perf_counter() - started) * 1e6)
+    _cpu_us.append((time.thread_time() - started_cpu) * 1e6)
+
+def _segment_path():
+    """Active segment of this worker, rolled over by size"""
+    path = _writer["segment"]
+    if path is None or not os.path.exists(path) or os.path.getsize(path) >= SEGMENT_MAX_BYTES:
+        _writer["seq"] += 1
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(LOG_DIR, f"predictions_{stamp}_{os.getpid()}_{_writer['seq']}.bin")
+        _writer["segment"] = path
+        _prune()
+    return path
+
+def _prune():
+    cutoff = time.time() - RETENTION_DAYS * 86400
+    for path in glob.glob(os.path.join(LOG_DIR, "predictions_*.bin")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def flush():
+    """Append everything buffered to the active segment"""
+    global _fill
+    with _write_lock:
+        with _lock:
+            pending = _buffer[:_fill].tobytes()
+            _fill = 0
+        if not pending:
+            return 0
+        try:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            fd = os.open(_segment_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, pending)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            _counters["write_errors"] += 1
+            print(f"Error writing prediction log: {str(e)}")
+            return 0
+        written = len(pending) // RECORD_DTYPE.itemsize
+        _counters["written"] += written
+        return written
+
+def _run():
+    while True:
+        _wake.wait(FLUSH_SECONDS)
+        _wake.clear()
+        flush()
+
+atexit.register(flush)
+
+def segments(since=None):
+    """Segment paths, oldest first, skipping those last written before ``since``"""
+    paths = sorted(glob.glob(os.path.join(LOG_DIR, "predictions_*.bin")), key=os.path.getmtime)
+    return [p for p in paths if since is None or os.path.getmtime(p) >= since]
+
+def open_segment(path):
+    """Read-only memory map of a segment's complete records"""
+    count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+
+def load(since=None, fields=('timestamp', 'user', 'version', 'prediction')):
+    """Records of all segments as one array holding only ``fields``"""
+    dtype = np.dtype([(f, RECORD_DTYPE.fields[f][0]) for f in fields])
+    parts = []
+    for path in segments(since):
+        records = open_segment(path)
+        if since is not None:
+            records = records[records['timestamp'] >= since]
+        part = np.empty(len(records), dtype=dtype)
+        for f in fields:
+            part[f] = records[f]
+        parts.append(part)
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+
+def join(users, timestamps, log=None, window_seconds=JOIN_WINDOW_SECONDS):
+    """
+    Index into ``log`` of the last prediction served to each user at most
+    ``window_seconds`` before each timestamp, or -1.
+
+    ``users`` are ``userId`` values and ``timestamps`` epoch seconds.
+    """
+    keys = np.array([user_key(u) if u == u and u is not None else 0 for u in users], dtype=np.uint64)
+    return join_keys(keys, timestamps, log, window_seconds)
+
+def join_keys(keys, timestamps, log=None, window_seconds=JOIN_WINDOW_SECONDS):
+    """``join`` for users already hashed with ``user_key`` (0 for none)"""
+    keys = np.asarray(keys, dtype=np.uint64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if log is None:
+        log = load(since=np.nanmin(timestamps) - window_seconds if len(timestamps) else None)
+    result = np.full(len(timestamps), -1, dtype=np.int64)
+    if len(log) == 0 or len(timestamps) == 0:
+        return result
+
+    # One sortable number per (user, time): dense user rank, then seconds
+    known, user_rank = np.unique(log['user'], return_inverse=True)
+    row_rank = np.searchsorted(known, keys)
+    matched = (keys != 0) & (row_rank < len(known))
+    matched[matched] = known[row_rank[matched]] == keys[matched]
+    origin = min(float(log['timestamp'].min()), float(np.nanmin(timestamps))) - window_seconds
+    span = max(float(log['timestamp'].max()), float(np.nanmax(timestamps))) - origin + 1.0
+    log_order = user_rank * span + (log['timestamp'] - origin)
+    order = np.argsort(log_order, kind='stable')
+    sorted_order = log_order[order]
+
+    query = row_rank[matched] * span + (timestamps[matched] - origin)
+    k = np.searchsorted(sorted_order, query, side='right') - 1
+    k_valid = k >= 0
+    candidate = order[np.where(k_valid, k, 0)]
+    ok = k_valid & (log['user'][candidate] == keys[matched]) & \
+        (timestamps[matched] - log['timestamp'][candidate] <= window_seconds)
+    rows = np.flatnonzero(matched)
+    result[rows[ok]] = candidate[ok]
+    return result
+
+def stats():
+    """
+    Counters and the per-request logging cost in microseconds (this worker).
+
+    ``cost_us`` is wall-clock time; with several request threads it
+    includes waiting for the GIL, which ``cpu_us`` leaves out.
+    """
+    percentile = lambda samples, q: round(float(np.percentile(samples, q)), 2) if samples else None
+    costs, cpu = list(_cost_us), list(_cpu_us)
+    with _lock:
+        buffered = _fill
+    return {
+        **_counters,
+        "buffered": buffered,
+        "record_bytes": RECORD_DTYPE.itemsize,
+        "cost_us_p50": percentile(costs, 50),
+        "cost_us_p99": percentile(costs, 99),
+        "cpu_us_p50": percentile(cpu, 50),
+        "cpu_us_p99": percentile(cpu, 99),
+    }
@@ -0,0 +1,108 @@
+"""
+Shadow evaluation of a candidate model on live /predict traffic.
+
+The request path only samples (one ``random()`` call) and hands the
+already-built feature frame to a bounded queue with ``put_nowait``; a
+background thread scores it with the candidate model. When the queue is
+full the sample is dropped rather than slowing the response. Results are
+kept in a fixed-size ring buffer, and the time spent on the request path
+is itself recorded so the overhead can be checked against the cap.
+
+State is per worker process; ``summary()`` reports what this worker saw.
+"""
+import time
+import queue
+import random
+import threading
+from collections import deque
+
+import numpy as np
+
+SAMPLE_RATE = 0.1          # fraction of live requests scored by the candidate
+QUEUE_SIZE = 256           # pending shadow jobs before samples are dropped
+BUFFER_SIZE = 2000         # comparisons kept for the summary
+
+_jobs = queue.Queue(maxsize=QUEUE_SIZE)
+_results = deque(maxlen=BUFFER_SIZE)
+_overhead_us = deque(maxlen=BUFFER_SIZE)
+_counters = {"seen": 0, "sampled": 0, "dropped": 0, "errors": 0}
+_lock = threading.Lock()
+_worker = None
+_load_candidate = None
+
+def start(load_candidate):
+    """
+    Start the background scorer.
+
+    ``load_candidate()`` must return ``(model, version)`` for the current
+    candidate, or ``(None, None)`` when shadowing is off.
+    """
+    global _worker, _load_candidate
+    _load_candidate = load_candidate
+    if _worker is None or not _worker.is_alive():
+        _worker = threading.Thread(target=_run, name="shadow-scorer", daemon=True)
+        _worker.start()
+
+def submit(features, primary_prediction, primary_latency, primary_version):
+    """Offer one served request for shadow scoring; never blocks"""
+    start_time = time.perf_counter()
+    with _lock:
+        _counters["seen"] += 1
+    if random.random() < SAMPLE_RATE and _load_candidate is not None:
+        if not _worker.is_alive():
+            # Threads do not survive a fork (e.g. gunicorn --preload)
+            start(_load_candidate)
+        try:
+            _jobs.put_nowait((features, primary_prediction, primary_latency, primary_version))
+            with _lock:
+                _counters["sampled"] += 1
+        except queue.Full:
+            with _lock:
+                _counters["dropped"] += 1
+    _overhead_us.append((time.perf_counter() - start_time) * 1e6)
+
+def _run():
+    while True:
+        features, primary_prediction, primary_latency, primary_version = _jobs.get()
+        try:
+            candidate, version = _load_candidate()
+            if candidate is None or version == primary_version:
+                continue
+            start_time = time.perf_counter()
+            prediction = float(candidate.predict(features)[0])
+            latency = time.perf_counter() - start_time
+            _results.append({
+                "version": version,
+                "delta": prediction - primary_prediction,
+                "primary_latency_ms": primary_latency * 1000,
+                "candidate_latency_ms": latency * 1000,
+            })
+        except Exception as e:
+            with _lock:
+                _counters["errors"] += 1
+            print(f"Shadow scoring failed: {str(e)}")
+
+def _percentiles(values):
+    if len(values) == 0:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": float(np.mean(values)), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+def summary(version=None):
+    """Compare candidate and primary over the buffered requests"""
+    results = [r for r in list(_results) if version is None or r["version"] == version]
+    deltas = np.array([r["delta"] for r in results])
+    with _lock:
+        counters = dict(_counters)
+    return {
+        "sample_rate": SAMPLE_RATE,
+        "pending": _jobs.qsize(),
+        "compared": len(results),
+        "candidate_versions": sorted({r["version"] for r in results}),
+        **counters,
+        "delta": _percentiles(deltas),
+        "abs_delta": _percentiles(np.abs(deltas)),
+        "primary_latency_ms": _percentiles([r["primary_latency_ms"] for r in results]),
+        "candidate_latency_ms": _percentiles([r["candidate_latency_ms"] for r in results]),
+        "request_path_overhead_us": _percentiles(list(_overhead_us)),
+    }
@@ -0,0 +1,107 @@
+"""
+Vectorized search for the best notification slot over a time horizon.
+
+Candidate slots are the points ``start, start + step, ...`` up to the
+horizon. Their time features repeat every week, so for each feature layout
+we build a matrix with one row per minute of the week once, cache it, and
+answer a request by taking the rows at each slot's minute of the week,
+filling in the device-state columns and scoring every slot in one
+``predict`` call.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+TIME_FEATURES = ['dayOfWeek', 'hourOfDay', 'minuteOfHour']
+MAX_HORIZON_HOURS = 7 * 24
+MIN_STEP_MINUTES = 1
+MAX_TOP_K = 100
+WEEK_MINUTES = 7 * 24 * 60
+WEEK_CACHE_SIZE = 16        # cached per-layout week matrices
+
+_week_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _week_matrix(columns):
+    """Feature matrix for every minute of a week (Monday 00:00 first), time columns filled"""
+    key = tuple(columns)
+    with _cache_lock:
+        if key in _week_cache:
+            _week_cache.move_to_end(key)
+            return _week_cache[key]
+
+    minutes = np.arange(WEEK_MINUTES)
+    week = np.zeros((len(minutes), len(columns)))
+    time_values = {
+        'dayOfWeek': minutes // (24 * 60),
+        'hourOfDay': (minutes // 60) % 24,
+        'minuteOfHour': minutes % 60,
+    }
+    for i, column in enumerate(columns):
+        if column in time_values:
+            week[:, i] = time_values[column]
+    week.setflags(write=False)
+
+    with _cache_lock:
+        _week_cache[key] = week
+        while len(_week_cache) > WEEK_CACHE_SIZE:
+            _week_cache.popitem(last=False)
+    return week
+
+def model_columns(model, fallback):
+    """Feature order the model expects"""
+    names = getattr(model, 'feature_names_in_', None)
+    return list(names) if names is not None else list(fallback)[:model.n_features_in_]
+
+def search(model, columns, device_state, start=None, horizon_hours=24, step_minutes=15,
+           top_k=5, residuals=None, user_id=None):
+    """
+    Score every slot in the horizon and return the ``top_k`` with the lowest
+    predicted response time, plus the number of slots evaluated.
+    """
+    if not 0 < horizon_hours <= MAX_HORIZON_HOURS:
+        raise ValueError(f"horizonHours must be in (0, {MAX_HORIZON_HOURS}]")
+    if step_minutes < MIN_STEP_MINUTES:
+        raise ValueError(f"stepMinutes must be at least {MIN_STEP_MINUTES}")
+    top_k = max(1, min(int(top_k), MAX_TOP_K))
+    step_minutes = int(step_minutes)
+
+    start = (start or datetime.now()).replace(second=0, microsecond=0)
+    # Round up to the slot grid (multiples of the step since Monday 00:00)
+    week_minute = start.weekday() * 24 * 60 + start.hour * 60 + start.minute
+    offset = -week_minute % step_minutes
+    start += timedelta(minutes=offset)
+
+    # Slot i starts at start + i * step; its row is that minute of the week
+    count = int(horizon_hours * 60 // step_minutes) + 1
+    rows = (week_minute + offset + np.arange(count) * step_minutes) % WEEK_MINUTES
+    X = _week_matrix(columns).take(rows, axis=0)
+
+    for i, column in enumerate(columns):
+        if column not in TIME_FEATURES:
+            X[:, i] = float(device_state.get(column, np.nan))
+
+    inputs = pd.DataFrame(X, columns=columns) if hasattr(model, 'feature_names_in_') else X
+    predictions = model.predict(inputs)
+    if residuals is not None and user_id is not None:
+        corrections = residuals.corrections(user_id, columns, X)
+        if corrections is not None:
+            predictions = predictions + corrections
+
+    k = min(top_k, len(predictions))
+    best = np.argpartition(predictions, k - 1)[:k]
+    best = best[np.argsort(predictions[best])]
+    slots = []
+    for i in best:
+        slot_time = start + timedelta(minutes=int(i) * step_minutes)
+        slots.append({
+            "start": slot_time.isoformat(timespec='minutes'),
+            "dayOfWeek": slot_time.weekday(),
+            "hourOfDay": slot_time.hour,
+            "minuteOfHour": slot_time.minute,
+            "responseTime": float(predictions[i]),
+        })
+    return slots, len(predictions)
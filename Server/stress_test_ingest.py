@@ -0,0 +1,153 @@
+"""
+Stress test for the study-data ingest path.
+
+Starts several processes (like gunicorn workers), each posting unique
+submissions to /api/submit-study-data from many threads through the Flask
+test client, in a scratch copy of the data directories. Each thread
+records a submission as acknowledged once it got a 200, and the first
+process is killed with SIGKILL part-way through, as an OOM kill or a
+worker timeout would. When every process has exited, it checks that each
+acknowledged submission appears exactly once in the raw archive and that
+its sessions reached a processed CSV.
+
+    python stress_test_ingest.py --processes 4 --threads 8 --requests 50
+"""
+import os
+import sys
+import glob
+import time
+import signal
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+import pandas as pd
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def make_submission(process, thread, i):
+    marker = f"{process}-{thread}-{i}"
+    return marker, {
+        "deviceContext": {"deviceType": f"stress-{process}", "batteryLevel": 0.5},
+        "sessions": [
+            {"userId": marker, "responseTime": 10.0, "dayOfWeek": 1, "hourOfDay": 12, "minuteOfHour": 0},
+            {"userId": marker, "responseTime": 20.0, "dayOfWeek": 1, "hourOfDay": 13, "minuteOfHour": 0},
+        ],
+    }
+
+def ack_path(work_dir, process):
+    return os.path.join(work_dir, f"acks_{process}.log")
+
+def run_worker(work_dir, process, threads, requests_per_thread, errors):
+    os.chdir(work_dir)
+    sys.path.insert(0, SERVER_DIR)
+    from app import app
+    # One unbuffered append per acknowledgement, so it survives a SIGKILL
+    acks = os.open(ack_path(work_dir, process), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def hammer(thread):
+        client = app.test_client()
+        for i in range(requests_per_thread):
+            marker, body = make_submission(process, thread, i)
+            response = client.post('/api/submit-study-data', json=body)
+            if response.status_code != 200 or response.get_json().get("duplicate"):
+                errors.put(f"{process}-{thread}-{i}: {response.status_code} {response.get_data(as_text=True)}")
+            else:
+                os.write(acks, f"{marker}\n".encode('utf-8'))
+
+    workers = [threading.Thread(target=hammer, args=(t,)) for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+def acknowledged(work_dir, process):
+    try:
+        with open(ack_path(work_dir, process), 'r') as f:
+            return set(f.read().split())
+    except FileNotFoundError:
+        return set()
+
+def verify(work_dir, expected, killed_pid=None):
+    os.chdir(work_dir)
+    sys.path.insert(0, SERVER_DIR)
+    import partitions
+    import submission_archive
+
+    archived = {}
+    for record in submission_archive.iter_submissions():
+        marker = record["data"]["sessions"][0]["userId"]
+        archived[marker] = archived.get(marker, 0) + 1
+    lost = expected - set(archived)
+    doubled = [m for m, n in archived.items() if n > 1]
+
+    csv_files = partitions.training_files()
+    rows = pd.concat([pd.read_csv(f) for f in csv_files]) if csv_files else pd.DataFrame(columns=["userId"])
+    csv_lost = expected - set(rows["userId"])
+    # A request in flight when the worker died may be stored without an acknowledgement
+    sessions = rows["userId"].value_counts()
+    csv_doubled = int((sessions != 2).sum())
+    meta_rows = sum(partitions.rows_per_day().values())
+    # Temp files of the killed worker are expected; anyone else's are not
+    partial = [p for p in glob.glob(os.path.join(partitions.PARTITION_DIR, "*", ".*.tmp"))
+               if str(killed_pid) not in os.path.basename(p).split('.')]
+
+    print(f"Acknowledged:            {len(expected)}")
+    print(f"Archived records:        {sum(archived.values())}")
+    print(f"Missing from archive:    {len(lost)}")
+    print(f"Archived more than once: {len(doubled)}")
+    print(f"Processed CSV files:     {len(csv_files)} ({len(rows)} rows, {2 * len(expected)} acknowledged)")
+    print(f"Missing from CSVs:       {len(csv_lost)}")
+    print(f"Stored other than twice: {csv_doubled}")
+    print(f"Rows in partition meta:  {meta_rows}")
+    print(f"Leftover temp files:     {len(partial)}")
+    return not lost and not doubled and not csv_lost and not csv_doubled \
+        and meta_rows == len(rows) and not partial
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hammer the ingest endpoint and check for lost records")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=25, help="Submissions per thread")
+    parser.add_argument("--no-kill", action="store_true", help="Let every process finish")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="ingest_stress_")
+    print(f"Working directory: {work_dir}")
+    ctx = multiprocessing.get_context("spawn")
+    errors = ctx.Manager().Queue()
+    procs = [ctx.Process(target=run_worker, args=(work_dir, p, args.threads, args.requests, errors))
+             for p in range(args.processes)]
+    for p in procs:
+        p.start()
+    killed_pid = None
+    if not args.no_kill:
+        # Kill the first worker once it acknowledged about a third of its submissions
+        per_process = args.threads * args.requests
+        deadline = time.time() + 120
+        while len(acknowledged(work_dir, 0)) < per_process // 3 and procs[0].is_alive() \
+                and time.time() < deadline:
+            time.sleep(0.01)
+        if procs[0].is_alive():
+            killed_pid = procs[0].pid
+            os.kill(killed_pid, signal.SIGKILL)
+            print(f"Killed worker 0 (pid {killed_pid}) after {len(acknowledged(work_dir, 0))} acknowledgements")
+    for p in procs:
+        p.join()
+
+    failures = []
+    while not errors.empty():
+        failures.append(errors.get())
+    for failure in failures[:10]:
+        print(f"Request failed: {failure}")
+
+    # Every acknowledged submission must be stored; surviving workers must acknowledge all of theirs
+    expected = set().union(*(acknowledged(work_dir, p) for p in range(args.processes)))
+    complete = all(len(acknowledged(work_dir, p)) == args.threads * args.requests
+                   for p in range(args.processes) if not (killed_pid and p == 0))
+    if not complete:
+        print("A surviving worker did not acknowledge all of its submissions")
+    ok = verify(work_dir, expected, killed_pid) and complete and not failures
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,432 @@
+"""
+Compressed archive for raw study-data submissions.
+
+Every submission is appended to a compressed segment file (zstd when the
+``zstandard`` package is installed, gzip otherwise) as its own frame
+holding one JSON record, through ``ingest_writer`` and its fsync policy,
+before the request is acknowledged. Nothing acknowledged waits in memory,
+so a killed worker loses no data. Every gunicorn worker appends to its
+own active segment, so writers never interleave. A small JSON index records
+the time range, devices and per-day counts of each segment, which lets
+lookups open only the segments they need and lets the dashboard report
+totals without reading any data. ``recent.json`` keeps the last few
+records' summaries for the dashboard.
+
+A worker killed between appending and updating the index leaves a
+segment longer than its index entry. ``recover`` re-indexes such segments
+once their writer has exited; it runs before archive scans and on each
+process's first write.
+"""
+import os
+import io
+import json
+import gzip
+import zlib
+import glob
+import time
+import fcntl
+import argparse
+import threading
+from datetime import datetime
+import ingest_writer
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+DATA_DIR = "collected_data"
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+INDEX_PATH = os.path.join(ARCHIVE_DIR, "index.json")
+RECENT_PATH = os.path.join(ARCHIVE_DIR, "recent.json")
+LOCK_PATH = os.path.join(ARCHIVE_DIR, ".lock")
+
+# Tunables
+SEGMENT_MAX_BYTES = 8 * 1024 * 1024        # roll over to a new segment past this size
+RECENT_LIMIT = 50                          # record summaries kept in recent.json
+RETENTION_DAYS = 365                       # segments older than this are deleted
+COMPACT_MIN_SEGMENT_BYTES = 1024 * 1024    # sealed segments below this are merged
+
+SEGMENT_EXT = ".ndjson.zst" if zstd is not None else ".ndjson.gz"
+
+_write_lock = threading.Lock()
+_recovered = False
+_active_segment = None
+_segment_seq = 0
+
+def _compress(payload):
+    if zstd is not None:
+        return zstd.ZstdCompressor(level=3).compress(payload)
+    return gzip.compress(payload)
+
+def _open_segment(path, offset=0, size=None):
+    """
+    Open a segment for line-by-line reading, whatever its codec.
+
+    Every append writes a self-contained compressed frame, so reading may
+    start at any previous end of file (``offset``) and stop at ``size``.
+    """
+    if offset or size is not None:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            raw = io.BytesIO(f.read() if size is None else f.read(size - offset))
+    elif path.endswith(".zst"):
+        raw = open(path, 'rb')
+    else:
+        return gzip.open(path, 'rt', encoding='utf-8')
+
+    if path.endswith(".zst"):
+        if zstd is None:
+            raw.close()
+            raise RuntimeError(f"zstandard is required to read {path}")
+        reader = zstd.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode='rb'), encoding='utf-8')
+
+class _IndexLock:
+    """Cross-process lock guarding the index file"""
+    def __enter__(self):
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        self._f = open(LOCK_PATH, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+
+def load_index():
+    """Return the segment index as a dict keyed by segment file name"""
+    if not os.path.exists(INDEX_PATH):
+        return {}
+    try:
+        with open(INDEX_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading archive index: {str(e)}")
+        return {}
+
+def _save_index(index):
+    tmp_path = f"{INDEX_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, INDEX_PATH)
+
+def _new_segment_name(prefix="segment"):
+    global _segment_seq
+    _segment_seq += 1
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{prefix}_{stamp}_{os.getpid()}_{_segment_seq}{SEGMENT_EXT}"
+
+def _segment_pid(name):
+    """Return the writer pid encoded in an active segment's name"""
+    if not name.startswith("segment_"):
+        return None
+    try:
+        return int(name.split('_')[3])
+    except (IndexError, ValueError):
+        return None
+
+def _pid_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _summarize(records):
+    """Build the index entry fields for a list of archive records"""
+    entry = {"records": 0, "sessions": 0, "min_ts": None, "max_ts": None, "devices": {}, "days": {}}
+    _merge_summary(entry, records)
+    return entry
+
+def _merge_summary(entry, records):
+    for record in records:
+        ts = record["received_at"]
+        entry["records"] += 1
+        entry["sessions"] += len(record["data"].get("sessions", []))
+        entry["min_ts"] = ts if entry["min_ts"] is None else min(entry["min_ts"], ts)
+        entry["max_ts"] = ts if entry["max_ts"] is None else max(entry["max_ts"], ts)
+        device = record["device_id"]
+        entry["devices"][device] = entry["devices"].get(device, 0) + 1
+        day = datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
+        entry["days"][day] = entry["days"].get(day, 0) + 1
+
+def append_submission(data, device_id, received_at=None, key=None):
+    """Archive a raw submission; it is on disk (per INGEST_FSYNC) when this returns"""
+    record = {
+        "received_at": received_at if received_at is not None else time.time(),
+        "device_id": device_id,
+        "data": data,
+    }
+    if key is not None:
+        record["key"] = key
+    _write_batch([record])
+
+def _write_batch(records):
+    global _active_segment, _recovered
+    with _write_lock:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        if not _recovered:
+            recover()
+            _recovered = True
+        if _active_segment is None or _segment_size(_active_segment) >= SEGMENT_MAX_BYTES:
+            _active_segment = _new_segment_name()
+
+        payload = "".join(json.dumps(r, separators=(',', ':')) + "\n" for r in records).encode('utf-8')
+        ingest_writer.append(os.path.join(ARCHIVE_DIR, _active_segment), _compress(payload))
+
+        with _IndexLock():
+            index = load_index()
+            entry = index.get(_active_segment) or _summarize([])
+            _merge_summary(entry, records)
+            entry["bytes"] = _segment_size(_active_segment)
+            index[_active_segment] = entry
+            _save_index(index)
+            _save_recent(_load_recent() + [_recent_entry(r) for r in records])
+
+def _recent_entry(record):
+    return {"received_at": record["received_at"], "device_id": record["device_id"],
+            "sessions": len(record["data"].get("sessions", []))}
+
+def _load_recent():
+    try:
+        with open(RECENT_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def _save_recent(entries):
+    entries = sorted(entries, key=lambda e: e["received_at"])[-RECENT_LIMIT:]
+    ingest_writer.write_atomic(RECENT_PATH, lambda f: json.dump(entries, f), mode='w')
+
+def _complete_frames(raw):
+    """Records in the whole compressed frames at the start of ``raw``, and the bytes they span"""
+    records, end = [], 0
+    while end < len(raw):
+        decoder = zstd.ZstdDecompressor().decompressobj() if zstd is not None else zlib.decompressobj(wbits=31)
+        try:
+            text = decoder.decompress(raw[end:])
+        except Exception:
+            break
+        if not getattr(decoder, "eof", True):
+            break
+        end = len(raw) - len(decoder.unused_data)
+        records.extend(json.loads(line) for line in text.decode('utf-8').splitlines() if line.strip())
+    return records, end
+
+def recover():
+    """Index records of segments whose writer died before updating the index"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return 0
+    repaired = 0
+    with _IndexLock():
+        index = load_index()
+        for name in sorted(os.listdir(ARCHIVE_DIR)):
+            # Compacted segments are indexed before their sources are removed
+            if not name.startswith("segment_") or not name.endswith(SEGMENT_EXT):
+                continue
+            entry = index.get(name)
+            size = _segment_size(name)
+            if entry is not None and entry.get("bytes") == size:
+                continue
+            if _pid_alive(_segment_pid(name)):
+                continue
+            path = os.path.join(ARCHIVE_DIR, name)
+            with open(path, 'rb') as f:
+                records, complete = _complete_frames(f.read())
+            if complete < size:
+                # The writer was killed mid-append: drop the partial frame
+                print(f"Truncating partial frame at byte {complete} of segment {name}")
+                os.truncate(path, complete)
+            entry = _summarize(records)
+            entry["bytes"] = complete
+            index[name] = entry
+            repaired += 1
+        if repaired:
+            _save_index(index)
+            print(f"Re-indexed {repaired} archive segments")
+    return repaired
+
+def _segment_size(name):
+    try:
+        return os.path.getsize(os.path.join(ARCHIVE_DIR, name))
+    except OSError:
+        return 0
+
+def read_segment_file(path, offset=0, size=None):
+    """Yield every record stored in the segment at ``path`` (optionally a byte range)"""
+    with _open_segment(path, offset, size) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def _read_segment(name):
+    return read_segment_file(os.path.join(ARCHIVE_DIR, name))
+
+def iter_submissions(device_id=None, start=None, end=None):
+    """
+    Yield archived records, oldest segment first.
+
+    ``start`` and ``end`` are epoch seconds (inclusive). Segments whose
+    indexed time range or device set cannot match are skipped unopened.
+    """
+    recover()
+    index = load_index()
+    for name in sorted(index, key=lambda n: index[n]["min_ts"] or 0):
+        entry = index[name]
+        if start is not None and entry["max_ts"] is not None and entry["max_ts"] < start:
+            continue
+        if end is not None and entry["min_ts"] is not None and entry["min_ts"] > end:
+            continue
+        if device_id is not None and device_id not in entry["devices"]:
+            continue
+        for record in _read_segment(name):
+            ts = record["received_at"]
+            if start is not None and ts < start:
+                continue
+            if end is not None and ts > end:
+                continue
+            if device_id is not None and record["device_id"] != device_id:
+                continue
+            yield record
+
+def segment_paths():
+    """Return the paths of all indexed segments, oldest first"""
+    index = load_index()
+    names = sorted(index, key=lambda n: index[n]["min_ts"] or 0)
+    return [os.path.join(ARCHIVE_DIR, n) for n in names]
+
+def recent_submissions(limit=10):
+    """
+    Summaries (``received_at``, ``device_id``, ``sessions``) of the ``limit``
+    most recently received records, newest first, from ``recent.json``.
+    """
+    return sorted(_load_recent(), key=lambda e: e["received_at"], reverse=True)[:limit]
+
+def archive_stats():
+    """Aggregate the index into totals for reporting"""
+    index = load_index()
+    stats = {"segments": len(index), "records": 0, "sessions": 0, "bytes": 0, "devices": set(), "days": {}}
+    for entry in index.values():
+        stats["records"] += entry["records"]
+        stats["sessions"] += entry["sessions"]
+        stats["bytes"] += entry.get("bytes", 0)
+        stats["devices"].update(entry["devices"])
+        for day, count in entry["days"].items():
+            stats["days"][day] = stats["days"].get(day, 0) + count
+    return stats
+
+def apply_retention(retention_days=RETENTION_DAYS):
+    """Delete segments whose newest record is older than the retention window"""
+    cutoff = time.time() - retention_days * 86400
+    removed = []
+    with _IndexLock():
+        index = load_index()
+        for name, entry in list(index.items()):
+            if entry["max_ts"] is not None and entry["max_ts"] < cutoff and name != _active_segment:
+                del index[name]
+                removed.append(name)
+        _save_index(index)
+    for name in removed:
+        try:
+            os.remove(os.path.join(ARCHIVE_DIR, name))
+        except OSError as e:
+            print(f"Error removing segment {name}: {str(e)}")
+    return removed
+
+def compact(min_segment_bytes=COMPACT_MIN_SEGMENT_BYTES, max_segment_bytes=SEGMENT_MAX_BYTES):
+    """
+    Merge small sealed segments into larger ones.
+
+    A segment is sealed once the process that wrote it has exited, so
+    compaction never touches a file a live worker may still append to.
+    """
+    index = load_index()
+    candidates = [n for n in sorted(index, key=lambda n: index[n]["min_ts"] or 0)
+                  if index[n].get("bytes", 0) < min_segment_bytes
+                  and n != _active_segment
+                  and not _pid_alive(_segment_pid(n))]
+    if len(candidates) < 2:
+        return 0
+
+    groups, current, current_bytes = [], [], 0
+    for name in candidates:
+        size = index[name].get("bytes", 0)
+        if current and current_bytes + size > max_segment_bytes:
+            groups.append(current)
+            current, current_bytes = [], 0
+        current.append(name)
+        current_bytes += size
+    if current:
+        groups.append(current)
+
+    merged = 0
+    for group in groups:
+        if len(group) < 2:
+            continue
+        records = [r for name in group for r in _read_segment(name)]
+        out_name = _new_segment_name(prefix="compacted")
+        tmp_path = os.path.join(ARCHIVE_DIR, out_name + ".tmp")
+        payload = "".join(json.dumps(r, separators=(',', ':')) + "\n" for r in records).encode('utf-8')
+        with open(tmp_path, 'wb') as f:
+            f.write(_compress(payload))
+        os.replace(tmp_path, os.path.join(ARCHIVE_DIR, out_name))
+
+        with _IndexLock():
+            index = load_index()
+            entry = _summarize(records)
+            entry["bytes"] = _segment_size(out_name)
+            for name in group:
+                index.pop(name, None)
+            index[out_name] = entry
+            _save_index(index)
+        for name in group:
+            try:
+                os.remove(os.path.join(ARCHIVE_DIR, name))
+            except OSError as e:
+                print(f"Error removing segment {name}: {str(e)}")
+        merged += len(group)
+    return merged
+
+def import_legacy_files(data_dir=DATA_DIR, delete=False):
+    """Move loose ``<timestamp>_<device>.json`` submissions into the archive"""
+    imported = 0
+    for file_path in sorted(glob.glob(os.path.join(data_dir, "*.json"))):
+        try:
+            with open(file_path, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error loading file {file_path}: {str(e)}")
+            continue
+        device_id = data.get('deviceContext', {}).get('deviceType', 'unknown')
+        append_submission(data, device_id, received_at=os.path.getmtime(file_path))
+        imported += 1
+        if delete:
+            os.remove(file_path)
+    return imported
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the raw submission archive")
+    parser.add_argument("command", choices=["stats", "compact", "retention", "import-legacy"])
+    parser.add_argument("--retention-days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--delete", action="store_true", help="Delete legacy JSON files after import")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        recover()
+        stats = archive_stats()
+        print(f"Segments: {stats['segments']}")
+        print(f"Records: {stats['records']} ({stats['sessions']} sessions)")
+        print(f"Compressed size: {stats['bytes']} bytes")
+        print(f"Devices: {len(stats['devices'])}")
+    elif args.command == "compact":
+        print(f"Merged {compact()} segments")
+    elif args.command == "retention":
+        print(f"Removed {len(apply_retention(args.retention_days))} segments")
+    elif args.command == "import-legacy":
+        print(f"Imported {import_legacy_files(delete=args.delete)} legacy submissions")
@@ -0,0 +1,57 @@
+"""
+Checks that a submission whose rows could not be stored is not remembered
+as a duplicate, so the client's retry reaches the CSV store.
+
+Runs without a server, in a scratch data directory:
+
+    python test_ingest_retry.py
+"""
+import os
+import sys
+import time
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SUBMISSION = {
+    "deviceContext": {"deviceType": "retry-test", "batteryLevel": 0.5},
+    "sessions": [
+        {"userId": "retry-user", "responseTime": 10.0, "dayOfWeek": 1, "hourOfDay": 12, "minuteOfHour": 0},
+    ],
+}
+
+def test_failed_write_is_retried():
+    work_dir = tempfile.mkdtemp(prefix="ingest_retry_")
+    os.environ["DEDUP_STATE_PATH"] = os.path.join(work_dir, "dedup.bin")
+    os.chdir(work_dir)
+    sys.path.insert(0, SERVER_DIR)
+    import pandas as pd
+    import app as ingest
+    import dedup
+    import partitions
+
+    # A new state file is seeded from the archive in the background; let that finish first
+    deadline = time.time() + 10
+    while not dedup.stats()["seeded"] and time.time() < deadline:
+        time.sleep(0.05)
+
+    write_rows = partitions.write_rows
+    def failing_write(rows, *args, **kwargs):
+        raise OSError("No space left on device")
+    partitions.write_rows = failing_write
+    try:
+        client = ingest.app.test_client()
+        failed = client.post('/api/submit-study-data', json=SUBMISSION)
+        assert failed.status_code == 500, failed.get_data(as_text=True)
+    finally:
+        partitions.write_rows = write_rows
+
+    retried = client.post('/api/submit-study-data', json=SUBMISSION)
+    assert retried.status_code == 200, retried.get_data(as_text=True)
+    assert not retried.get_json().get("duplicate"), "retry was acknowledged as a duplicate"
+    stored = pd.concat([pd.read_csv(f) for f in partitions.training_files()])
+    assert list(stored["userId"]) == ["retry-user"]
+
+if __name__ == "__main__":
+    test_failed_write_is_retried()
+    print("test_failed_write_is_retried: PASS")
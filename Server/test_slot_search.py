@@ -0,0 +1,50 @@
+"""
+Checks that /optimal_slots scores every slot on that slot's own time features.
+
+Runs without a server:
+
+    python test_slot_search.py
+"""
+from datetime import datetime
+
+import numpy as np
+
+import slot_search
+
+COLUMNS = ['dayOfWeek', 'hourOfDay', 'minuteOfHour', 'device_activity']
+
+class MinuteOfWeekModel:
+    """Predicts the minute of the week encoded in the time features"""
+    n_features_in_ = len(COLUMNS)
+
+    def predict(self, X):
+        X = np.asarray(X)
+        return X[:, 0] * 24 * 60 + X[:, 1] * 60 + X[:, 2]
+
+def check_slots(start, horizon_hours, step_minutes):
+    slots, evaluated = slot_search.search(MinuteOfWeekModel(), COLUMNS, {'device_activity': 0.5},
+                                          start=start, horizon_hours=horizon_hours,
+                                          step_minutes=step_minutes, top_k=slot_search.MAX_TOP_K)
+    assert len(slots) == min(evaluated, slot_search.MAX_TOP_K)
+    for slot in slots:
+        slot_time = datetime.fromisoformat(slot["start"])
+        scored = slot_time.weekday() * 24 * 60 + slot_time.hour * 60 + slot_time.minute
+        assert slot["responseTime"] == scored, f"{slot['start']} scored on minute {slot['responseTime']:.0f}"
+        assert (slot_time - start).total_seconds() < step_minutes * 60 + horizon_hours * 3600
+
+def test_divisor_step():
+    check_slots(datetime(2024, 1, 3, 9, 7), 24, 15)
+
+def test_non_divisor_step():
+    # 10080 minutes is not a multiple of 11, so the grid does not repeat weekly
+    check_slots(datetime(2024, 1, 1, 0, 3), 12, 11)
+
+def test_week_wrap():
+    # Sunday evening into Monday morning
+    check_slots(datetime(2024, 1, 7, 23, 0), 12, 11)
+    check_slots(datetime(2024, 1, 7, 22, 50), 6, 15)
+
+if __name__ == "__main__":
+    for test in (test_divisor_step, test_non_divisor_step, test_week_wrap):
+        test()
+        print(f"{test.__name__}: PASS")
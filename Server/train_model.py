@@ -1,53 +1,172 @@
 import os
 import pandas as pd
 import numpy as np
-import glob
 import pickle
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_absolute_error
-import coremltools as ct
+import argparse
+from datetime import date, datetime
+import backtest
+import coreml_export
+import drift
+import feature_cache
+import ingest_schema
+import model_registry
+import partitions
+import prediction_log
+from features import TARGET
+from personalization import user_key
 
 DATA_DIR = "collected_data"
 OUTPUT_DIR = "output_models"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def load_and_prepare_data():
-    """Load data from all collected CSVs and prepare for model training"""
-    # Find all processed CSV files
-    csv_files = glob.glob(os.path.join(DATA_DIR, "processed_*.csv"))
+# The version suffix rebuilds caches extracted before rows were normalized
+TRAINING_CACHE_NAME = "training_features_v2"
+# userId keys, epoch seconds and outcomes for joining rows to the prediction log
+FEEDBACK_CACHE_NAME = "feedback_rows"
+FEEDBACK_COLUMNS = ["user_key_high", "user_key_low", "epochTime", TARGET]
+WEIGHT_COLUMN = "sample_weight"
+MODEL_PARAMS = {"n_estimators": 100, "random_state": 42}
+
+def _extract_csv_files(jobs, columns):
+    for file, _, _ in jobs:
+        try:
+            # Files written since ingest normalization already conform; older
+            # ones are checked the same way here, once per cache entry
+            df, _ = ingest_schema.normalize(pd.read_csv(file))
+            yield file, df[columns].to_numpy(dtype=np.float32, na_value=np.nan)
+        except Exception as e:
+            print(f"Error loading file {file}: {str(e)}")
+            yield file, None
+
+def _extract_feedback_rows(jobs):
+    """Rows with a ``userId`` and an ``epochTime``, as FEEDBACK_COLUMNS"""
+    for file, _, _ in jobs:
+        try:
+            df, _ = ingest_schema.normalize(pd.read_csv(file))
+        except Exception as e:
+            print(f"Error loading file {file}: {str(e)}")
+            yield file, None
+            continue
+        df = df[df['userId'].notna() & df['epochTime'].notna()]
+        # 64-bit user keys are split in two halves that float64 holds exactly
+        keys = np.array([user_key(u) for u in df['userId']], dtype=np.uint64)
+        yield file, np.column_stack([(keys >> np.uint64(32)).astype(np.float64),
+                                     (keys & np.uint64(0xFFFFFFFF)).astype(np.float64),
+                                     df['epochTime'].to_numpy(dtype=np.float64),
+                                     df[TARGET].to_numpy(dtype=np.float64)])
+
+def _recency_weights(day, half_life_days, today, oldest_age):
+    """Weight halving every ``half_life_days`` of age (legacy data counts as oldest)"""
+    if day == "legacy":
+        age = oldest_age
+    else:
+        age = (today - datetime.strptime(day, partitions.DAY_FORMAT).date()).days
+    return 0.5 ** (max(age, 0) / half_life_days)
+
+def load_and_prepare_data(days=None, since=None, until=None, half_life_days=None):
+    """
+    Load collected data and prepare it for model training.
+
+    ``days`` (the last N days) or ``since``/``until`` (``YYYY-MM-DD``,
+    inclusive) restrict training to a window of day partitions; the others
+    are never opened. ``half_life_days`` adds a WEIGHT_COLUMN that
+    down-weights older days.
+    """
+    start, end = partitions.window(days, since, until)
+    groups = partitions.window_files(start, end)
     
-    if not csv_files:
+    if not groups:
         print("No data files found for training")
         return None
     
-    # Combine all data files
-    dfs = []
-    for file in csv_files:
-        try:
-            df = pd.read_csv(file)
-            dfs.append(df)
-        except Exception as e:
-            print(f"Error loading file {file}: {str(e)}")
+    # Every partition has its own memory-mapped feature cache, so only CSVs
+    # that are new since the last run are parsed
+    columns = ingest_schema.FEATURES + [TARGET]
+    blocks, weights = [], []
+    today = date.today()
+    ages = [(today - datetime.strptime(day, partitions.DAY_FORMAT).date()).days
+            for day, _ in groups if day != "legacy"]
+    for day, csv_files in groups:
+        matrix = feature_cache.load(
+            f"{TRAINING_CACHE_NAME}_{day}", csv_files, columns,
+            extract=lambda jobs: _extract_csv_files(jobs, columns),
+        )
+        if matrix is None:
+            continue
+        blocks.append(matrix)
+        if half_life_days:
+            weight = _recency_weights(day, half_life_days, today, max(ages, default=0))
+            weights.append(np.full(len(matrix), weight, dtype=np.float32))
     
-    if not dfs:
+    if not blocks:
         return None
         
-    # Combine all dataframes
-    combined_df = pd.concat(dfs, ignore_index=True)
+    combined_df = pd.DataFrame(np.concatenate(blocks), columns=columns, copy=False)
+    if half_life_days:
+        combined_df[WEIGHT_COLUMN] = np.concatenate(weights)
     
-    # Clean and prepare data
-    # Note: Adjust these preprocessing steps based on your actual data structure
-    # This is a simplified example
+    # Rows are already validated; drop optional features no source provided,
+    # then the rows that lack one of the remaining ones
+    combined_df = combined_df.dropna(axis=1, how='all').dropna()
+    combined_df.attrs["training_window"] = {
+        "since": start, "until": end, "half_life_days": half_life_days,
+        "partitions": len(groups),
+    }
     
-    # Drop any rows with missing values
-    combined_df = combined_df.dropna()
-    
-    print(f"Loaded {len(combined_df)} data points for training")
+    print(f"Loaded {len(combined_df)} data points for training from {len(groups)} partitions")
     return combined_df
 
-def train_notification_time_model(data):
-    """Train a model to predict optimal notification times"""
+def served_feedback(start=None, end=None):
+    """
+    Error of the predictions actually served, for rows users reported back.
+
+    Each row of the window with a ``userId`` and an ``epochTime`` (rows
+    whose device time zone is unknown have none) is joined to the last
+    prediction logged for that user shortly before it. The join columns
+    come from a per-partition cache, so only new CSVs are parsed.
+    """
+    blocks = []
+    for day, csv_files in partitions.window_files(start, end):
+        matrix = feature_cache.load(f"{FEEDBACK_CACHE_NAME}_{day}", csv_files, FEEDBACK_COLUMNS,
+                                    extract=_extract_feedback_rows, dtype='<f8')
+        if matrix is not None:
+            blocks.append(matrix)
+    if not blocks:
+        return None
+    rows = np.concatenate(blocks)
+    keys = (rows[:, 0].astype(np.uint64) << np.uint64(32)) | rows[:, 1].astype(np.uint64)
+    seconds, targets = rows[:, 2], rows[:, 3]
+    
+    log = prediction_log.load(since=seconds.min() - prediction_log.JOIN_WINDOW_SECONDS)
+    index = prediction_log.join_keys(keys, seconds, log)
+    hit = (index >= 0) & ~np.isnan(targets)
+    if not hit.any():
+        return {"matched": 0}
+    served = log[index[hit]]
+    errors = np.abs(served['prediction'] - targets[hit])
+    versions = served['version'].astype(str)
+    return {
+        "matched": int(hit.sum()),
+        "mae": float(errors.mean()),
+        "by_version": {v or "unversioned": {"rows": int((versions == v).sum()),
+                                            "mae": float(errors[versions == v].mean())}
+                       for v in np.unique(versions)},
+    }
+
+def train_notification_time_model(data, name=None, backtest_folds=None, candidate=False):
+    """
+    Train a model to predict optimal notification times.
+
+    With ``name`` the model is served as ``/predict/<name>`` and the
+    default model is left alone. With ``candidate`` it is only registered
+    as the shadow candidate; the default model stays served until the
+    candidate is promoted. With ``backtest_folds`` the model is
+    evaluated by a rolling-origin backtest over the rows in collection
+    order, and the final model is fitted on all of them.
+    """
     # Feature engineering
     # Note: You should adapt these features based on your actual data
     features = [col for col in data.columns if col.startswith('device_') or
@@ -75,45 +194,103 @@ def train_notification_time_model(data):
         print("No valid features found in data")
         return None
     
-    # Split data
+    # Split data (recency weights, when requested, only affect fitting)
     X = data[features]
     y = data[target]
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    w = data[WEIGHT_COLUMN] if WEIGHT_COLUMN in data.columns else None
+    evaluation = None
+    if backtest_folds:
+        # Folds train in worker processes while the final model is fitted here
+        evaluation = backtest.start(X.to_numpy(dtype=np.float32), y.to_numpy(dtype=np.float32),
+                                    None if w is None else w.to_numpy(dtype=np.float32),
+                                    folds=backtest_folds, params=MODEL_PARAMS)
+        if evaluation is None:
+            print(f"Too few rows for a backtest ({len(data)}), using a random split")
+    if evaluation is not None:
+        X_train, y_train, w_train = X, y, w
+    elif w is not None:
+        X_train, X_test, y_train, y_test, w_train, _ = train_test_split(X, y, w, test_size=0.2, random_state=42)
+    else:
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        w_train = None
     
     # Train a simple model
-    model = RandomForestRegressor(n_estimators=100, random_state=42)
-    model.fit(X_train, y_train)
-    
-    # Evaluate
-    predictions = model.predict(X_test)
-    mae = mean_absolute_error(y_test, predictions)
-    print(f"Model MAE: {mae}")
-    
-    # Export as CoreML model
-    model_path = os.path.join(OUTPUT_DIR, "NotificationTimePredictor.mlmodel")
+    model = RandomForestRegressor(**MODEL_PARAMS)
+    model.fit(X_train, y_train, sample_weight=w_train)
     
-    # Convert to CoreML
-    try:
-        coreml_model = ct.converters.sklearn.convert(model, 
-                                                  input_features=[(f, ct.TensorType(shape=(1,))) for f in features],
-                                                  output_feature_names=['notificationTime'])
-        # Save the model
-        coreml_model.save(model_path)
-        print(f"Model saved to {model_path}")
-    except Exception as e:
-        print(f"Error converting to CoreML: {str(e)}")
-        model_path = None
+    # CoreML conversion runs in a worker process (or comes from the cache)
+    # while the pickle is written and the model is evaluated
+    model_bytes = pickle.dumps(model)
+    export = coreml_export.start(model_bytes, features)
     
     # Also save the sklearn model directly
-    sklearn_model_path = os.path.join(OUTPUT_DIR, "NotificationTimePredictor.pkl")
+    sklearn_model_path = os.path.join(OUTPUT_DIR, f"{name or 'NotificationTimePredictor'}.pkl")
     with open(sklearn_model_path, 'wb') as f:
-        pickle.dump(model, f)
+        f.write(model_bytes)
     print(f"Scikit-learn model saved to {sklearn_model_path}")
     
-    return model_path
+    # Evaluate
+    report = None
+    if evaluation is not None:
+        report = evaluation.result()
+        for fold in report["folds"]:
+            print(f"Fold {fold['fold']}: train {fold['train_rows']} rows, test {fold['test_rows']} rows, "
+                  f"MAE {fold['mae']:.2f}, within {backtest.ACCURACY_TOLERANCE_SECONDS}s "
+                  f"{fold['accuracy']:.1%} (baseline MAE {fold['baseline_mae']:.2f})")
+        mae = report["summary"]["mae"]
+        print(f"Backtest MAE: {mae} over {report['summary']['folds']} folds in {report['seconds']}s")
+    else:
+        predictions = model.predict(X_test)
+        mae = mean_absolute_error(y_test, predictions)
+        print(f"Model MAE: {mae}")
+    
+    coreml_path = export.result()
+    if coreml_path:
+        print(f"CoreML model {'reused from cache' if export.cached else 'exported'}: {coreml_path}")
+    
+    # How the models that were serving did on the outcomes in this data
+    window = data.attrs.get("training_window") or {}
+    feedback = served_feedback(window.get("since"), window.get("until"))
+    if feedback and feedback["matched"]:
+        print(f"Served predictions matched: {feedback['matched']}, served MAE: {feedback['mae']:.4f}")
+    
+    # Register the new version and serve it by default (or under its name)
+    version = model_registry.register_model(
+        sklearn_model_path, coreml_path,
+        features=features, mae=mae, training_rows=len(X_train),
+        extra={"training_window": data.attrs.get("training_window"),
+               "drift_sketch": drift.build_sketch(X_train),
+               "served_feedback": feedback,
+               "backtest": report},
+        make_current=name is None and not candidate, name=name,
+    )
+    print(f"Registered model version {version}" + (f" as /predict/{name}" if name else ""))
+    if candidate:
+        model_registry.set_candidate(version)
+        print(f"Shadow-evaluating version {version}; promote it with: python model_registry.py promote {version}")
+    if name or candidate:
+        return coreml_path
+    
+    # Registering made the version current, which copied its CoreML model here
+    model_path = os.path.join(OUTPUT_DIR, "NotificationTimePredictor.mlmodel")
+    return model_path if coreml_path else None
 
 if __name__ == "__main__":
-    # Test the training pipeline
-    data = load_and_prepare_data()
+    parser = argparse.ArgumentParser(description="Train the notification time model")
+    parser.add_argument("--days", type=int, help="Train on the last N days of partitions")
+    parser.add_argument("--since", help="First day to train on (YYYY-MM-DD)")
+    parser.add_argument("--until", help="Last day to train on (YYYY-MM-DD)")
+    parser.add_argument("--half-life", type=float, dest="half_life_days",
+                        help="Down-weight data by half for every N days of age")
+    parser.add_argument("--name", help="Serve the model as /predict/<name> instead of by default")
+    parser.add_argument("--candidate", action="store_true",
+                        help="Only shadow-evaluate the model; keep serving the current default")
+    parser.add_argument("--backtest", type=int, nargs="?", const=backtest.FOLDS, metavar="FOLDS",
+                        help=f"Evaluate with a rolling-origin backtest (default {backtest.FOLDS} folds)")
+    args = parser.parse_args()
+    if args.name and not model_registry.NAME_PATTERN.match(args.name):
+        parser.error("--name may only contain letters, digits, '_' and '-'")
+    
+    data = load_and_prepare_data(args.days, args.since, args.until, args.half_life_days)
     if data is not None:
-        train_notification_time_model(data)
+        train_notification_time_model(data, args.name, args.backtest, args.candidate)
@@ -4,15 +4,24 @@ Script to update the ML model on your AWS server
 
 This script:
 1. Generates a new seed model locally
-2. Uploads it to your AWS server
+2. Uploads it to your AWS server and registers it there as the default
+   version (which also publishes it for download)
 3. Restarts the server service to load the new model
+
+For several serving nodes, use model_sync.py instead: nodes pull and swap
+in a published version without a restart.
 """
 
 import os
 import sys
 import subprocess
+import time
 import argparse
-from datetime import datetime
+
+import model_registry
+
+MODEL_PATH = os.path.join(model_registry.OUTPUT_DIR, "NotificationTimePredictor.pkl")
+REMOTE_DIR = "~/bit-ml-server"
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Update the Bit ML model on AWS")
@@ -61,41 +70,52 @@ def create_new_model():
         return False
 
 def upload_model(key_path, host):
-    """Upload the model file to the AWS server"""
-    if not os.path.exists("output_models/NotificationTimePredictor.pkl"):
+    """Upload the model to the AWS server and register it there as the default version"""
+    if not os.path.exists(MODEL_PATH):
         print("ERROR: No model file found to upload")
         return False
-        
-    # Backup the model with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_cmd = f"ssh -i {key_path} ubuntu@{host} 'mkdir -p ~/model_backups && " \
-                f"cp ~/bit-ml-server/output_models/NotificationTimePredictor.pkl " \
-                f"~/model_backups/NotificationTimePredictor_{timestamp}.pkl 2>/dev/null || true'"
     
-    run_command(backup_cmd, "Backing up existing model on server")
+    # The server serves its registry's CURRENT, so the model goes in through the registry;
+    # registering locally first (a no-op if done already) gives its version and metadata
+    version = model_registry.register_model(MODEL_PATH)
+    files = [model_registry.model_path(version), os.path.join(model_registry.version_dir(version), "metadata.json")]
+    coreml_path = model_registry.model_path(version, "coreml")
+    if os.path.exists(coreml_path):
+        files.append(coreml_path)
     
-    # Upload the new model
-    upload_cmd = f"scp -i {key_path} output_models/NotificationTimePredictor.pkl " \
-                f"ubuntu@{host}:~/bit-ml-server/output_models/"
+    # Staged outside the registry; previous versions stay registered for a rollback
+    incoming = f"{REMOTE_DIR}/output_models/incoming/{version}"
+    if not run_command(f"ssh -i {key_path} ubuntu@{host} 'mkdir -p {incoming}'", "Preparing upload directory"):
+        return False
+    upload_cmd = f"scp -i {key_path} {' '.join(files)} ubuntu@{host}:{incoming}/"
+    if not run_command(upload_cmd, f"Uploading model version {version} to server"):
+        return False
     
-    return run_command(upload_cmd, "Uploading new model to server")
+    coreml_arg = f" --coreml {incoming}/model.mlmodel" if os.path.exists(coreml_path) else ""
+    register_cmd = f"ssh -i {key_path} ubuntu@{host} 'cd {REMOTE_DIR} && " \
+                   f"python3 model_registry.py register --model {incoming}/model.pkl{coreml_arg} " \
+                   f"--metadata {incoming}/metadata.json --current && rm -rf {incoming}'"
+    return run_command(register_cmd, f"Registering version {version} as the default (and publishing it)")
 
 def restart_server(key_path, host):
     """Restart the server service to load the new model"""
     restart_cmd = f"ssh -i {key_path} ubuntu@{host} 'sudo systemctl restart bit-ml-server'"
     return run_command(restart_cmd, "Restarting server service")
 
-def verify_server(host):
-    """Verify that the server is running with the new model"""
-    verify_cmd = f"curl -s http://{host}:5001/health"
-    try:
-        result = subprocess.run(verify_cmd, shell=True, check=True, 
-                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f"Server health check: {result.stdout.decode('utf-8')}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: Server verification failed: {e}")
-        return False
+def verify_server(host, attempts=30):
+    """Verify that the server is running with the new model and has warmed up"""
+    verify_cmd = f"curl -sf http://{host}:5001/ready"
+    for attempt in range(attempts):
+        try:
+            result = subprocess.run(verify_cmd, shell=True, check=True, 
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            print(f"Server readiness check: {result.stdout.decode('utf-8')}")
+            return True
+        except subprocess.CalledProcessError as e:
+            if attempt == attempts - 1:
+                print(f"ERROR: Server verification failed: {e}")
+                return False
+            time.sleep(2)
 
 if __name__ == "__main__":
     args = parse_args()
@@ -112,9 +132,6 @@ if __name__ == "__main__":
         if upload_model(args.key, args.host):
             if restart_server(args.key, args.host):
                 print("\nWaiting for server to restart...")
-                import time
-                time.sleep(5)  # Give the server time to restart
-                
                 if verify_server(args.host):
                     print("\n✅ Success! The model has been updated and the server restarted.")
                     print(f"  You can test it at: http://{args.host}:5001")
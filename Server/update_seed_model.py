@@ -1,16 +1,70 @@
 import os
 import sys
 import glob
+import json
 import pandas as pd
 import pickle
 import numpy as np
+from multiprocessing import Pool
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import train_test_split
+from sklearn.metrics import mean_absolute_error
+import submission_archive
+import feature_cache
+import coreml_export
+import drift
+import ingest_schema
+import model_registry
+from features import SEED_FEATURES, TARGET, submission_rows
 
 # Constants
 DATA_DIR = "collected_data"
 OUTPUT_DIR = "output_models"
 MODEL_PATH = os.path.join(OUTPUT_DIR, "NotificationTimePredictor.pkl")
+# The version suffix rebuilds caches extracted before rows were normalized
+FEATURE_CACHE_NAME = "seed_features_v2"
+
+def _extract_source(job):
+    """Parse one archive segment or legacy JSON file into [features | target] rows"""
+    path, offset, size = job
+    try:
+        if path.endswith(".json"):
+            with open(path, 'r') as f:
+                submissions = [json.load(f)]
+        else:
+            records = submission_archive.read_segment_file(path, offset, size)
+            submissions = (r["data"] for r in records)
+        rows = []
+        for data in submissions:
+            rows.extend(submission_rows(data))
+    except Exception as e:
+        print(f"Error extracting {path}: {str(e)}")
+        # Not cached, so the next run reads it again
+        return path, None
+
+    # Same validation as ingest, then drop rows lacking a seed feature
+    df, _ = ingest_schema.normalize(pd.DataFrame(rows))
+    matrix = df[SEED_FEATURES + [TARGET]].to_numpy(dtype=np.float32, na_value=np.nan)
+    return path, matrix[~np.isnan(matrix).any(axis=1)]
+
+def _extract_in_pool(jobs, workers=None):
+    with Pool(processes=workers) as pool:
+        yield from pool.imap(_extract_source, jobs, chunksize=8)
+
+def extract_features(sources, workers=None):
+    """
+    Stream submissions through a process pool into a memory-mapped matrix.
+
+    Each worker parses whole files; the feature cache appends their rows
+    in fixed-size chunks, so peak memory is bounded by the chunk size plus
+    the in-flight files rather than by the dataset. Only sources that are
+    new or have grown since the previous run are parsed.
+    """
+    return feature_cache.load(
+        FEATURE_CACHE_NAME, sources, SEED_FEATURES + [TARGET],
+        extract=lambda jobs: _extract_in_pool(jobs, workers),
+        appendable=lambda path: not path.endswith(".json"),
+    )
 
 def collect_anonymized_data():
     """Collect and process anonymized data files from DATA_DIR"""
@@ -20,21 +74,24 @@ def collect_anonymized_data():
         print("No data files found. Please add anonymized data files to this directory.")
         return None
         
-    # Look for all JSON files in the data directory
+    # Archived submissions are read as one sequential scan per segment;
+    # loose JSON files predate the archive
+    segments = submission_archive.segment_paths()
     data_files = glob.glob(os.path.join(DATA_DIR, "*.json"))
-    if not data_files:
+    if not segments and not data_files:
         print("No data files found in the data directory.")
         return None
         
-    print(f"Found {len(data_files)} data files")
+    print(f"Found {len(segments)} archive segments and {len(data_files)} data files")
     
-    # Process data - this is just a placeholder
-    # In a real implementation, you'd parse the JSON files and extract features
+    matrix = extract_features(segments + data_files)
+    if matrix is None:
+        print("No usable sessions found in the data files.")
+        return None
     
-    # Create a simple example dataset if no real data
-    print("Creating example dataset for demonstration...")
-    X = np.random.rand(1000, 5)  # 5 features: dayOfWeek, hourOfDay, etc.
-    y = np.random.rand(1000)     # Target: optimal notification time
+    print(f"Extracted {len(matrix)} sessions with features: {', '.join(SEED_FEATURES)}")
+    X = matrix[:, :len(SEED_FEATURES)]
+    y = matrix[:, len(SEED_FEATURES)]
     
     return X, y
 
@@ -51,22 +108,35 @@ def train_model(X, y):
     
     # Evaluate model
     test_score = model.score(X_test, y_test)
+    mae = mean_absolute_error(y_test, model.predict(X_test))
     print(f"Model R² score on test data: {test_score:.4f}")
+    print(f"Model MAE on test data: {mae:.4f}")
     
-    return model
+    return model, {"mae": mae, "r2": test_score, "training_rows": len(X_train),
+                   "drift_sketch": drift.build_sketch(X_train, SEED_FEATURES)}
 
-def save_model(model):
+def save_model(model, metrics=None):
     """Save the trained model"""
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
         
-    # Save scikit-learn model
+    # Save scikit-learn model; CoreML conversion runs in a worker meanwhile
+    model_bytes = pickle.dumps(model)
+    export = coreml_export.start(model_bytes, SEED_FEATURES)
     with open(MODEL_PATH, 'wb') as f:
-        pickle.dump(model, f)
+        f.write(model_bytes)
     print(f"Model saved to {MODEL_PATH}")
+    coreml_path = export.result()
     
-    # TODO: Convert to CoreML format if needed
-    # This would require coremltools and specific code to convert
+    # Register the new version and serve it by default
+    metrics = metrics or {}
+    version = model_registry.register_model(
+        MODEL_PATH, coreml_path, features=SEED_FEATURES,
+        mae=metrics.get("mae"), training_rows=metrics.get("training_rows"),
+        extra={"r2": metrics.get("r2"), "drift_sketch": metrics.get("drift_sketch")},
+        make_current=True,
+    )
+    print(f"Registered model version {version}")
 
 if __name__ == "__main__":
     print("===== Bit ML Seed Model Creator =====")
@@ -78,13 +148,13 @@ if __name__ == "__main__":
     # Collect data
     data = collect_anonymized_data()
     
-    if data:
+    if data is not None:
         X, y = data
         # Train model
-        model = train_model(X, y)
+        model, metrics = train_model(X, y)
         
         # Save model
-        save_model(model)
+        save_model(model, metrics)
         
         print("\nSeed model creation complete!")
         print("The model is now available for clients to download.")
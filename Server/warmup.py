@@ -0,0 +1,98 @@
+"""
+Startup warm-up for a serving worker.
+
+A freshly loaded model answers its first requests slowly: scikit-learn
+and NumPy initialize lazily, the per-tree code paths and the model's
+arrays are cold, and caches such as the slot-search week matrix or the
+flattened forest are still empty. ``start(tasks)`` runs the given
+``(name, callable)`` steps once in a background thread, timing each, so
+that work is done before traffic arrives. ``ready()`` turns true only
+when the run has ended: ``done``, or ``failed`` if the step list itself
+could not be built (the error is in ``status()``). Until then the
+``/ready`` probe answers 503 and load balancers keep the worker out of
+rotation.
+
+Steps run directly against the models and caches rather than through the
+HTTP routes, so warm-up traffic never reaches admission control, drift
+counts, the prediction log or shadow evaluation. State is per worker.
+"""
+import time
+import threading
+
+_status = {"state": "pending", "started_at": None, "duration_ms": None, "steps": {}, "errors": {}}
+_lock = threading.Lock()
+_done = threading.Event()
+_thread = None
+
+def run_steps(steps, on_step=None):
+    """
+    Run ``(name, callable)`` steps in this thread, timing each.
+
+    Returns ``(ms per step, errors)``; ``on_step(name, ms, error)`` is
+    called after every step.
+    """
+    timings, errors = {}, {}
+    for name, task in steps:
+        step_started = time.perf_counter()
+        error = None
+        try:
+            task()
+        except Exception as e:
+            # A failed step is reported but does not keep the worker unready
+            print(f"Warm-up step {name} failed: {str(e)}")
+            error = errors[name] = str(e)
+        timings[name] = round((time.perf_counter() - step_started) * 1000, 2)
+        if on_step:
+            on_step(name, timings[name], error)
+    return timings, errors
+
+def _record_step(name, ms, error):
+    with _lock:
+        _status["steps"][name] = ms
+        if error is not None:
+            _status["errors"][name] = error
+
+def _run(tasks):
+    started = time.perf_counter()
+    state = "failed"
+    with _lock:
+        _status.update(state="running", started_at=time.time())
+    try:
+        run_steps(tasks(), _record_step)
+        state = "done"
+    except Exception as e:
+        # Building the step list failed; report it rather than staying "running"
+        print(f"Warm-up failed: {str(e)}")
+        with _lock:
+            _status["errors"]["tasks"] = str(e)
+    finally:
+        with _lock:
+            _status.update(state=state, duration_ms=round((time.perf_counter() - started) * 1000, 2))
+        _done.set()
+    print(f"Warm-up {state} in {_status['duration_ms']} ms")
+
+def start(tasks):
+    """
+    Run the warm-up in the background.
+
+    ``tasks()`` returns the ``(name, callable)`` steps; it is called in the
+    warm-up thread so building the list can itself load models.
+    """
+    global _thread
+    if _thread is None or not _thread.is_alive():
+        _done.clear()
+        _thread = threading.Thread(target=_run, args=(tasks,), name="warm-up", daemon=True)
+        _thread.start()
+
+def ready():
+    """True once the warm-up has ended, whether it is ``done`` or ``failed``"""
+    return _done.is_set()
+
+def wait(timeout=None):
+    """Block until the warm-up finished; returns ``ready()``"""
+    return _done.wait(timeout)
+
+def status():
+    """Warm-up state, total and per-step durations in milliseconds"""
+    with _lock:
+        return {**_status, "steps": dict(_status["steps"]), "errors": dict(_status["errors"])}